@@ -1,21 +1,41 @@
+import queue
 import re
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable, Tuple
 
-import inquirer
-import openai
-import pyperclip
 from halo import Halo
 from rich.console import Console
 from rich.syntax import Syntax
 
+from rubberduck_chat.chat_gpt.context_sizing import ContextSizingConfigs, context_size_controller
+from rubberduck_chat.chat_gpt.map_reduce import needs_map_reduce, split_prompt, map_reduce
+from rubberduck_chat.chat_gpt.model_router import ModelRoutingConfigs, parse_model_prefix, \
+  request_model_completion, RoutedResponse, route_chat_completion_stream, fallback_errors, estimate_token_count, \
+  characters_per_token
+from rubberduck_chat.chat_gpt.outbox import add_to_outbox, drain_outbox, has_due_outbox_entries, \
+  get_outbox_entries, print_outbox_status, print_drain_result
+from rubberduck_chat.chat_gpt.relevance_index import Bm25Index, ContextSelectionMode
+from rubberduck_chat.chat_gpt.response_stream import StreamAggregator
 from rubberduck_chat.chat_gpt.session_store import *
+from rubberduck_chat.chat_gpt.usage_stats import record_turn_usage, record_session_usage, print_usage_report
 from rubberduck_chat.utils import get_datetime
 from dataclasses import dataclass
 
 
+continue_prompt = 'Your previous response was cut off. ' \
+                  'Continue it exactly where it stopped, without repeating any of it.'
+
+
 @dataclass
-class GptChatSessionConfigs:
-  chat_gpt_model: str
-  max_messages_per_request: int
+class GptChatSessionConfigs(ModelRoutingConfigs, ContextSizingConfigs):
+  context_selection_mode: ContextSelectionMode
+  relevant_turns_per_request: int
+  relevant_context_max_characters: int
+  map_reduce_chunk_tokens: int
+  map_reduce_max_workers: int
+  outbox_max_workers: int
   snippet_header_background_color: str
   snippet_theme: str
 
@@ -36,6 +56,7 @@ class GptChatSession:
     self.turns: List[GptChatTurn] = turns
     self.console: Console = Console()
     self.snippets: List[str] = []
+    self.relevance_index: Optional[Bm25Index] = None
 
   @classmethod
   def create_new(cls, configs: GptChatSessionConfigs):
@@ -45,26 +66,21 @@ class GptChatSession:
 
   @classmethod
   def from_session_id(cls, session_id: str, configs: GptChatSessionConfigs):
-    lines: List[str] = fetch_session_data(session_id)
-
-    gpt_session_metadata: GptSessionMetadata = GptSessionMetadata.from_line(lines[0])
-    gpt_system_message: GptSystemMessage = GptSystemMessage.from_json_string(lines[1])
-    gpt_chat_turns: List[GptChatTurn] = []
-    turn_ids: set[str] = set()
-
-    for line in lines[-1:1:-1]:
-      turn = GptChatTurn.from_json_string(line)
+    groups = decode_session_records(fetch_session_data(session_id))
 
-      if turn.id in turn_ids:
-        continue
-
-      turn_ids.add(turn.id)
-      gpt_chat_turns.append(turn)
-
-    gpt_chat_turns.reverse()
+    gpt_session_metadata: GptSessionMetadata = GptSessionMetadata.from_line(groups.metadata)
+    gpt_system_message: GptSystemMessage = GptSystemMessage.from_json_string(groups.system_message)
+    gpt_chat_turns: List[GptChatTurn] = get_parent_chat_turns(gpt_session_metadata) + get_chat_turns(groups.turns)
 
     return cls(session_id, configs, gpt_session_metadata, gpt_system_message, gpt_chat_turns)
 
+  def create_fork(self, turn_count: int):
+    # Only a reference to the parent turn is stored, the fork is the same size for any number of turns.
+    session_id = str(uuid4())
+    metadata = GptSessionMetadata(session_id, int(time.time()), self.session_id, self.turns[turn_count - 1].id)
+    store_forked_session_to_file(session_id, metadata, self.system_message)
+    return GptChatSession(session_id, self.configs, metadata, self.system_message, self.turns[:turn_count])
+
   def print_current_session(self, print_time=False):
     for turn in self.turns:
       if print_time:
@@ -78,37 +94,327 @@ class GptChatSession:
         self.print_assistant_response(assistant_response)
 
   def process_prompt(self, prompt: str, configs: GptChatSessionConfigs):
-    current_turn = GptChatTurn.from_user_prompt(prompt)
-    self.store_chat_turn(current_turn)
-    self.turns.append(current_turn)
-    messages: List[dict] = [self.system_message.get_chat_gpt_request_message()]
+    pinned_model, prompt = parse_model_prefix(prompt, configs)
 
-    for turn in self.turns[-(self.configs.max_messages_per_request + 1):]:
-      messages.append(turn.get_user_prompt_message())
-      assistant_response_message = turn.get_assistant_response_message()
-      if assistant_response_message:
-        messages.append(assistant_response_message)
+    if needs_map_reduce(prompt, configs):
+      self.process_map_reduce_prompt(prompt, configs, pinned_model)
+      return
+
+    current_turn = self.add_user_prompt(prompt)
+    messages = self.get_request_messages(pinned_model)
+    self.request_response(current_turn, messages, configs, pinned_model)
+
+  def continue_response(self, configs: GptChatSessionConfigs):
+    current_turn = self.turns[-1] if self.turns else None
+
+    if not current_turn or not current_turn.is_incomplete:
+      print('There is no cancelled response to continue')
+      return
+
+    messages = self.get_request_messages(current_turn.model)
+
+    # The received part is already in the request as the assistant message, the model is asked to go on from it.
+    if current_turn.get_assistant_response():
+      messages.append({'role': GptRole.USER.value, 'content': continue_prompt})
 
-    response = None
+    self.request_response(current_turn, messages, configs, current_turn.model)
+
+  def request_response(self, turn: GptChatTurn, messages: List[dict], configs: GptChatSessionConfigs,
+                       pinned_model: Optional[str]):
+    is_continued = turn.is_incomplete
     error_message = None
+    is_queued = False
+    is_cancelled = False
+
+    with Halo(text='Fetching', spinner='dots', stream=sys.stdout, enabled=sys.stdout.isatty()) as spinner:
+      received_characters = 0
+
+      def on_content(content: str):
+        nonlocal received_characters
+        received_characters += len(content)
+        spinner.text = f'Fetching ({received_characters} characters)'
 
-    with Halo(text='Fetching', spinner='dots'):
       try:
-        response = openai.ChatCompletion.create(model=configs.chat_gpt_model, messages=messages)
+        self.stream_response(turn, messages, configs, pinned_model, on_content)
+      except fallback_errors as error:
+        error_message = str(error)
+        is_queued = not is_continued and self.queue_prompt(turn, messages, pinned_model, error)
+      except KeyboardInterrupt:
+        is_cancelled = True
       except Exception as error:
         error_message = str(error)
 
     if error_message:
       print(error_message)
+      if is_queued:
+        print('Prompt saved to the outbox, it is sent once the API is available again')
       return
 
-    if response:
-      current_turn.updated_response(response)
-      self.store_chat_turn(current_turn)
-      self.print_assistant_response(current_turn.get_assistant_response())
-    else:
+    assistant_response = turn.get_assistant_response()
+
+    if assistant_response:
+      self.print_assistant_response(assistant_response)
+    elif not is_cancelled:
       print('No results found')
 
+    if is_cancelled:
+      print('Response cancelled, type `.continue` to resume it')
+
+  def process_map_reduce_prompt(self, prompt: str, configs: GptChatSessionConfigs, pinned_model: Optional[str]):
+    instruction, content = split_prompt(prompt)
+    current_turn = None
+    error_message = None
+
+    with Halo(text='Processing', spinner='dots', stream=sys.stdout, enabled=sys.stdout.isatty()) as spinner:
+      try:
+        current_turn = self.map_reduce_prompt(instruction, content, configs, pinned_model,
+                                              lambda progress: setattr(spinner, 'text', progress))
+      except KeyboardInterrupt:
+        error_message = 'Cancelled'
+      except Exception as error:
+        error_message = str(error)
+
+    if error_message:
+      print(error_message)
+      print('Completed parts are saved, send the same prompt again to resume')
+    elif current_turn:
+      self.print_assistant_response(current_turn.get_assistant_response() or '')
+
+  def map_reduce_prompt(self, instruction: str, content: str, configs: GptChatSessionConfigs,
+                        pinned_model: Optional[str] = None,
+                        on_progress: Optional[Callable[[str], None]] = None) -> GptChatTurn:
+    result = map_reduce(instruction, content, self.system_message.get_chat_gpt_request_message(), configs,
+                        configs.map_reduce_chunk_tokens, configs.map_reduce_max_workers, pinned_model, on_progress)
+
+    # The input is too large to keep in the session, only the instruction and a note about the input are stored.
+    prompt_note = f'[{len(content)} characters of input processed in {result.chunk_count} parts]'
+    current_turn = self.add_user_prompt(f'{instruction}\n{prompt_note}' if instruction else prompt_note)
+    self.record_unstored_usage(current_turn, result.partial_responses)
+    self.store_response(current_turn, result.response, result.model)
+    return current_turn
+
+  def record_unstored_usage(self, turn: GptChatTurn, responses: List[Tuple[str, dict]]):
+    # Responses that are not kept in the turn were paid for as well, they are counted under the turn they belong to.
+    record_session_usage(self.session_id, [GptChatTurn(turn.id, turn.created_time, turn.user_prompt, response, model)
+                                           for model, response in responses])
+
+  def stream_prompt(self, prompt: str, configs: GptChatSessionConfigs,
+                    on_content: Callable[[str], None]) -> GptChatTurn:
+    pinned_model, prompt = parse_model_prefix(prompt, configs)
+    current_turn = self.add_user_prompt(prompt)
+    messages = self.get_request_messages(pinned_model)
+
+    try:
+      self.stream_response(current_turn, messages, configs, pinned_model, on_content)
+    except fallback_errors as error:
+      self.queue_prompt(current_turn, messages, pinned_model, error)
+      raise
+
+    return current_turn
+
+  def stream_response(self, turn: GptChatTurn, messages: List[dict], configs: GptChatSessionConfigs,
+                      pinned_model: Optional[str], on_content: Callable[[str], None]):
+    previous_content = (turn.get_assistant_response() or '') if turn.is_incomplete else ''
+    aggregator = StreamAggregator()
+    routed_stream = None
+    start_time = time.monotonic()
+    latency_ms = None
+
+    try:
+      routed_stream = route_chat_completion_stream(messages, configs, pinned_model)
+
+      # The latency of a stream is the time to its first chunk, the length of the answer does not count.
+      for chunk in routed_stream.chunks:
+        if latency_ms is None:
+          latency_ms = int((time.monotonic() - start_time) * 1000)
+
+        content = aggregator.add_chunk(chunk)
+        if content:
+          on_content(content)
+    except KeyboardInterrupt:
+      # The content received so far is paid for, it is kept as an incomplete turn that can be continued.
+      if routed_stream:
+        routed_stream.chunks.close()
+        self.store_stream_response(turn, messages, aggregator, routed_stream.model, previous_content, None, True)
+      elif not turn.is_incomplete:
+        turn.is_incomplete = True
+        self.store_chat_turn(turn)
+      raise
+
+    if latency_ms is None:
+      latency_ms = int((time.monotonic() - start_time) * 1000)
+
+    self.store_stream_response(turn, messages, aggregator, routed_stream.model, previous_content, latency_ms, False)
+    self.record_request_latency(messages, pinned_model, latency_ms)
+
+  def store_stream_response(self, turn: GptChatTurn, messages: List[dict], aggregator: StreamAggregator, model: str,
+                            previous_content: str, latency_ms: Optional[int], is_incomplete: bool):
+    response = aggregator.get_response()
+
+    # Streams carry no usage, it is estimated so the context sent with every request and continuation is counted too.
+    response['usage'] = {
+      'prompt_tokens': estimate_token_count(messages),
+      'completion_tokens': len(aggregator.get_content()) // characters_per_token,
+    }
+
+    # Only the content received by this request is counted, the earlier part was counted when it was received.
+    record_turn_usage(self.session_id, GptChatTurn(turn.id, turn.created_time, turn.user_prompt, response, model),
+                      latency_ms)
+
+    if previous_content:
+      response['choices'][0]['message']['content'] = previous_content + aggregator.get_content()
+
+    self.store_response(turn, response, model, is_incomplete=is_incomplete, record_usage=False)
+
+  def queue_prompt(self, turn: GptChatTurn, messages: List[dict], pinned_model: Optional[str],
+                   error: Exception) -> bool:
+    try:
+      add_to_outbox(self.session_id, turn, messages, pinned_model, error)
+      return True
+    except OSError:
+      return False
+
+  def update_sent_turn(self, session_id: str, sent_turn: GptChatTurn):
+    if session_id != self.session_id:
+      return
+
+    for turn in self.turns:
+      if turn.id == sent_turn.id:
+        turn.updated_response(sent_turn.response, sent_turn.model)
+
+  def compare_prompt(self, prompt: str, models: List[str], configs: GptChatSessionConfigs):
+    if not models:
+      print('No models to compare, set `compare_models` or pass them with --models')
+      return
+
+    current_turn = self.add_user_prompt(prompt)
+    messages = self.get_request_messages()
+    routed_responses: List[RoutedResponse] = []
+
+    # Every model is requested at once, answers are printed in the order they arrive.
+    with ThreadPoolExecutor(max_workers=len(models)) as executor:
+      futures = {executor.submit(request_model_completion, model, messages, configs): model for model in models}
+
+      with Halo(text=f'Fetching from {len(models)} models', spinner='dots', stream=sys.stdout,
+                enabled=sys.stdout.isatty()) as spinner:
+        remaining_count = len(futures)
+
+        for future in as_completed(futures):
+          remaining_count -= 1
+          spinner.stop()
+
+          try:
+            routed_response = future.result()
+            routed_responses.append(routed_response)
+            self.console.rule(f'{routed_response.model} | {routed_response.latency_ms} ms')
+            self.print_assistant_response(get_response_content(routed_response.response) or '')
+          except Exception as error:
+            self.console.rule(f'{futures[future]} | failed')
+            print(str(error))
+
+          if remaining_count > 0:
+            spinner.start()
+
+    if not routed_responses:
+      print('No results found')
+      return
+
+    selected_response = self.select_compared_response(routed_responses)
+    self.record_unstored_usage(current_turn, [(routed_response.model, routed_response.response)
+                                              for routed_response in routed_responses
+                                              if routed_response is not selected_response])
+    self.store_response(current_turn, selected_response.response, selected_response.model,
+                        selected_response.latency_ms)
+
+  def select_compared_response(self, routed_responses: List[RoutedResponse]) -> RoutedResponse:
+    if len(routed_responses) == 1 or not sys.stdin.isatty():
+      return routed_responses[0]
+
+    import inquirer
+
+    choices = [(f'{routed_response.model} | {routed_response.latency_ms} ms', routed_response)
+               for routed_response in routed_responses]
+    answers = inquirer.prompt([inquirer.List('response', message='Keep response from', choices=choices)])
+
+    if answers:
+      return answers['response']
+    else:
+      return routed_responses[0]
+
+  def add_user_prompt(self, prompt: str) -> GptChatTurn:
+    current_turn = GptChatTurn.from_user_prompt(prompt)
+    self.store_chat_turn(current_turn)
+    self.turns.append(current_turn)
+
+    if self.relevance_index is not None:
+      self.relevance_index.add(get_turn_text(current_turn))
+
+    return current_turn
+
+  def get_sizing_model(self, pinned_model: Optional[str] = None) -> str:
+    # The context is sized before the router picks a model, so sizes are kept per requested model, not routed model.
+    return pinned_model or self.configs.chat_gpt_model
+
+  def get_max_messages(self, pinned_model: Optional[str] = None) -> int:
+    return context_size_controller.get_max_messages(self.get_sizing_model(pinned_model), self.configs)
+
+  def get_request_messages(self, pinned_model: Optional[str] = None) -> List[dict]:
+    messages: List[dict] = [self.system_message.get_chat_gpt_request_message()]
+    recent_turn_count = self.get_max_messages(pinned_model) + 1
+    older_turn_count = max(len(self.turns) - recent_turn_count, 0)
+    turns = self.turns[older_turn_count:]
+
+    if self.configs.context_selection_mode == ContextSelectionMode.RELEVANT and older_turn_count and turns:
+      turns = self.get_relevant_turns(turns[-1].user_prompt, older_turn_count) + turns
+
+    for turn in turns:
+      messages.append(turn.get_user_prompt_message())
+      assistant_response_message = turn.get_assistant_response_message()
+      if assistant_response_message:
+        messages.append(assistant_response_message)
+
+    return messages
+
+  def get_relevant_turns(self, prompt: str, older_turn_count: int) -> List[GptChatTurn]:
+    # The index is built on first use, afterwards it is updated as turns are stored.
+    if self.relevance_index is None:
+      self.relevance_index = Bm25Index()
+      for turn in self.turns:
+        self.relevance_index.add(get_turn_text(turn))
+
+    matches = self.relevance_index.search(prompt, self.configs.relevant_turns_per_request, older_turn_count)
+    remaining_characters = self.configs.relevant_context_max_characters
+    turn_indexes: List[int] = []
+
+    for turn_index, _ in matches:
+      turn_characters = len(get_turn_text(self.turns[turn_index]))
+      if turn_characters <= remaining_characters:
+        turn_indexes.append(turn_index)
+        remaining_characters -= turn_characters
+
+    # Relevant turns are sent in the order they happened, ahead of the recent turns.
+    return [self.turns[turn_index] for turn_index in sorted(turn_indexes)]
+
+  def record_request_latency(self, messages: List[dict], pinned_model: Optional[str], latency_ms: int):
+    # A request is limited when older turns were left out, only then can more context be sent.
+    is_limited = len(self.turns) > self.get_max_messages(pinned_model) + 1
+    context_size_controller.record(self.get_sizing_model(pinned_model), estimate_token_count(messages), is_limited,
+                                   latency_ms, self.configs)
+
+  def store_response(self, turn: GptChatTurn, response: dict, model: Optional[str] = None,
+                     latency_ms: Optional[int] = None, is_incomplete: bool = False, record_usage: bool = True):
+    turn.updated_response(response, model, is_incomplete)
+    self.store_chat_turn(turn)
+
+    if record_usage:
+      record_turn_usage(self.session_id, turn, latency_ms)
+
+    if self.relevance_index is not None:
+      for turn_index in range(len(self.turns) - 1, -1, -1):
+        if self.turns[turn_index] is turn:
+          self.relevance_index.set_document(turn_index, get_turn_text(turn))
+          break
+
   def print_assistant_response(self, message: str):
     new_snippets: List[str] = []
     message_parts = message.split('\n')
@@ -172,6 +478,8 @@ class GptChatSession:
 
   def copy_snippet(self, snippet_index: int):
     if snippet_index <= len(self.snippets):
+      import pyperclip
+
       pyperclip.copy(self.snippets[snippet_index - 1])
       print('Snippet copied to clipboard')
     else:
@@ -181,9 +489,11 @@ class GptChatSession:
     if self.turns:
       store_chat_turn_to_file(self.session_id, gpt_chat_turn)
     else:
-      store_metadata_to_file(self.session_id, self.session_metadata)
-      store_system_message_to_file(self.session_id, self.system_message)
-      store_chat_turn_to_file(self.session_id, gpt_chat_turn)
+      store_new_session_to_file(self.session_id, self.session_metadata, self.system_message, gpt_chat_turn)
+
+
+def get_turn_text(turn: GptChatTurn) -> str:
+  return f'{turn.user_prompt}\n{turn.get_assistant_response() or ""}'
 
 
 class GptChat:
@@ -191,10 +501,60 @@ class GptChat:
   def __init__(self, session: GptChatSession, configs: GptChatSessionConfigs):
     self.session = session
     self.configs = configs
+    self.outbox_thread: Optional[threading.Thread] = None
+    self.sent_turns: queue.SimpleQueue = queue.SimpleQueue()
 
   def process_prompt(self, prompt: str):
     self.session.process_prompt(prompt, self.configs)
 
+  def continue_response(self):
+    self.session.continue_response(self.configs)
+
+  def stream_prompt(self, prompt: str, on_content: Callable[[str], None]) -> GptChatTurn:
+    return self.session.stream_prompt(prompt, self.configs, on_content)
+
+  def map_reduce_prompt(self, instruction: str, content: str) -> GptChatTurn:
+    return self.session.map_reduce_prompt(instruction, content, self.configs)
+
+  def compare_prompt(self, prompt: str, models: List[str]):
+    self.session.compare_prompt(prompt, models, self.configs)
+
+  def drain_outbox(self):
+    print_outbox_status(get_outbox_entries())
+
+    with Halo(text='Sending', spinner='dots', stream=sys.stdout, enabled=sys.stdout.isatty()):
+      result = drain_outbox(self.configs, self.configs.outbox_max_workers, due_only=False,
+                            on_sent=self.update_sent_turn)
+
+    self.apply_sent_turns()
+    print_drain_result(result)
+
+  def drain_outbox_in_background(self):
+    if self.outbox_thread and self.outbox_thread.is_alive():
+      return
+
+    if not has_due_outbox_entries():
+      return
+
+    # Responses are appended to their sessions quietly, the current session is updated before the next input.
+    self.outbox_thread = threading.Thread(target=drain_outbox, daemon=True,
+                                          args=(self.configs, self.configs.outbox_max_workers),
+                                          kwargs={'on_sent': self.update_sent_turn})
+    self.outbox_thread.start()
+
+  def update_sent_turn(self, session_id: str, turn: GptChatTurn):
+    # Called from the outbox threads, the turns of the session are only changed by the thread reading input.
+    self.sent_turns.put((session_id, turn))
+
+  def apply_sent_turns(self):
+    while True:
+      try:
+        session_id, turn = self.sent_turns.get_nowait()
+      except queue.Empty:
+        return
+
+      self.session.update_sent_turn(session_id, turn)
+
   def create_new_session(self):
     self.session = GptChatSession.create_new(self.configs)
     set_active_session_id(self.session.session_id)
@@ -204,6 +564,30 @@ class GptChat:
     self.configs = configs
     self.session.configs = configs
 
+  def fork_session(self, turn_count: Optional[int] = None):
+    if not self.session.turns:
+      print('No turns to fork from')
+      return
+
+    if turn_count is None:
+      turn_count = len(self.session.turns)
+
+    if not 1 <= turn_count <= len(self.session.turns):
+      print(f'Turn must be between 1 and {len(self.session.turns)}')
+      return
+
+    self.session = self.session.create_fork(turn_count)
+    set_active_session_id(self.session.session_id)
+    print(f'Forked session at turn {turn_count}: {self.session.turns[-1].user_prompt}')
+
+  def print_usage(self):
+    print_usage_report(self.session.session_id)
+
+  def toggle_pin_session(self):
+    is_pinned = self.session.session_id not in get_pinned_session_ids()
+    set_session_pinned(self.session.session_id, is_pinned)
+    print('Session pinned' if is_pinned else 'Session unpinned')
+
   def has_snippet(self, snippet_index: int) -> bool:
     return self.session.has_snippet(snippet_index)
 
@@ -214,6 +598,8 @@ class GptChat:
     self.session.print_current_session(print_time=True)
 
   def change_session(self):
+    import inquirer
+
     session_previews = get_all_session_previews()
 
     if not session_previews:
@@ -232,7 +618,13 @@ class GptChat:
 
     if answers:
       preview: GptSessionPreview = answers['option']
-      self.session = GptChatSession.from_session_id(preview.session_id, self.configs)
+
+      try:
+        self.session = GptChatSession.from_session_id(preview.session_id, self.configs)
+      except (ValueError, OSError):
+        print(f'Could not load session: {preview.session_preview}')
+        return
+
       self.session.print_current_session(print_time=True)
       set_active_session_id(preview.session_id)
       print(f'Loaded session: {preview.session_preview}')
@@ -0,0 +1,149 @@
+import json
+import os
+import tempfile
+import threading
+import time
+from dataclasses import dataclass
+from typing import Optional, List, Tuple
+
+from rubberduck_chat.chat_gpt.session_store import get_gpt_dir_filepath
+
+context_sizing_filename = 'context-sizing.json'
+context_sizing_log_filename = 'context-sizing-log.jsonl'
+max_latency_samples = 20
+min_latency_samples = 5
+decrease_factor = 0.7
+increase_headroom = 0.8
+
+
+@dataclass
+class ContextSizingConfigs:
+  max_messages_per_request: int
+  min_messages_per_request: int
+  target_p50_latency_in_ms: int
+  target_p95_latency_in_ms: int
+
+  def is_enabled(self) -> bool:
+    return self.target_p50_latency_in_ms > 0 or self.target_p95_latency_in_ms > 0
+
+  def clamp(self, max_messages: int) -> int:
+    min_messages = min(self.min_messages_per_request, self.max_messages_per_request)
+    return max(min_messages, min(max_messages, self.max_messages_per_request))
+
+
+def get_percentile(values: List[int], percentile: float) -> int:
+  sorted_values = sorted(values)
+  return sorted_values[min(int(len(sorted_values) * percentile), len(sorted_values) - 1)]
+
+
+class ContextSizeController:
+
+  def __init__(self):
+    self.state: Optional[dict[str, dict]] = None
+    self.lock = threading.RLock()
+
+  def get_state_filepath(self) -> str:
+    return get_gpt_dir_filepath(context_sizing_filename)
+
+  def get_log_filepath(self) -> str:
+    return get_gpt_dir_filepath(context_sizing_log_filename)
+
+  def get(self, model: str) -> dict:
+    with self.lock:
+      if self.state is None:
+        try:
+          with open(self.get_state_filepath(), 'r') as file:
+            self.state = json.load(file)
+        except (FileNotFoundError, ValueError):
+          self.state = {}
+
+      return self.state.setdefault(model, {'max_messages': None, 'samples': []})
+
+  def get_max_messages(self, model: str, configs: ContextSizingConfigs) -> int:
+    if not configs.is_enabled():
+      return configs.max_messages_per_request
+
+    # Every model starts at the configured maximum and only sends less after it was measured to be too slow.
+    with self.lock:
+      max_messages = self.get(model)['max_messages']
+      return configs.clamp(configs.max_messages_per_request if max_messages is None else max_messages)
+
+  def record(self, model: str, request_tokens: int, is_limited: bool, latency_ms: int, configs: ContextSizingConfigs):
+    if not configs.is_enabled():
+      return
+
+    with self.lock:
+      state = self.get(model)
+      max_messages = self.get_max_messages(model, configs)
+      samples = state['samples'] = (state['samples'] + [[latency_ms, request_tokens, is_limited]])[-max_latency_samples:]
+
+      if len(samples) < min_latency_samples:
+        state['max_messages'] = max_messages
+        self.save()
+        return
+
+      latencies = [sample[0] for sample in samples]
+      p50_latency_ms = get_percentile(latencies, 0.5)
+      p95_latency_ms = get_percentile(latencies, 0.95)
+      new_max_messages, reason = self.get_adjustment(max_messages, samples, p50_latency_ms, p95_latency_ms, configs)
+      state['max_messages'] = new_max_messages
+
+      # Samples describe the latency at one context size, they are dropped whenever the size changes.
+      if new_max_messages != max_messages:
+        state['samples'] = []
+        self.log_decision(model, max_messages, new_max_messages, p50_latency_ms, p95_latency_ms, samples, reason)
+
+      self.save()
+
+  def get_adjustment(self, max_messages: int, samples: List[list], p50_latency_ms: int, p95_latency_ms: int,
+                     configs: ContextSizingConfigs) -> Tuple[int, Optional[str]]:
+    targets = [(p50_latency_ms, configs.target_p50_latency_in_ms, 'p50'),
+               (p95_latency_ms, configs.target_p95_latency_in_ms, 'p95')]
+    targets = [(latency_ms, target_ms, name) for latency_ms, target_ms, name in targets if target_ms > 0]
+    missed_targets = [name for latency_ms, target_ms, name in targets if latency_ms > target_ms]
+
+    # Missed targets cut the context quickly, it is given back one message at a time while there is headroom.
+    if missed_targets:
+      return configs.clamp(int(max_messages * decrease_factor)), f'{"/".join(missed_targets)} over target'
+
+    is_usually_limited = sum(1 for sample in samples if sample[2]) * 2 > len(samples)
+    has_headroom = all(latency_ms < target_ms * increase_headroom for latency_ms, target_ms, _ in targets)
+
+    if is_usually_limited and has_headroom:
+      return configs.clamp(max_messages + 1), 'under target'
+
+    return max_messages, None
+
+  def log_decision(self, model: str, previous_max_messages: int, max_messages: int, p50_latency_ms: int,
+                   p95_latency_ms: int, samples: List[list], reason: str):
+    decision = {
+      'time': int(time.time()),
+      'model': model,
+      'previous_max_messages': previous_max_messages,
+      'max_messages': max_messages,
+      'p50_latency_ms': p50_latency_ms,
+      'p95_latency_ms': p95_latency_ms,
+      'sample_count': len(samples),
+      'average_request_tokens': sum(sample[1] for sample in samples) // len(samples),
+      'reason': reason,
+    }
+
+    try:
+      with open(self.get_log_filepath(), 'a', encoding='utf-8') as file:
+        file.write(json.dumps(decision) + '\n')
+    except OSError:
+      pass
+
+  def save(self):
+    filepath = self.get_state_filepath()
+
+    try:
+      file_descriptor, temp_filepath = tempfile.mkstemp(dir=os.path.dirname(filepath), prefix=context_sizing_filename)
+      with os.fdopen(file_descriptor, 'w') as file:
+        json.dump(self.state, file)
+      os.replace(temp_filepath, filepath)
+    except OSError:
+      pass
+
+
+context_size_controller = ContextSizeController()
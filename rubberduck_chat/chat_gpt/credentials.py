@@ -3,7 +3,6 @@ import getpass
 import os
 from typing import Optional
 
-import inquirer
 import openai
 
 from rubberduck_chat.chat_gpt.session_store import gpt_dir_name
@@ -44,7 +43,13 @@ def setup_gpt_credentials(openai_api_key: Optional[str]):
     exit()
 
 
+def process_key_command(gpt_chat, user_input: str):
+  ask_for_key_input()
+
+
 def ask_for_key_input():
+  import inquirer
+
   print('Update or delete key. Press Ctrl+C to cancel.')
   message = 'Option'
   options = [
@@ -0,0 +1,227 @@
+import hashlib
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, field
+from typing import Optional, List, Tuple, Callable
+
+from rubberduck_chat.chat_gpt import session_codec
+from rubberduck_chat.chat_gpt.model_router import ModelRoutingConfigs, route_chat_completion, estimate_token_count, \
+  get_context_token_limit, characters_per_token
+from rubberduck_chat.chat_gpt.session_store import GptRole, get_gpt_dir_filepath, get_response_content
+
+map_reduce_dir_name = 'map-reduce'
+default_context_token_limit = 4096
+context_fill_ratio = 0.75
+map_prompt_template = '{instruction}\n\nThe input is split into {count} parts, this is part {number}:\n\n{chunk}'
+reduce_prompt_template = '{instruction}\n\nThe input was split into parts and answered part by part. ' \
+                         'Combine these partial answers into a single answer:\n\n{answers}'
+
+
+@dataclass
+class MapReduceResult:
+  response: dict
+  model: str
+  chunk_count: int
+  partial_responses: List[Tuple[str, dict]] = field(default_factory=list)
+
+
+def get_input_token_limit(configs: ModelRoutingConfigs) -> int:
+  models = [configs.chat_gpt_model, *configs.fallback_models]
+  context_token_limits = [get_context_token_limit(model) for model in models]
+  context_token_limit = max([limit for limit in context_token_limits if limit], default=default_context_token_limit)
+  return int(context_token_limit * context_fill_ratio)
+
+
+def needs_map_reduce(prompt: str, configs: ModelRoutingConfigs) -> bool:
+  return estimate_token_count([{'content': prompt}]) > get_input_token_limit(configs)
+
+
+def split_prompt(prompt: str) -> Tuple[str, str]:
+  # The first line of a large prompt is taken as the instruction, the rest as the input it applies to.
+  instruction, _, content = prompt.partition('\n')
+
+  if not content.strip():
+    return '', prompt
+
+  return instruction.strip(), content
+
+
+def split_into_chunks(content: str, max_characters: int) -> List[str]:
+  chunks: List[str] = []
+  chunk_parts: List[str] = []
+  chunk_characters = 0
+
+  for part in split_on_boundaries(content, max_characters):
+    if chunk_parts and chunk_characters + len(part) > max_characters:
+      chunks.append(''.join(chunk_parts))
+      chunk_parts = []
+      chunk_characters = 0
+
+    chunk_parts.append(part)
+    chunk_characters += len(part)
+
+  if chunk_parts:
+    chunks.append(''.join(chunk_parts))
+
+  return [chunk for chunk in chunks if chunk.strip()]
+
+
+def split_on_boundaries(text: str, max_characters: int, separators: Tuple[str, ...] = ('\n\n', '\n')) -> List[str]:
+  # Paragraphs are kept whole when possible, then lines, and only lines longer than a chunk are cut.
+  if len(text) <= max_characters:
+    return [text]
+
+  if not separators:
+    return [text[index:index + max_characters] for index in range(0, len(text), max_characters)]
+
+  separator = separators[0]
+  pieces = text.split(separator)
+  parts: List[str] = []
+
+  for index, piece in enumerate(pieces):
+    if index < len(pieces) - 1:
+      piece += separator
+    parts.extend(split_on_boundaries(piece, max_characters, separators[1:]))
+
+  return parts
+
+
+class MapReduceCheckpoint:
+
+  def __init__(self, filepath: str):
+    self.filepath = filepath
+    self.results: dict[Tuple[int, int], Tuple[str, dict]] = {}
+    self.lock = threading.Lock()
+
+    try:
+      with open(filepath, 'r', encoding='utf-8') as file:
+        for line in file:
+          try:
+            data = session_codec.loads(line)
+          except ValueError:
+            continue
+          self.results[(data['level'], data['index'])] = (data['model'], data['response'])
+    except FileNotFoundError:
+      os.makedirs(os.path.dirname(filepath), exist_ok=True)
+
+  def get(self, level: int, index: int) -> Optional[Tuple[str, dict]]:
+    return self.results.get((level, index))
+
+  def save(self, level: int, index: int, model: str, response: dict):
+    line = session_codec.dumps({'level': level, 'index': index, 'model': model, 'response': response})
+
+    with self.lock:
+      self.results[(level, index)] = (model, response)
+      with open(self.filepath, 'a', encoding='utf-8') as file:
+        file.write(line + '\n')
+
+  def remove(self):
+    try:
+      os.remove(self.filepath)
+    except FileNotFoundError:
+      pass
+
+
+def get_checkpoint_filepath(instruction: str, content: str, configs: ModelRoutingConfigs, chunk_tokens: int) -> str:
+  digest = hashlib.sha256()
+
+  for value in [configs.chat_gpt_model, str(chunk_tokens), instruction, content]:
+    digest.update(value.encode('utf-8'))
+    digest.update(b'\0')
+
+  return os.path.join(get_gpt_dir_filepath(map_reduce_dir_name), f'{digest.hexdigest()}.jsonl')
+
+
+def group_partial_answers(answers: List[str], max_characters: int) -> List[List[str]]:
+  groups: List[List[str]] = []
+
+  for answer in answers:
+    # Every group takes at least two answers so each level is smaller than the one before.
+    if groups and (len(groups[-1]) < 2 or sum(map(len, groups[-1])) + len(answer) <= max_characters):
+      groups[-1].append(answer)
+    else:
+      groups.append([answer])
+
+  return groups
+
+
+def get_reduce_prompt(instruction: str, answers: List[str]) -> str:
+  joined_answers = '\n\n'.join(f'Part {number}:\n{answer}' for number, answer in enumerate(answers, start=1))
+  return reduce_prompt_template.format(instruction=instruction, answers=joined_answers)
+
+
+def map_reduce(instruction: str, content: str, system_message: dict, configs: ModelRoutingConfigs,
+               chunk_tokens: int, max_workers: int, pinned_model: Optional[str] = None,
+               on_progress: Optional[Callable[[str], None]] = None) -> MapReduceResult:
+  max_characters = chunk_tokens * characters_per_token
+  chunks = split_into_chunks(content, max_characters)
+
+  if not chunks:
+    raise ValueError('The input is empty, there is nothing to process')
+
+  prompts = [map_prompt_template.format(instruction=instruction, count=len(chunks), number=number, chunk=chunk)
+             for number, chunk in enumerate(chunks, start=1)]
+  checkpoint = MapReduceCheckpoint(get_checkpoint_filepath(instruction, content, configs, chunk_tokens))
+  level = 0
+  partial_responses: List[Tuple[str, dict]] = []
+
+  while True:
+    results = run_level(level, prompts, system_message, configs, max_workers, checkpoint, pinned_model, on_progress)
+
+    if not results:
+      raise ValueError('No partial answers were returned')
+
+    if len(results) == 1:
+      checkpoint.remove()
+      model, response = results[0]
+      return MapReduceResult(response, model, len(chunks), partial_responses)
+
+    partial_responses.extend(results)
+    answers = [get_response_content(response) or '' for _, response in results]
+    prompts = [get_reduce_prompt(instruction, group) for group in group_partial_answers(answers, max_characters)]
+    level += 1
+
+
+def run_level(level: int, prompts: List[str], system_message: dict, configs: ModelRoutingConfigs, max_workers: int,
+              checkpoint: MapReduceCheckpoint, pinned_model: Optional[str],
+              on_progress: Optional[Callable[[str], None]]) -> List[Tuple[str, dict]]:
+  results: List[Optional[Tuple[str, dict]]] = [checkpoint.get(level, index) for index in range(len(prompts))]
+  completed_count = sum(1 for result in results if result)
+  stage = 'Processing' if level == 0 else 'Combining'
+
+  if on_progress:
+    on_progress(f'{stage} {completed_count}/{len(prompts)}')
+
+  executor = ThreadPoolExecutor(max_workers=max_workers)
+  futures = {}
+
+  try:
+    for index, prompt in enumerate(prompts):
+      if not results[index]:
+        messages = [system_message, {'role': GptRole.USER.value, 'content': prompt}]
+        futures[executor.submit(route_chat_completion, messages, configs, pinned_model)] = index
+
+    for future in as_completed(futures):
+      routed_response = future.result()
+      index = futures[future]
+      results[index] = (routed_response.model, routed_response.response)
+      checkpoint.save(level, index, routed_response.model, routed_response.response)
+      completed_count += 1
+
+      if on_progress:
+        on_progress(f'{stage} {completed_count}/{len(prompts)}')
+  finally:
+    # Parts that are not started yet are dropped, parts already sent are waited for and checkpointed as well.
+    # A failed or interrupted run resumes from the checkpoint without sending any finished part again.
+    for future in futures:
+      future.cancel()
+
+    executor.shutdown(wait=True)
+
+    for future, index in futures.items():
+      if not results[index] and not future.cancelled() and not future.exception():
+        routed_response = future.result()
+        checkpoint.save(level, index, routed_response.model, routed_response.response)
+
+  return results
@@ -0,0 +1,351 @@
+import asyncio
+import atexit
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+from dataclasses import dataclass
+from typing import Optional, List, Tuple, Iterator
+
+import openai
+
+from rubberduck_chat.chat_gpt.rate_limiter import rate_limiter, current_model
+from rubberduck_chat.chat_gpt.session_store import get_gpt_dir_filepath
+
+model_stats_filename = 'model-stats.json'
+model_prefix_pattern = re.compile(r'^@(\S+)\s+(.*)$', re.DOTALL)
+stats_smoothing_factor = 0.2
+unhealthy_error_rate = 0.5
+default_rate_limit_cooldown_in_seconds = 30
+characters_per_token = 4
+tokens_per_message = 4
+stats_save_interval_in_seconds = 5.0
+
+model_context_token_limits = {
+  'gpt-3.5-turbo': 4096,
+  'gpt-3.5-turbo-0613': 4096,
+  'gpt-3.5-turbo-16k': 16384,
+  'gpt-3.5-turbo-16k-0613': 16384,
+  'gpt-4': 8192,
+  'gpt-4-0613': 8192,
+  'gpt-4-32k': 32768,
+  'gpt-4-32k-0613': 32768,
+}
+
+fallback_errors = (
+  openai.error.RateLimitError,
+  openai.error.Timeout,
+  openai.error.APIConnectionError,
+  openai.error.ServiceUnavailableError,
+  openai.error.TryAgain,
+)
+
+
+@dataclass
+class ModelRoutingConfigs:
+  chat_gpt_model: str
+  fallback_models: List[str]
+  light_model: str
+  light_model_max_prompt_tokens: int
+  request_timeout_in_seconds: int
+  requests_per_minute: int
+  tokens_per_minute: int
+
+
+@dataclass
+class RoutedResponse:
+  response: dict
+  model: str
+  latency_ms: int
+
+
+@dataclass
+class RoutedStream:
+  chunks: Iterator[dict]
+  model: str
+
+
+def estimate_token_count(messages: List[dict]) -> int:
+  return sum(len(message.get('content') or '') // characters_per_token + tokens_per_message for message in messages)
+
+
+def get_context_token_limit(model: str) -> Optional[int]:
+  return model_context_token_limits.get(model)
+
+
+def parse_model_prefix(prompt: str, configs: ModelRoutingConfigs) -> Tuple[Optional[str], str]:
+  match = model_prefix_pattern.match(prompt)
+
+  if not match:
+    return None, prompt
+
+  model = match.group(1)
+  known_models = [configs.chat_gpt_model, configs.light_model, *configs.fallback_models, *model_context_token_limits]
+
+  if model in known_models:
+    return model, match.group(2)
+  else:
+    return None, prompt
+
+
+class ModelStats:
+
+  def __init__(self):
+    self.stats: Optional[dict[str, dict]] = None
+    self.lock = threading.RLock()
+    self.is_dirty = False
+    self.last_save_time = 0.0
+
+  def get_stats_filepath(self) -> str:
+    return get_gpt_dir_filepath(model_stats_filename)
+
+  def get(self, model: str) -> dict:
+    with self.lock:
+      if self.stats is None:
+        try:
+          with open(self.get_stats_filepath(), 'r') as file:
+            self.stats = json.load(file)
+        except (FileNotFoundError, ValueError):
+          self.stats = {}
+
+      default_stats = {'latency_ms': None, 'error_rate': 0.0, 'requests': 0, 'cooldown_until': 0}
+      return self.stats.setdefault(model, default_stats)
+
+  def record_success(self, model: str, latency_ms: int):
+    with self.lock:
+      stats = self.get(model)
+      previous_latency_ms = stats['latency_ms']
+      stats['latency_ms'] = latency_ms if previous_latency_ms is None else \
+        previous_latency_ms + stats_smoothing_factor * (latency_ms - previous_latency_ms)
+      stats['error_rate'] *= 1 - stats_smoothing_factor
+      stats['requests'] += 1
+      self.save_throttled()
+
+  def record_error(self, model: str, error: Exception):
+    with self.lock:
+      stats = self.get(model)
+      stats['error_rate'] += stats_smoothing_factor * (1 - stats['error_rate'])
+      stats['requests'] += 1
+
+      if isinstance(error, openai.error.RateLimitError):
+        retry_after = error.headers.get('retry-after') if error.headers else None
+        is_valid_retry_after = retry_after and retry_after.isdigit()
+        cooldown = int(retry_after) if is_valid_retry_after else default_rate_limit_cooldown_in_seconds
+        stats['cooldown_until'] = int(time.time()) + cooldown
+
+      self.save_throttled()
+
+  def is_healthy(self, model: str) -> bool:
+    stats = self.get(model)
+    return stats['error_rate'] < unhealthy_error_rate and stats['cooldown_until'] <= time.time()
+
+  def get_score(self, model: str) -> float:
+    stats = self.get(model)
+    latency_ms = stats['latency_ms'] if stats['latency_ms'] is not None else 0
+    return latency_ms * (1 + stats['error_rate'])
+
+  def save_throttled(self):
+    # Stats change on every request, the file is rewritten at most once per interval and at exit.
+    self.is_dirty = True
+
+    if time.monotonic() - self.last_save_time >= stats_save_interval_in_seconds:
+      self.save()
+
+  def save_if_dirty(self):
+    with self.lock:
+      if self.is_dirty:
+        self.save()
+
+  def save(self):
+    self.is_dirty = False
+    self.last_save_time = time.monotonic()
+    filepath = self.get_stats_filepath()
+
+    try:
+      file_descriptor, temp_filepath = tempfile.mkstemp(dir=os.path.dirname(filepath), prefix=model_stats_filename)
+      with os.fdopen(file_descriptor, 'w') as file:
+        json.dump(self.stats, file)
+      os.replace(temp_filepath, filepath)
+    except OSError:
+      pass
+
+
+model_stats = ModelStats()
+atexit.register(model_stats.save_if_dirty)
+
+
+def get_candidate_models(messages: List[dict], configs: ModelRoutingConfigs,
+                         pinned_model: Optional[str] = None) -> List[str]:
+  if pinned_model:
+    preferred_models = [pinned_model]
+  else:
+    preferred_models = [configs.chat_gpt_model]
+    prompt_tokens = estimate_token_count(messages[-1:])
+    if configs.light_model and prompt_tokens <= configs.light_model_max_prompt_tokens:
+      preferred_models.insert(0, configs.light_model)
+
+  # Fallback models are ordered by measured latency and error rate.
+  fallback_models = sorted([model for model in configs.fallback_models if model], key=model_stats.get_score)
+  candidates: List[str] = []
+
+  for model in preferred_models + [configs.chat_gpt_model] + fallback_models:
+    if model not in candidates:
+      candidates.append(model)
+
+  # Models that cannot fit the request are skipped, unless none of them can.
+  request_tokens = estimate_token_count(messages)
+  fitting_candidates = [model for model in candidates
+                        if not get_context_token_limit(model) or get_context_token_limit(model) >= request_tokens]
+  candidates = fitting_candidates or candidates
+
+  # Rate limited or failing models are tried last.
+  return [model for model in candidates if model_stats.is_healthy(model)] + \
+    [model for model in candidates if not model_stats.is_healthy(model)]
+
+
+def get_used_token_count(response: dict, prompt_tokens: int) -> int:
+  usage = response.get('usage')
+
+  if usage and usage.get('total_tokens'):
+    return usage['total_tokens']
+
+  contents = [(choice.get('message') or {}).get('content') or '' for choice in response.get('choices', [])]
+  return prompt_tokens + sum(len(content) for content in contents) // characters_per_token
+
+
+def record_stream_tokens(model: str, chunks: Iterator[dict], prompt_tokens: int) -> Iterator[dict]:
+  completion_characters = 0
+
+  for chunk in chunks:
+    for choice in chunk.get('choices', []):
+      completion_characters += len((choice.get('delta') or {}).get('content') or '')
+    yield chunk
+
+  rate_limiter.record_used_tokens(model, prompt_tokens + completion_characters // characters_per_token, prompt_tokens)
+
+
+def create_completion(model: str, messages: List[dict], configs: ModelRoutingConfigs, **kwargs):
+  # Every request waits for the budget shared by all rda processes before it is sent.
+  prompt_tokens = estimate_token_count(messages)
+  rate_limiter.acquire(model, prompt_tokens, configs.requests_per_minute, configs.tokens_per_minute)
+  model_token = current_model.set(model)
+
+  try:
+    response = openai.ChatCompletion.create(model=model, messages=messages,
+                                            request_timeout=configs.request_timeout_in_seconds, **kwargs)
+  finally:
+    current_model.reset(model_token)
+
+  if kwargs.get('stream'):
+    return record_stream_tokens(model, response, prompt_tokens)
+
+  rate_limiter.record_used_tokens(model, get_used_token_count(response, prompt_tokens), prompt_tokens)
+  return response
+
+
+async def acreate_completion(model: str, messages: List[dict], configs: ModelRoutingConfigs, **kwargs):
+  prompt_tokens = estimate_token_count(messages)
+  await rate_limiter.aacquire(model, prompt_tokens, configs.requests_per_minute, configs.tokens_per_minute)
+  model_token = current_model.set(model)
+
+  try:
+    response = await openai.ChatCompletion.acreate(model=model, messages=messages,
+                                                   request_timeout=configs.request_timeout_in_seconds, **kwargs)
+  finally:
+    current_model.reset(model_token)
+
+  await asyncio.get_running_loop().run_in_executor(None, rate_limiter.record_used_tokens, model,
+                                                   get_used_token_count(response, prompt_tokens), prompt_tokens)
+  return response
+
+
+def request_model_completion(model: str, messages: List[dict], configs: ModelRoutingConfigs) -> RoutedResponse:
+  start_time = time.monotonic()
+
+  try:
+    response = create_completion(model, messages, configs)
+  except fallback_errors as error:
+    model_stats.record_error(model, error)
+    raise
+
+  latency_ms = int((time.monotonic() - start_time) * 1000)
+  model_stats.record_success(model, latency_ms)
+  return RoutedResponse(response, model, latency_ms)
+
+
+def route_chat_completion(messages: List[dict], configs: ModelRoutingConfigs,
+                          pinned_model: Optional[str] = None) -> RoutedResponse:
+  candidates = get_candidate_models(messages, configs, pinned_model)
+  last_error = None
+
+  for model in candidates:
+    try:
+      return request_model_completion(model, messages, configs)
+    except fallback_errors as error:
+      last_error = error
+
+  raise last_error
+
+
+def stream_model_completion(model: str, messages: List[dict], configs: ModelRoutingConfigs) -> Iterator[dict]:
+  start_time = time.monotonic()
+
+  # The request is sent before the first chunk is read, so request errors are raised here and can fall back.
+  try:
+    chunks = create_completion(model, messages, configs, stream=True)
+  except fallback_errors as error:
+    model_stats.record_error(model, error)
+    raise
+
+  return record_stream_latency(model, chunks, start_time)
+
+
+def record_stream_latency(model: str, chunks: Iterator[dict], start_time: float) -> Iterator[dict]:
+  # The latency of a stream is the time to its first chunk, so long answers do not make a model look slow.
+  is_recorded = False
+
+  for chunk in chunks:
+    if not is_recorded:
+      is_recorded = True
+      model_stats.record_success(model, int((time.monotonic() - start_time) * 1000))
+    yield chunk
+
+  if not is_recorded:
+    model_stats.record_success(model, int((time.monotonic() - start_time) * 1000))
+
+
+def route_chat_completion_stream(messages: List[dict], configs: ModelRoutingConfigs,
+                                 pinned_model: Optional[str] = None) -> RoutedStream:
+  candidates = get_candidate_models(messages, configs, pinned_model)
+  last_error = None
+
+  for model in candidates:
+    try:
+      return RoutedStream(stream_model_completion(model, messages, configs), model)
+    except fallback_errors as error:
+      last_error = error
+
+  raise last_error
+
+
+async def aroute_chat_completion(messages: List[dict], configs: ModelRoutingConfigs,
+                                 pinned_model: Optional[str] = None, **kwargs) -> RoutedResponse:
+  candidates = get_candidate_models(messages, configs, pinned_model)
+  last_error = None
+
+  for model in candidates:
+    start_time = time.monotonic()
+    try:
+      response = await acreate_completion(model, messages, configs, **kwargs)
+    except fallback_errors as error:
+      model_stats.record_error(model, error)
+      last_error = error
+      continue
+
+    latency_ms = int((time.monotonic() - start_time) * 1000)
+    model_stats.record_success(model, latency_ms)
+    return RoutedResponse(response, model, latency_ms)
+
+  raise last_error
@@ -0,0 +1,264 @@
+import json
+import os
+import random
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, asdict, field
+from enum import Enum
+from typing import Optional, List, Callable
+
+from rubberduck_chat.chat_gpt.model_router import ModelRoutingConfigs, route_chat_completion, fallback_errors
+from rubberduck_chat.chat_gpt.session_store import GptChatTurn, get_gpt_namespace_filepath, get_gpt_session_filepath, \
+  store_chat_turn_to_file
+from rubberduck_chat.chat_gpt.usage_stats import record_turn_usage
+from rubberduck_chat.utils import get_datetime
+
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
+
+outbox_dir_name = 'outbox'
+outbox_entry_extension = '.json'
+outbox_lock_extension = '.lock'
+base_retry_delay_in_seconds = 5
+max_retry_delay_in_seconds = 3600
+
+
+class OutboxSendStatus(Enum):
+  SENT = 'sent'
+  FAILED = 'failed'
+  REJECTED = 'rejected'
+  DROPPED = 'dropped'
+  SKIPPED = 'skipped'
+
+
+@dataclass
+class OutboxEntry:
+  session_id: str
+  turn_id: str
+  created_time: int
+  user_prompt: str
+  messages: List[dict]
+  pinned_model: Optional[str] = None
+  attempts: int = 0
+  next_attempt_time: int = 0
+  last_error: Optional[str] = None
+  is_rejected: bool = False
+
+  @classmethod
+  def from_json_string(cls, json_string: str):
+    return cls(**json.loads(json_string))
+
+  def to_json_string(self) -> str:
+    return json.dumps(asdict(self))
+
+  def is_due(self, now: float) -> bool:
+    return not self.is_rejected and self.next_attempt_time <= now
+
+
+@dataclass
+class OutboxDrainResult:
+  sent_count: int = 0
+  failed_count: int = 0
+  rejected_count: int = 0
+  dropped_count: int = 0
+  remaining_count: int = 0
+  elapsed_seconds: float = 0.0
+  errors: List[str] = field(default_factory=list)
+
+  def get_throughput(self) -> float:
+    return self.sent_count / self.elapsed_seconds if self.elapsed_seconds > 0 else 0.0
+
+
+def get_outbox_dir_path() -> str:
+  return get_gpt_namespace_filepath(outbox_dir_name)
+
+
+def get_outbox_entry_filepath(turn_id: str) -> str:
+  return os.path.join(get_outbox_dir_path(), f'{turn_id}{outbox_entry_extension}')
+
+
+def get_outbox_lock_filepath(turn_id: str) -> str:
+  return os.path.join(get_outbox_dir_path(), f'{turn_id}{outbox_lock_extension}')
+
+
+def get_retry_delay(attempts: int) -> float:
+  delay = min(base_retry_delay_in_seconds * 2 ** max(attempts - 1, 0), max_retry_delay_in_seconds)
+  return delay * random.uniform(0.8, 1.2)
+
+
+def save_outbox_entry(entry: OutboxEntry):
+  # Entries are replaced atomically, so a crash never leaves a partially written entry behind.
+  os.makedirs(get_outbox_dir_path(), exist_ok=True)
+  file_descriptor, temp_filepath = tempfile.mkstemp(dir=get_outbox_dir_path(), prefix=entry.turn_id)
+
+  with os.fdopen(file_descriptor, 'w', encoding='utf-8') as file:
+    file.write(entry.to_json_string())
+    file.flush()
+    os.fsync(file.fileno())
+
+  os.replace(temp_filepath, get_outbox_entry_filepath(entry.turn_id))
+
+
+def add_to_outbox(session_id: str, turn: GptChatTurn, messages: List[dict], pinned_model: Optional[str],
+                  error: Exception):
+  entry = OutboxEntry(session_id, turn.id, turn.created_time, turn.user_prompt, messages, pinned_model,
+                      attempts=1, next_attempt_time=int(time.time() + get_retry_delay(1)), last_error=str(error))
+  save_outbox_entry(entry)
+
+
+def get_outbox_entries() -> List[OutboxEntry]:
+  entries: List[OutboxEntry] = []
+
+  try:
+    with os.scandir(get_outbox_dir_path()) as dir_entries:
+      for dir_entry in dir_entries:
+        if not dir_entry.name.endswith(outbox_entry_extension):
+          continue
+
+        try:
+          with open(dir_entry.path, 'r', encoding='utf-8') as file:
+            entries.append(OutboxEntry.from_json_string(file.read()))
+        except (OSError, ValueError, TypeError):
+          continue
+  except FileNotFoundError:
+    pass
+
+  entries.sort(key=lambda entry: entry.created_time)
+  return entries
+
+
+def has_due_outbox_entries() -> bool:
+  now = time.time()
+  return any(entry.is_due(now) for entry in get_outbox_entries())
+
+
+def drain_outbox(configs: ModelRoutingConfigs, max_workers: int, due_only: bool = True,
+                 on_sent: Optional[Callable[[str, GptChatTurn], None]] = None) -> OutboxDrainResult:
+  start_time = time.monotonic()
+  now = time.time()
+  entries = [entry for entry in get_outbox_entries() if not entry.is_rejected and (not due_only or entry.is_due(now))]
+  result = OutboxDrainResult()
+
+  with ThreadPoolExecutor(max_workers=max(max_workers, 1)) as executor:
+    for entry, status in zip(entries, executor.map(lambda entry: send_outbox_entry(entry, configs, on_sent), entries)):
+      if status == OutboxSendStatus.SENT:
+        result.sent_count += 1
+      elif status == OutboxSendStatus.DROPPED:
+        result.dropped_count += 1
+      elif status == OutboxSendStatus.FAILED:
+        result.failed_count += 1
+        result.errors.append(f'{entry.user_prompt[:40]}: {entry.last_error}')
+      elif status == OutboxSendStatus.REJECTED:
+        result.rejected_count += 1
+        result.errors.append(f'{entry.user_prompt[:40]}: {entry.last_error} (will not be retried)')
+
+  result.remaining_count = len(get_outbox_entries())
+  result.elapsed_seconds = time.monotonic() - start_time
+  return result
+
+
+def send_outbox_entry(entry: OutboxEntry, configs: ModelRoutingConfigs,
+                      on_sent: Optional[Callable[[str, GptChatTurn], None]]) -> OutboxSendStatus:
+  filepath = get_outbox_entry_filepath(entry.turn_id)
+  lock_filepath = get_outbox_lock_filepath(entry.turn_id)
+
+  try:
+    lock_file = open(lock_filepath, 'a')
+  except FileNotFoundError:
+    return OutboxSendStatus.SKIPPED
+
+  with lock_file:
+    # Another process may be draining at the same time, an entry is only sent by the process holding its lock.
+    # The entry file is replaced on every retry, so the lock is taken on a separate file that is never replaced.
+    if fcntl:
+      try:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+      except OSError:
+        return OutboxSendStatus.SKIPPED
+
+    # The lock file is removed once its entry is sent, a lock taken on a removed lock file is not held by anyone else.
+    if not is_same_file(lock_file, lock_filepath) or not os.path.exists(filepath):
+      return OutboxSendStatus.SKIPPED
+
+    # The session was removed while the prompt was waiting, there is no turn left to update.
+    if not os.path.exists(get_gpt_session_filepath(entry.session_id)):
+      remove_outbox_entry(entry.turn_id)
+      return OutboxSendStatus.DROPPED
+
+    try:
+      routed_response = route_chat_completion(entry.messages, configs, entry.pinned_model)
+    except fallback_errors as error:
+      entry.attempts += 1
+      entry.next_attempt_time = int(time.time() + get_retry_delay(entry.attempts))
+      entry.last_error = str(error)
+      save_outbox_entry(entry)
+      return OutboxSendStatus.FAILED
+    except Exception as error:
+      # Errors that are not transient, like a prompt over the context limit or an invalid key, fail the same way
+      # every time. The entry is kept to be reported, but never sent again.
+      entry.attempts += 1
+      entry.last_error = str(error)
+      entry.is_rejected = True
+      save_outbox_entry(entry)
+      return OutboxSendStatus.REJECTED
+
+    # The updated turn is appended with the same id, the last record of a turn replaces the earlier ones.
+    turn = GptChatTurn(entry.turn_id, entry.created_time, entry.user_prompt, routed_response.response,
+                       routed_response.model)
+    store_chat_turn_to_file(entry.session_id, turn)
+    record_turn_usage(entry.session_id, turn, routed_response.latency_ms)
+    remove_outbox_entry(entry.turn_id)
+
+  if on_sent:
+    on_sent(entry.session_id, turn)
+
+  return OutboxSendStatus.SENT
+
+
+def is_same_file(file, filepath: str) -> bool:
+  try:
+    return os.path.samestat(os.fstat(file.fileno()), os.stat(filepath))
+  except FileNotFoundError:
+    return False
+
+
+def remove_outbox_entry(turn_id: str):
+  # The entry is removed before its lock file, while the lock is still held.
+  os.remove(get_outbox_entry_filepath(turn_id))
+
+  try:
+    os.remove(get_outbox_lock_filepath(turn_id))
+  except FileNotFoundError:
+    pass
+
+
+def print_outbox_status(entries: List[OutboxEntry]):
+  if not entries:
+    print('Outbox is empty')
+    return
+
+  now = time.time()
+  due_count = sum(1 for entry in entries if entry.is_due(now))
+  rejected_count = sum(1 for entry in entries if entry.is_rejected)
+
+  for entry in entries:
+    if entry.is_rejected:
+      retry = 'never'
+    else:
+      retry = 'now' if entry.is_due(now) else get_datetime(entry.next_attempt_time)
+    print(f'[{get_datetime(entry.created_time)}] {entry.user_prompt[:60]} '
+          f'(attempts: {entry.attempts}, retry: {retry}, error: {entry.last_error})')
+
+  print(f'{len(entries)} prompts in outbox, {due_count} due, {rejected_count} rejected')
+
+
+def print_drain_result(result: OutboxDrainResult):
+  for error in result.errors:
+    print(error)
+
+  print(f'Sent {result.sent_count} prompts in {result.elapsed_seconds:.1f}s ({result.get_throughput():.2f}/s), '
+        f'{result.failed_count} failed, {result.rejected_count} rejected, {result.dropped_count} dropped, '
+        f'{result.remaining_count} remaining')
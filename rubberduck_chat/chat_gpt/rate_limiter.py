@@ -0,0 +1,229 @@
+import asyncio
+import contextvars
+import json
+import re
+import threading
+import time
+from typing import Optional, Callable, Mapping
+
+import openai
+
+from rubberduck_chat.chat_gpt.session_store import get_gpt_dir_filepath
+
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
+
+rate_limits_filename = 'rate-limits.json'
+seconds_per_minute = 60
+default_rate_limit_block_in_seconds = 20
+max_wait_step_in_seconds = 5.0
+reset_duration_pattern = re.compile(r'(\d+(?:\.\d+)?)(ms|s|m|h)')
+reset_duration_units = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+
+# The model of the request in flight, set around every API call so response hooks know which budget to update.
+current_model = contextvars.ContextVar('current_model', default=None)
+
+
+def parse_reset_duration(value: Optional[str]) -> Optional[float]:
+  if not value:
+    return None
+
+  matches = reset_duration_pattern.findall(value)
+
+  if not matches:
+    return None
+
+  return sum(float(amount) * reset_duration_units[unit] for amount, unit in matches)
+
+
+def parse_header_int(headers: Mapping[str, str], name: str) -> Optional[int]:
+  value = headers.get(name)
+  return int(value) if value and value.isdigit() else None
+
+
+def get_effective_limit(configured_limit: int, reported_limit: Optional[int]) -> Optional[int]:
+  limits = [limit for limit in [configured_limit, reported_limit] if limit]
+  return min(limits) if limits else None
+
+
+class RateLimiter:
+
+  def __init__(self, get_filepath: Callable[[], str]):
+    self.get_filepath = get_filepath
+    self.lock = threading.Lock()
+
+  def update_state(self, update: Callable[[dict], Optional[float]]) -> Optional[float]:
+    # The budgets are shared by every rda process through a small file, updated under an exclusive lock.
+    with self.lock, open(self.get_filepath(), 'a+', encoding='utf-8') as file:
+      if fcntl:
+        fcntl.flock(file.fileno(), fcntl.LOCK_EX)
+
+      file.seek(0)
+
+      try:
+        state = json.loads(file.read() or '{}')
+      except ValueError:
+        state = {}
+
+      result = update(state)
+      file.seek(0)
+      file.truncate()
+      file.write(json.dumps(state))
+      file.flush()
+      return result
+
+  def reserve(self, model: str, tokens: int, requests_per_minute: int, tokens_per_minute: int) -> float:
+    def reserve_budget(state: dict) -> float:
+      now = time.time()
+      budget = state.setdefault(model, {})
+
+      if budget.get('blocked_until', 0) > now:
+        return budget['blocked_until'] - now
+
+      request_limit = get_effective_limit(requests_per_minute, budget.get('reported_request_limit'))
+      token_limit = get_effective_limit(tokens_per_minute, budget.get('reported_token_limit'))
+      elapsed = now - budget.get('updated_time', now)
+      budget['updated_time'] = now
+      wait = 0.0
+
+      if request_limit:
+        refilled_requests = elapsed * request_limit / seconds_per_minute
+        requests = min(request_limit, budget.get('requests', request_limit) + refilled_requests)
+        budget['requests'] = requests
+        if requests < 1:
+          wait = max(wait, (1 - requests) * seconds_per_minute / request_limit)
+
+      if token_limit:
+        required_tokens = min(tokens, token_limit)
+        refilled_tokens = elapsed * token_limit / seconds_per_minute
+        available_tokens = min(token_limit, budget.get('tokens', token_limit) + refilled_tokens)
+        budget['tokens'] = available_tokens
+        if available_tokens < required_tokens:
+          wait = max(wait, (required_tokens - available_tokens) * seconds_per_minute / token_limit)
+
+      if wait > 0:
+        return wait
+
+      if request_limit:
+        budget['requests'] -= 1
+      if token_limit:
+        budget['tokens'] -= min(tokens, token_limit)
+
+      return 0.0
+
+    try:
+      return self.update_state(reserve_budget)
+    except OSError:
+      return 0.0
+
+  def acquire(self, model: str, tokens: int, requests_per_minute: int, tokens_per_minute: int):
+    while (wait := self.reserve(model, tokens, requests_per_minute, tokens_per_minute)) > 0:
+      time.sleep(min(wait, max_wait_step_in_seconds))
+
+  async def aacquire(self, model: str, tokens: int, requests_per_minute: int, tokens_per_minute: int):
+    # The state file is locked and rewritten by blocking calls, they run in the executor to keep the loop responsive.
+    loop = asyncio.get_running_loop()
+
+    while (wait := await loop.run_in_executor(None, self.reserve, model, tokens, requests_per_minute,
+                                              tokens_per_minute)) > 0:
+      await asyncio.sleep(min(wait, max_wait_step_in_seconds))
+
+  def record_used_tokens(self, model: str, used_tokens: int, reserved_tokens: int):
+    # Only the prompt is known when a request is sent, the budget is corrected once the completion is known.
+    def update_budget(state: dict):
+      budget = state.setdefault(model, {})
+      if 'tokens' in budget:
+        budget['tokens'] -= used_tokens - reserved_tokens
+
+    try:
+      self.update_state(update_budget)
+    except OSError:
+      pass
+
+  def update_from_response(self, model: str, status: int, headers: Mapping[str, str]):
+    def update_budget(state: dict):
+      now = time.time()
+      budget = state.setdefault(model, {})
+      reported_request_limit = parse_header_int(headers, 'x-ratelimit-limit-requests')
+      reported_token_limit = parse_header_int(headers, 'x-ratelimit-limit-tokens')
+      remaining_requests = parse_header_int(headers, 'x-ratelimit-remaining-requests')
+      remaining_tokens = parse_header_int(headers, 'x-ratelimit-remaining-tokens')
+
+      if reported_request_limit:
+        budget['reported_request_limit'] = reported_request_limit
+      if reported_token_limit:
+        budget['reported_token_limit'] = reported_token_limit
+
+      # The API knows about requests from every client of the key, local budgets never exceed what it reports.
+      if remaining_requests is not None:
+        budget['requests'] = min(budget.get('requests', remaining_requests), remaining_requests)
+      if remaining_tokens is not None:
+        budget['tokens'] = min(budget.get('tokens', remaining_tokens), remaining_tokens)
+
+      if status == 429:
+        retry_after = headers.get('retry-after')
+        block_in_seconds = float(retry_after) if retry_after and retry_after.isdigit() else \
+          max(parse_reset_duration(headers.get('x-ratelimit-reset-requests')) or 0,
+              parse_reset_duration(headers.get('x-ratelimit-reset-tokens')) or 0) or \
+          default_rate_limit_block_in_seconds
+        budget['blocked_until'] = max(budget.get('blocked_until', 0), now + block_in_seconds)
+        budget['requests'] = 0
+        budget['tokens'] = 0
+
+      budget['updated_time'] = now
+
+    try:
+      self.update_state(update_budget)
+    except OSError:
+      pass
+
+
+def on_response(response, *args, **kwargs):
+  model = current_model.get()
+  if model:
+    rate_limiter.update_from_response(model, response.status_code, response.headers)
+
+
+def create_requests_session():
+  import requests
+  from openai.api_requestor import MAX_CONNECTION_RETRIES
+
+  # The session is set up like the one openai creates itself, with its proxy and connection retries.
+  session = requests.Session()
+
+  if isinstance(openai.proxy, str):
+    session.proxies = {'http': openai.proxy, 'https': openai.proxy}
+  elif isinstance(openai.proxy, dict):
+    session.proxies = openai.proxy.copy()
+
+  session.mount('https://', requests.adapters.HTTPAdapter(max_retries=MAX_CONNECTION_RETRIES))
+  session.hooks['response'].append(on_response)
+  return session
+
+
+def create_trace_config():
+  import aiohttp
+
+  async def on_request_end(session, context, params):
+    model = current_model.get()
+    if model:
+      await asyncio.get_running_loop().run_in_executor(None, rate_limiter.update_from_response, model,
+                                                       params.response.status, params.response.headers)
+
+  trace_config = aiohttp.TraceConfig()
+  trace_config.on_request_end.append(on_request_end)
+  return trace_config
+
+
+def setup_rate_limiter():
+  # The openai package creates one session per thread from this factory, every response passes through the hook.
+  openai.requestssession = create_requests_session
+
+
+def get_rate_limits_filepath() -> str:
+  return get_gpt_dir_filepath(rate_limits_filename)
+
+
+rate_limiter = RateLimiter(get_rate_limits_filepath)
@@ -0,0 +1,84 @@
+import collections
+import math
+import re
+from enum import Enum
+from typing import List, Tuple
+
+token_pattern = re.compile(r'[a-z0-9_]+')
+term_frequency_saturation = 1.5
+length_normalization = 0.75
+
+
+class ContextSelectionMode(Enum):
+  RECENT = 'recent'
+  RELEVANT = 'relevant'
+
+
+def is_valid_context_selection_mode(value: str) -> bool:
+  return value in [mode.value for mode in ContextSelectionMode]
+
+
+def tokenize(text: str) -> List[str]:
+  return [token for token in token_pattern.findall(text.lower()) if len(token) > 1]
+
+
+class Bm25Index:
+
+  def __init__(self):
+    self.term_counts: List[collections.Counter] = []
+    self.document_lengths: List[int] = []
+    self.document_frequencies: collections.Counter = collections.Counter()
+    self.total_length = 0
+
+  def add(self, text: str) -> int:
+    self.term_counts.append(collections.Counter())
+    self.document_lengths.append(0)
+    self.set_document(len(self.term_counts) - 1, text)
+    return len(self.term_counts) - 1
+
+  def set_document(self, index: int, text: str):
+    # Replacing a document only touches the terms of that document, the rest of the index is unchanged.
+    previous_term_counts = self.term_counts[index]
+    self.document_frequencies.subtract(previous_term_counts.keys())
+    self.total_length -= self.document_lengths[index]
+
+    tokens = tokenize(text)
+    term_counts = collections.Counter(tokens)
+    self.term_counts[index] = term_counts
+    self.document_lengths[index] = len(tokens)
+    self.document_frequencies.update(term_counts.keys())
+    self.total_length += len(tokens)
+
+  def search(self, query: str, limit: int, document_count: int) -> List[Tuple[int, float]]:
+    query_terms = set(tokenize(query))
+    total_documents = len(self.term_counts)
+
+    if not query_terms or not total_documents or limit <= 0:
+      return []
+
+    average_length = self.total_length / total_documents or 1
+    inverse_frequencies = {}
+
+    for term in query_terms:
+      frequency = self.document_frequencies.get(term, 0)
+      if frequency > 0:
+        inverse_frequencies[term] = math.log(1 + (total_documents - frequency + 0.5) / (frequency + 0.5))
+
+    scores: List[Tuple[int, float]] = []
+
+    for index in range(min(document_count, total_documents)):
+      term_counts = self.term_counts[index]
+      length_factor = 1 - length_normalization + length_normalization * self.document_lengths[index] / average_length
+      score = 0.0
+
+      for term, inverse_frequency in inverse_frequencies.items():
+        count = term_counts.get(term, 0)
+        if count:
+          score += inverse_frequency * count * (term_frequency_saturation + 1) / \
+                   (count + term_frequency_saturation * length_factor)
+
+      if score > 0:
+        scores.append((index, score))
+
+    scores.sort(key=lambda index_and_score: index_and_score[1], reverse=True)
+    return scores[:limit]
@@ -0,0 +1,52 @@
+import time
+from typing import List, Optional
+
+from rubberduck_chat.chat_gpt.session_store import GptRole
+
+
+class StreamAggregator:
+
+  def __init__(self):
+    self.response_id: Optional[str] = None
+    self.created_time: Optional[int] = None
+    self.model: Optional[str] = None
+    self.role: str = GptRole.ASSISTANT.value
+    self.content_parts: List[str] = []
+    self.finish_reason: Optional[str] = None
+
+  def add_chunk(self, chunk: dict) -> str:
+    self.response_id = self.response_id or chunk.get('id')
+    self.created_time = self.created_time or chunk.get('created')
+    self.model = self.model or chunk.get('model')
+    content = ''
+
+    for choice in chunk.get('choices') or []:
+      if choice.get('index', 0) != 0:
+        continue
+
+      delta = choice.get('delta') or {}
+      self.role = delta.get('role') or self.role
+      content = delta.get('content') or ''
+      self.finish_reason = choice.get('finish_reason') or self.finish_reason
+
+      if content:
+        self.content_parts.append(content)
+
+    return content
+
+  def get_content(self) -> str:
+    return ''.join(self.content_parts)
+
+  def get_response(self) -> dict:
+    # Streamed chunks are folded into the same shape as a regular completion, so stored turns look the same.
+    return {
+      'id': self.response_id,
+      'object': 'chat.completion',
+      'created': self.created_time or int(time.time()),
+      'model': self.model,
+      'choices': [{
+        'index': 0,
+        'message': {'role': self.role, 'content': self.get_content()},
+        'finish_reason': self.finish_reason,
+      }]
+    }
@@ -0,0 +1,149 @@
+import time
+from dataclasses import dataclass, field
+from typing import List, Optional, Iterable, Set
+
+from rubberduck_chat.chat_gpt.session_store import get_active_session, get_pinned_session_ids, remove_session_file, \
+  get_session_index
+from rubberduck_chat.chat_gpt.usage_stats import remove_session_usage
+from rubberduck_chat.utils import get_datetime
+
+seconds_per_day = 86400
+
+
+@dataclass
+class RetentionPolicy:
+  max_session_count: int
+  max_session_age_in_seconds: int
+  max_total_bytes: int
+  max_session_bytes: int
+
+
+@dataclass
+class SessionUsage:
+  session_id: str
+  size: int
+  last_active_time: int
+  parent_session_id: Optional[str] = None
+
+
+@dataclass
+class SessionRemoval:
+  session: SessionUsage
+  reason: str
+
+
+@dataclass
+class RetentionPlan:
+  removals: List[SessionRemoval] = field(default_factory=list)
+  kept_count: int = 0
+  kept_bytes: int = 0
+
+  def get_freed_bytes(self) -> int:
+    return sum(removal.session.size for removal in self.removals)
+
+
+def get_session_usages() -> List[SessionUsage]:
+  # The size, modified time and parent of each session come from the session index, only changed sessions are read.
+  return [SessionUsage(session_id, size, mtime_ns // 1_000_000_000, parent_session_id)
+          for session_id, (mtime_ns, size, _, _, parent_session_id) in get_session_index().items()]
+
+
+def get_protected_session_ids() -> Set[str]:
+  protected_session_ids = set(get_pinned_session_ids())
+  active_session = get_active_session()
+
+  # Do not remove the current session, even if it is old enough to be removed.
+  # This ensures that the user can continue their session.
+  if active_session:
+    protected_session_ids.add(active_session.session_id)
+
+  return protected_session_ids
+
+
+def plan_retention(sessions: Iterable[SessionUsage], policy: RetentionPolicy,
+                   protected_session_ids: Set[str], now: Optional[int] = None) -> RetentionPlan:
+  now = now if now is not None else int(time.time())
+  sessions = list(sessions)
+  plan = RetentionPlan()
+  candidates: List[SessionUsage] = []
+
+  # Protected sessions are always kept, and count against the limits before any other session.
+  for session in sessions:
+    if session.session_id in protected_session_ids:
+      plan.kept_count += 1
+      plan.kept_bytes += session.size
+    else:
+      candidates.append(session)
+
+  candidates.sort(key=lambda session: session.last_active_time, reverse=True)
+
+  for session in candidates:
+    reason = get_removal_reason(session, policy, plan, now)
+
+    if reason:
+      plan.removals.append(SessionRemoval(session, reason))
+    else:
+      plan.kept_count += 1
+      plan.kept_bytes += session.size
+
+  keep_fork_parents(sessions, plan)
+  return plan
+
+
+def keep_fork_parents(sessions: List[SessionUsage], plan: RetentionPlan):
+  # A fork reads its first turns from its parent, the parents of kept sessions are kept even over the limits.
+  sessions_by_id = {session.session_id: session for session in sessions}
+  removals_by_id = {removal.session.session_id: removal for removal in plan.removals}
+  pending_session_ids = [session_id for session_id in sessions_by_id if session_id not in removals_by_id]
+
+  while pending_session_ids:
+    session = sessions_by_id.get(pending_session_ids.pop())
+    parent_session_id = session.parent_session_id if session else None
+
+    if parent_session_id in removals_by_id:
+      removal = removals_by_id.pop(parent_session_id)
+      plan.removals.remove(removal)
+      plan.kept_count += 1
+      plan.kept_bytes += removal.session.size
+      pending_session_ids.append(parent_session_id)
+
+
+def get_removal_reason(session: SessionUsage, policy: RetentionPolicy, plan: RetentionPlan, now: int) -> Optional[str]:
+  if policy.max_session_bytes and session.size > policy.max_session_bytes:
+    return 'session size'
+  if policy.max_session_age_in_seconds and now - session.last_active_time > policy.max_session_age_in_seconds:
+    return 'age'
+  if plan.kept_count >= policy.max_session_count:
+    return 'session count'
+  if policy.max_total_bytes and plan.kept_bytes + session.size > policy.max_total_bytes:
+    return 'total size'
+  return None
+
+
+def get_retention_plan(policy: RetentionPolicy) -> RetentionPlan:
+  return plan_retention(get_session_usages(), policy, get_protected_session_ids())
+
+
+def apply_retention(policy: RetentionPolicy) -> RetentionPlan:
+  plan = get_retention_plan(policy)
+
+  # Parents of kept forks are never in the plan, a removed session never leaves a fork without its first turns.
+  for removal in plan.removals:
+    try:
+      remove_session_file(removal.session.session_id)
+    except FileNotFoundError:
+      pass
+
+  if plan.removals:
+    remove_session_usage([removal.session.session_id for removal in plan.removals])
+
+  return plan
+
+
+def print_retention_report(plan: RetentionPlan):
+  for removal in plan.removals:
+    session = removal.session
+    print(f'[{get_datetime(session.last_active_time)}] {session.session_id} {session.size} bytes ({removal.reason})')
+
+  print(f'{len(plan.removals)} sessions would be removed, freeing {plan.get_freed_bytes()} bytes')
+  print(f'{plan.kept_count} sessions would be kept, using {plan.kept_bytes} bytes')
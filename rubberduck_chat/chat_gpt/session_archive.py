@@ -0,0 +1,270 @@
+import contextlib
+import gzip
+import io
+import json
+import sys
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED, Future
+from typing import Optional, List, Iterator, IO, Tuple
+from uuid import uuid4
+
+from rubberduck_chat.chat_gpt import session_codec
+from rubberduck_chat.chat_gpt.session_layout import is_valid_session_id
+from rubberduck_chat.chat_gpt.session_records import unframe_records
+from rubberduck_chat.chat_gpt.session_schema import decode_session_records
+from rubberduck_chat.chat_gpt.session_store import GptSessionMetadata, GptSystemMessage, GptChatTurn, GptRole, \
+  iter_session_entries, store_records_to_new_session_file, get_chat_turns, migrate_session_files
+from rubberduck_chat.chat_gpt.usage_stats import add_turn_usage, merge_usage_stats, record_usage_stats
+
+default_system_message = 'You are a helpful assistant'
+chatgpt_export_member_name = 'conversations.json'
+json_array_read_size = 1 << 16
+max_import_workers = 4
+
+
+@contextlib.contextmanager
+def open_archive_for_write(output_path: str) -> Iterator[IO[str]]:
+  if output_path != '-':
+    with (gzip.open(output_path, 'wt', encoding='utf-8') if output_path.endswith('.gz')
+          else open(output_path, 'w', encoding='utf-8')) as file:
+      yield file
+    return
+
+  sys.stdout.flush()
+  file = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8', write_through=False)
+
+  # The wrapper is detached instead of closed, closing it would close stdout as well.
+  try:
+    yield file
+  finally:
+    file.flush()
+    file.detach()
+
+
+@contextlib.contextmanager
+def open_archive_for_read(input_path: str) -> Iterator[IO[bytes]]:
+  if input_path == '-':
+    yield sys.stdin.buffer
+  elif input_path.endswith('.gz'):
+    with gzip.open(input_path, 'rb') as file:
+      yield file
+  elif input_path.endswith('.zip'):
+    with zipfile.ZipFile(input_path) as archive:
+      member_name = next(name for name in archive.namelist() if name.endswith(chatgpt_export_member_name))
+      with archive.open(member_name) as file:
+        yield file
+  else:
+    with open(input_path, 'rb') as file:
+      yield file
+
+
+def export_sessions(output_path: str) -> int:
+  session_count = 0
+
+  migrate_session_files()
+
+  # Records are copied line by line without decoding them, so memory use does not depend on the history size.
+  with open_archive_for_write(output_path) as archive:
+    for entry in sorted(iter_session_entries(), key=lambda entry: entry.name):
+      session_id_json = json.dumps(entry.name)
+
+      with open(entry.path, 'r', encoding='utf-8', errors='replace') as file:
+        for record in unframe_records(file):
+          archive.write(f'{{"session_id": {session_id_json}, "record": {record}}}\n')
+
+      session_count += 1
+
+  return session_count
+
+
+def iter_json_array(file: IO[str]) -> Iterator[dict]:
+  try:
+    import ijson
+  except ImportError:
+    ijson = None
+
+  if ijson:
+    yield from ijson.items(file, 'item')
+    return
+
+  decoder = json.JSONDecoder()
+  buffer = file.read(json_array_read_size).lstrip()
+
+  if not buffer.startswith('['):
+    raise ValueError('Expected a JSON array')
+
+  position = 1
+  read_size = json_array_read_size
+
+  while True:
+    while position < len(buffer) and buffer[position] in ' \t\r\n,':
+      position += 1
+
+    if position < len(buffer) and buffer[position] == ']':
+      return
+
+    try:
+      value, position = decoder.raw_decode(buffer, position)
+      read_size = json_array_read_size
+      yield value
+    except json.JSONDecodeError:
+      # The element is incomplete, read more. The read size grows so large elements are not re-parsed too often.
+      chunk = file.read(read_size)
+      if not chunk:
+        raise
+      buffer = buffer[position:] + chunk
+      position = 0
+      read_size *= 2
+
+
+def get_chatgpt_message_text(message: dict) -> str:
+  parts = (message.get('content') or {}).get('parts') or []
+  return '\n'.join(part for part in parts if isinstance(part, str))
+
+
+def get_chatgpt_response(message: dict, content: str) -> dict:
+  return {
+    'id': message.get('id'),
+    'object': 'chat.completion',
+    'created': int(message.get('create_time') or time.time()),
+    'model': (message.get('metadata') or {}).get('model_slug'),
+    'choices': [{'index': 0, 'message': {'role': GptRole.ASSISTANT.value, 'content': content}, 'finish_reason': 'stop'}]
+  }
+
+
+def convert_chatgpt_conversation(conversation: dict) -> Optional[Tuple[str, List[str]]]:
+  mapping = conversation.get('mapping') or {}
+  node_id = conversation.get('current_node')
+  messages: List[dict] = []
+
+  # The current branch of the conversation is found by walking from the current node up to the root.
+  while node_id and node_id in mapping:
+    node = mapping[node_id]
+    if node.get('message'):
+      messages.append(node['message'])
+    node_id = node.get('parent')
+
+  messages.reverse()
+  session_id = conversation.get('id') or conversation.get('conversation_id') or str(uuid4())
+  created_time = int(conversation.get('create_time') or time.time())
+  system_content = default_system_message
+  turns: List[GptChatTurn] = []
+
+  for message in messages:
+    role = (message.get('author') or {}).get('role')
+    text = get_chatgpt_message_text(message)
+    message_time = int(message.get('create_time') or created_time)
+
+    if role == GptRole.SYSTEM.value and text:
+      system_content = text
+    elif role == GptRole.USER.value:
+      turns.append(GptChatTurn(message.get('id') or str(uuid4()), message_time, text, None))
+    elif role == GptRole.ASSISTANT.value and turns and text:
+      previous_content = turns[-1].get_assistant_response()
+      content = f'{previous_content}\n{text}' if previous_content else text
+      model = (message.get('metadata') or {}).get('model_slug')
+      turns[-1].updated_response(get_chatgpt_response(message, content), model)
+
+  if not turns:
+    return None
+
+  records = [
+    GptSessionMetadata(session_id, created_time).get_line(),
+    GptSystemMessage(str(uuid4()), created_time, system_content).get_json_string(),
+  ]
+  records.extend(turn.to_json_string() for turn in turns)
+  return session_id, records
+
+
+def iter_archive_sessions(file: IO[str]) -> Iterator[Tuple[str, List[str]]]:
+  session_id = None
+  records: List[str] = []
+
+  for line in file:
+    if not line.strip():
+      continue
+
+    entry = session_codec.loads(line)
+
+    if entry['session_id'] != session_id and records:
+      yield session_id, records
+      records = []
+
+    session_id = entry['session_id']
+    records.append(session_codec.dumps(entry['record']))
+
+  if records:
+    yield session_id, records
+
+
+def iter_chatgpt_sessions(file: IO[str]) -> Iterator[Tuple[str, List[str]]]:
+  for conversation in iter_json_array(file):
+    session = convert_chatgpt_conversation(conversation)
+    if session:
+      yield session
+
+
+def store_imported_session(session_id: str, records: List[str]) -> Optional[dict]:
+  # Ids come from the imported file, anything that is not a plain id is stored under a new one.
+  if not is_valid_session_id(session_id):
+    session_id = str(uuid4())
+
+  last_active_time = session_codec.decode_fields(records[-1], ['created_time']).get('created_time')
+
+  if not store_records_to_new_session_file(session_id, records, last_active_time):
+    return None
+
+  # The usage is returned instead of recorded, it is added to the usage stats once for the whole import.
+  session_usage: dict = {}
+
+  for turn in get_chat_turns(decode_session_records(records).turns):
+    add_turn_usage(session_usage, session_id, turn)
+
+  return session_usage
+
+
+def import_sessions(input_path: str) -> Tuple[int, int]:
+  imported_count = 0
+  skipped_count = 0
+  imported_usage: dict = {}
+
+  with open_archive_for_read(input_path) as binary_file:
+    # ChatGPT data exports are a single JSON array, rda archives are JSON lines.
+    is_chatgpt_export = binary_file.peek(64).lstrip()[:1] == b'['
+    file = io.TextIOWrapper(binary_file, encoding='utf-8')
+    sessions = iter_chatgpt_sessions(file) if is_chatgpt_export else iter_archive_sessions(file)
+    pending: set[Future] = set()
+
+    # Sessions are written in parallel, the number of sessions in flight is bounded to keep memory constant.
+    try:
+      with ThreadPoolExecutor(max_workers=max_import_workers) as executor:
+        for session_id, records in sessions:
+          pending.add(executor.submit(store_imported_session, session_id, records))
+
+          if len(pending) >= max_import_workers * 2:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+              imported_count, skipped_count = count_imported_session(future, imported_count, skipped_count,
+                                                                     imported_usage)
+
+        for future in pending:
+          imported_count, skipped_count = count_imported_session(future, imported_count, skipped_count,
+                                                                 imported_usage)
+    finally:
+      # The archive is closed by its own context, the text wrapper must not close stdin when it is collected.
+      file.detach()
+      record_usage_stats(imported_usage)
+
+  return imported_count, skipped_count
+
+
+def count_imported_session(future: Future, imported_count: int, skipped_count: int,
+                           imported_usage: dict) -> Tuple[int, int]:
+  session_usage = future.result()
+
+  if session_usage is None:
+    return imported_count, skipped_count + 1
+
+  merge_usage_stats(imported_usage, session_usage)
+  return imported_count + 1, skipped_count
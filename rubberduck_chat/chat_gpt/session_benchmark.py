@@ -0,0 +1,79 @@
+import argparse
+import time
+from typing import List, Callable
+
+from rubberduck_chat.chat_gpt.session_records import frame_record, unframe_record
+from rubberduck_chat.chat_gpt.session_schema import decode_session_records, upgrade_session_records
+from rubberduck_chat.chat_gpt.session_store import GptSessionMetadata, GptSystemMessage, GptChatTurn, get_chat_turns
+
+benchmark_parser = argparse.ArgumentParser(prog='python -m rubberduck_chat.chat_gpt.session_benchmark',
+                                           description='Benchmark decoding of session records per schema version')
+benchmark_parser.add_argument('--turns', type=int, default=200, help='Turns per session.')
+benchmark_parser.add_argument('--response-characters', type=int, default=2000, help='Characters per response.')
+benchmark_parser.add_argument('--repeat', type=int, default=20, help='Times every case is run.')
+
+
+def create_current_records(turn_count: int, response_characters: int) -> List[str]:
+  metadata = GptSessionMetadata('benchmark', int(time.time()))
+  system_message = GptSystemMessage.from_system_message('You are a helpful assistant')
+  records = [metadata.get_line(), system_message.get_json_string()]
+
+  for index in range(turn_count):
+    turn = GptChatTurn.from_user_prompt(f'Prompt {index}')
+    turn.updated_response({
+      'id': f'chatcmpl-{index}',
+      'object': 'chat.completion',
+      'model': 'gpt-3.5-turbo',
+      'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': 'x' * response_characters},
+                   'finish_reason': 'stop'}],
+      'usage': {'prompt_tokens': 100, 'completion_tokens': response_characters // 4},
+    }, 'gpt-3.5-turbo')
+    records.append(turn.to_json_string())
+
+  return records
+
+
+def create_legacy_records(records: List[str]) -> List[str]:
+  # Legacy records are the current ones without the type and version fields.
+  legacy_records: List[str] = []
+
+  for record in records:
+    record = record.replace('"type": "session", "version": 2, ', '').replace('"type":"session","version":2,', '')
+    for record_type in ['system', 'turn']:
+      record = record.replace(f'"type": "{record_type}", ', '').replace(f'"type":"{record_type}",', '')
+    legacy_records.append(record)
+
+  return legacy_records
+
+
+def measure(name: str, repeat: int, record_count: int, run: Callable[[], object]):
+  run()
+  start_time = time.perf_counter()
+
+  for _ in range(repeat):
+    run()
+
+  elapsed_seconds = (time.perf_counter() - start_time) / repeat
+  print(f'{name:<32} {elapsed_seconds * 1000:9.3f} ms {record_count / elapsed_seconds:14,.0f} records/s')
+
+
+def main():
+  args = benchmark_parser.parse_args()
+  current_records = create_current_records(args.turns, args.response_characters)
+  legacy_records = create_legacy_records(current_records)
+  framed_lines = [f'{frame_record(record)}\n' for record in current_records]
+  record_count = len(current_records)
+
+  for version, records in [('legacy', legacy_records), ('current', current_records)]:
+    measure(f'{version} group records', args.repeat, record_count, lambda: decode_session_records(records))
+    measure(f'{version} load turns', args.repeat, record_count,
+            lambda: get_chat_turns(decode_session_records(records).turns))
+    measure(f'{version} preview last turn', args.repeat, 1,
+            lambda: GptChatTurn.from_json_string_preview(records[-1]))
+
+  measure('legacy upgrade', args.repeat, record_count, lambda: upgrade_session_records(legacy_records))
+  measure('checksum verification', args.repeat, record_count, lambda: [unframe_record(line) for line in framed_lines])
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,72 @@
+import json
+import re
+from json.decoder import scanstring
+from typing import Iterable
+
+try:
+  import orjson
+except ImportError:
+  orjson = None
+
+whitespace_pattern = re.compile(r'[ \t\n\r]*')
+json_decoder = json.JSONDecoder()
+
+
+def loads(line: str) -> dict:
+  if orjson:
+    return orjson.loads(line)
+  return json.loads(line)
+
+
+def dumps(data: dict) -> str:
+  if orjson:
+    try:
+      return orjson.dumps(data).decode('utf-8')
+    except TypeError:
+      pass
+  return json.dumps(data)
+
+
+def skip_whitespace(line: str, index: int) -> int:
+  return whitespace_pattern.match(line, index).end()
+
+
+def decode_fields(line: str, field_names: Iterable[str]) -> dict:
+  # Records are written with their small fields first, decoding stops as soon as the requested fields are found,
+  # so large trailing fields like the raw API response are never parsed.
+  remaining_field_names = set(field_names)
+  fields = {}
+  index = skip_whitespace(line, 0)
+
+  if line[index:index + 1] != '{':
+    raise ValueError('Expected a JSON object')
+
+  index += 1
+
+  while remaining_field_names:
+    index = skip_whitespace(line, index)
+
+    if line[index:index + 1] == '}':
+      break
+
+    if line[index:index + 1] != '"':
+      raise ValueError(f'Expected a field name at {index}')
+
+    name, index = scanstring(line, index + 1)
+    index = skip_whitespace(line, index)
+
+    if line[index:index + 1] != ':':
+      raise ValueError(f'Expected ":" at {index}')
+
+    value, index = json_decoder.raw_decode(line, skip_whitespace(line, index + 1))
+
+    if name in remaining_field_names:
+      fields[name] = value
+      remaining_field_names.discard(name)
+
+    index = skip_whitespace(line, index)
+
+    if line[index:index + 1] == ',':
+      index += 1
+
+  return fields
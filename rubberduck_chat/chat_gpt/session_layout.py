@@ -0,0 +1,131 @@
+import hashlib
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Iterator
+
+shard_name_length = 2
+max_shard_scan_workers = 8
+session_id_pattern = re.compile(r'[A-Za-z0-9_-]{1,128}')
+
+
+def is_valid_session_id(session_id) -> bool:
+  # Session ids are used as file names, so only ids that cannot point outside of their shard are accepted.
+  return isinstance(session_id, str) and session_id_pattern.fullmatch(session_id) is not None
+
+
+def get_session_shard(session_id: str) -> str:
+  # Session ids are hashed, so imported and legacy ids are spread as evenly as generated ones.
+  return hashlib.sha1(session_id.encode('utf-8')).hexdigest()[:shard_name_length]
+
+
+def get_sharded_session_filepath(session_dir_path: str, session_id: str) -> str:
+  return os.path.join(session_dir_path, get_session_shard(session_id), session_id)
+
+
+def is_session_entry(entry: os.DirEntry) -> bool:
+  # Names starting with a dot are temporary files of rewrites in progress.
+  return not entry.name.startswith('.') and entry.is_file()
+
+
+def is_shard_entry(entry: os.DirEntry) -> bool:
+  return len(entry.name) == shard_name_length and not entry.name.startswith('.') and entry.is_dir()
+
+
+def prefetch_entry_stats(session_entries: List[os.DirEntry]) -> List[os.DirEntry]:
+  # The stat is cached by the entry, so it is fetched by the scanning thread instead of the caller.
+  stated_entries: List[os.DirEntry] = []
+
+  for entry in session_entries:
+    try:
+      entry.stat()
+      stated_entries.append(entry)
+    except FileNotFoundError:
+      continue
+
+  return stated_entries
+
+
+def scan_session_dir(dir_path: str, prefetch_stat: bool) -> List[os.DirEntry]:
+  try:
+    with os.scandir(dir_path) as entries:
+      session_entries = [entry for entry in entries if is_session_entry(entry)]
+  except FileNotFoundError:
+    return []
+
+  return prefetch_entry_stats(session_entries) if prefetch_stat else session_entries
+
+
+def iter_flat_session_entries(session_dir_path: str) -> Iterator[os.DirEntry]:
+  try:
+    with os.scandir(session_dir_path) as entries:
+      for entry in entries:
+        if is_session_entry(entry):
+          yield entry
+  except FileNotFoundError:
+    return
+
+
+def iter_session_dir_entries(session_dir_path: str, max_workers: int = 1,
+                             prefetch_stat: bool = False) -> Iterator[os.DirEntry]:
+  # Entries are yielded shard by shard, a caller that stops early leaves the remaining shards unscanned.
+  try:
+    with os.scandir(session_dir_path) as entries:
+      root_entries = list(entries)
+  except FileNotFoundError:
+    return
+
+  shard_paths = sorted(entry.path for entry in root_entries if is_shard_entry(entry))
+  flat_entries = [entry for entry in root_entries if is_session_entry(entry)]
+
+  if prefetch_stat:
+    flat_entries = prefetch_entry_stats(flat_entries)
+
+  # Sessions not moved into their shard yet are listed as well, a session moved while listing is only listed once.
+  flat_session_ids = {entry.name for entry in flat_entries}
+
+  yield from flat_entries
+
+  if max_workers <= 1 or len(shard_paths) <= 1:
+    shard_entry_lists = (scan_session_dir(shard_path, prefetch_stat) for shard_path in shard_paths)
+    for shard_entries in shard_entry_lists:
+      yield from (entry for entry in shard_entries if entry.name not in flat_session_ids)
+    return
+
+  executor = ThreadPoolExecutor(max_workers=max_workers)
+  futures = [executor.submit(scan_session_dir, shard_path, prefetch_stat) for shard_path in shard_paths]
+
+  try:
+    for future in futures:
+      yield from (entry for entry in future.result() if entry.name not in flat_session_ids)
+  finally:
+    for future in futures:
+      future.cancel()
+
+    executor.shutdown(wait=True)
+
+
+def has_flat_session_files(session_dir_path: str) -> bool:
+  return next(iter_flat_session_entries(session_dir_path), None) is not None
+
+
+def move_flat_session_file(session_dir_path: str, session_id: str) -> bool:
+  flat_filepath = os.path.join(session_dir_path, session_id)
+  filepath = get_sharded_session_filepath(session_dir_path, session_id)
+
+  if os.path.exists(filepath):
+    return False
+
+  os.makedirs(os.path.dirname(filepath), exist_ok=True)
+
+  # A rename keeps the inode, writers that have the session open keep appending to the moved file.
+  try:
+    os.rename(flat_filepath, filepath)
+    return True
+  except FileNotFoundError:
+    return False
+
+
+def migrate_flat_session_files(session_dir_path: str) -> int:
+  return sum(1 for entry in list(iter_flat_session_entries(session_dir_path))
+             if move_flat_session_file(session_dir_path, entry.name))
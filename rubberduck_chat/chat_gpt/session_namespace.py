@@ -0,0 +1,61 @@
+import hashlib
+import os
+import re
+from enum import Enum
+from typing import Optional
+
+global_namespace = 'global'
+namespace_pattern = re.compile(r'^[A-Za-z0-9_.-]+$')
+invalid_namespace_characters_pattern = re.compile(r'[^A-Za-z0-9_.-]+')
+
+
+class NamespaceMode(Enum):
+  GLOBAL = 'global'
+  CWD = 'cwd'
+  GIT = 'git'
+
+
+def is_valid_namespace_mode(value: str) -> bool:
+  return value in [mode.value for mode in NamespaceMode]
+
+
+def is_valid_namespace(value: str) -> bool:
+  return value == '' or (namespace_pattern.match(value) is not None and value not in ['.', '..'])
+
+
+def find_git_root(path: str) -> Optional[str]:
+  # Only the directories are checked, git itself is never run.
+  path = os.path.abspath(path)
+
+  while True:
+    if os.path.exists(os.path.join(path, '.git')):
+      return path
+
+    parent_path = os.path.dirname(path)
+
+    if parent_path == path:
+      return None
+
+    path = parent_path
+
+
+def get_path_namespace(path: str) -> str:
+  path = os.path.abspath(path)
+  name = invalid_namespace_characters_pattern.sub('-', os.path.basename(path)).strip('-.') or 'root'
+  path_hash = hashlib.sha1(path.encode('utf-8')).hexdigest()[:8]
+  return f'{name}-{path_hash}'
+
+
+def resolve_namespace(mode: NamespaceMode, explicit_namespace: Optional[str], cwd: str) -> str:
+  if explicit_namespace:
+    return explicit_namespace
+
+  if mode == NamespaceMode.CWD:
+    return get_path_namespace(cwd)
+
+  if mode == NamespaceMode.GIT:
+    git_root = find_git_root(cwd)
+    if git_root:
+      return get_path_namespace(git_root)
+
+  return global_namespace
@@ -0,0 +1,158 @@
+import os
+import zlib
+from dataclasses import dataclass
+from typing import Optional, List, Iterator, Tuple, BinaryIO, Iterable
+
+from rubberduck_chat.chat_gpt import session_codec
+
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
+
+checksum_separator = '\t'
+checksum_length = 8
+tail_block_size = 8192
+
+
+@dataclass
+class RecordRepair:
+  truncated_bytes: int
+  is_recoverable: bool
+
+
+def get_checksum(record: str) -> str:
+  return f'{zlib.crc32(record.encode("utf-8")):08x}'
+
+
+def frame_record(record: str) -> str:
+  # Encoded JSON never contains a raw tab, so the checksum is told apart from the record on the same line.
+  return f'{record}{checksum_separator}{get_checksum(record)}'
+
+
+def is_framed_line(line: str) -> bool:
+  separator_index = len(line.rstrip('\n')) - checksum_length - 1
+  return separator_index > 0 and line[separator_index] == checksum_separator
+
+
+def unframe_record(line: str, allow_legacy: bool = True) -> Optional[str]:
+  line = line.rstrip('\n')
+
+  if is_framed_line(line):
+    record = line[:-checksum_length - 1]
+    return record if get_checksum(record) == line[-checksum_length:] else None
+
+  # Records written before checksums were added are parsed to check they are complete, a framed record torn before
+  # its checksum is not valid JSON unless it was torn right at its end.
+  if not allow_legacy:
+    return None
+
+  try:
+    session_codec.loads(line)
+    return line
+  except ValueError:
+    return None
+
+
+def unframe_records(lines: Iterable[str]) -> Iterator[str]:
+  allow_legacy = True
+
+  # Records written before checksums were added only ever come before the first framed record of a file.
+  for line in lines:
+    record = unframe_record(line, allow_legacy)
+
+    if record is None:
+      continue
+
+    if allow_legacy and is_framed_line(line):
+      allow_legacy = False
+
+    yield record
+
+
+def read_records(filepath: str) -> List[str]:
+  with open(filepath, 'r', encoding='utf-8', errors='replace') as file:
+    return list(unframe_records(file))
+
+
+def has_legacy_records(file: BinaryIO) -> bool:
+  # A file that starts with a framed record was written after checksums were added, all its records are framed.
+  file.seek(0)
+  return not is_framed_line(file.readline().decode('utf-8', errors='replace'))
+
+
+def read_first_record(filepath: str) -> str:
+  with open(filepath, 'r', encoding='utf-8', errors='replace') as file:
+    record = unframe_record(file.readline())
+
+  if record is None:
+    raise ValueError(f'Corrupt first record in {filepath}')
+
+  return record
+
+
+def iter_records_reversed(file: BinaryIO) -> Iterator[Tuple[int, str]]:
+  # Blocks are read from the end of the file, so the last records are found without reading the rest of it.
+  # Every record is yielded with the offset right after its line.
+  allow_legacy = has_legacy_records(file)
+  position = file.seek(0, os.SEEK_END)
+  region_end = position
+  buffer = b''
+  is_tail = True
+
+  while position > 0:
+    read_size = min(tail_block_size, position)
+    position -= read_size
+    file.seek(position)
+    buffer = file.read(read_size) + buffer
+    lines = buffer.split(b'\n')
+
+    # The first line may start in the block before, it is kept until that block is read.
+    buffer = lines.pop(0) if position > 0 else b''
+
+    for line in reversed(lines):
+      line_end = region_end if is_tail else region_end + 1
+      record = unframe_record(line.decode('utf-8', errors='replace'), allow_legacy)
+      region_end -= len(line) + 1
+      is_tail = False
+
+      if record is not None:
+        yield line_end, record
+
+
+def read_last_records(filepath: str, count: int) -> List[str]:
+  records: List[str] = []
+
+  with open(filepath, 'rb') as file:
+    for _, record in iter_records_reversed(file):
+      records.append(record)
+      if len(records) >= count:
+        break
+
+  records.reverse()
+  return records
+
+
+def repair_records(filepath: str) -> RecordRepair:
+  with open(filepath, 'r+b') as file:
+    if fcntl:
+      fcntl.flock(file.fileno(), fcntl.LOCK_EX)
+
+    size = file.seek(0, os.SEEK_END)
+    valid_end = next((line_end for line_end, _ in iter_records_reversed(file)), None)
+
+    # A file without a single valid record is left as it is, there is nothing to keep.
+    if valid_end is None:
+      return RecordRepair(0, size == 0)
+
+    if valid_end < size:
+      file.truncate(valid_end)
+
+    file.seek(valid_end - 1)
+    is_terminated = file.read(1) == b'\n'
+
+    if not is_terminated:
+      file.seek(valid_end)
+      file.write(b'\n')
+
+    return RecordRepair(size - valid_end, True)
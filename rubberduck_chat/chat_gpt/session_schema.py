@@ -0,0 +1,108 @@
+from dataclasses import dataclass
+from typing import List, Callable, Dict
+
+from rubberduck_chat.chat_gpt import session_codec
+
+legacy_session_version = 1
+current_session_version = 2
+session_record_type = 'session'
+system_record_type = 'system'
+turn_record_type = 'turn'
+turn_record_prefixes = ('{"type": "turn",', '{"type":"turn",')
+
+
+@dataclass
+class SessionRecordGroups:
+  version: int
+  metadata: str
+  system_message: str
+  turns: List[str]
+
+
+def get_session_version(header: str) -> int:
+  # Sessions written before records were versioned have no version field in their first record.
+  return session_codec.decode_fields(header, ['version']).get('version', legacy_session_version)
+
+
+def get_record_type(record: str) -> str:
+  # Turns written by rda start with their type, with or without spaces depending on the JSON encoder.
+  if record.startswith(turn_record_prefixes):
+    return turn_record_type
+
+  return session_codec.decode_fields(record, ['type']).get('type', turn_record_type)
+
+
+def decode_version_1(records: List[str]) -> SessionRecordGroups:
+  if len(records) < 2:
+    raise ValueError('Session is missing its metadata or system message')
+
+  # The first record is the metadata, the second the system message, all others are turns.
+  return SessionRecordGroups(1, records[0], records[1], records[2:])
+
+
+def decode_version_2(records: List[str]) -> SessionRecordGroups:
+  system_message = None
+  turns: List[str] = []
+
+  # The type is the first field of every record, so classifying a record never decodes the rest of it.
+  for record in records[1:]:
+    record_type = get_record_type(record)
+
+    if record_type == turn_record_type:
+      turns.append(record)
+    elif record_type == system_record_type:
+      system_message = record
+
+  if system_message is None:
+    raise ValueError('Session is missing its system message')
+
+  return SessionRecordGroups(2, records[0], system_message, turns)
+
+
+def add_record_fields(record: str, fields: str) -> str:
+  # The fields are spliced in front of the existing ones, the record itself is never decoded.
+  body = record.strip()[1:]
+  return f'{{{fields}}}' if body.strip() == '}' else f'{{{fields}, {body}'
+
+
+def upgrade_version_1(records: List[str]) -> List[str]:
+  groups = decode_version_1(records)
+  return [
+    add_record_fields(groups.metadata, f'"type": "{session_record_type}", "version": 2'),
+    add_record_fields(groups.system_message, f'"type": "{system_record_type}"'),
+    *[add_record_fields(turn, f'"type": "{turn_record_type}"') for turn in groups.turns],
+  ]
+
+
+session_decoders: Dict[int, Callable[[List[str]], SessionRecordGroups]] = {
+  1: decode_version_1,
+  2: decode_version_2,
+}
+
+# Every upgrader turns the records of a version into the records of the next version.
+session_upgraders: Dict[int, Callable[[List[str]], List[str]]] = {
+  1: upgrade_version_1,
+}
+
+
+def decode_session_records(records: List[str]) -> SessionRecordGroups:
+  if not records:
+    raise ValueError('Session has no records')
+
+  version = get_session_version(records[0])
+  decoder = session_decoders.get(version)
+
+  if not decoder:
+    raise ValueError(f'Session version {version} is not supported, update rda to open it')
+
+  return decoder(records)
+
+
+def upgrade_session_records(records: List[str]) -> List[str]:
+  version = get_session_version(records[0])
+
+  while version < current_session_version:
+    records = session_upgraders[version](records)
+    version += 1
+
+  return records
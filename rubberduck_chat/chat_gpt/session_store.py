@@ -1,19 +1,40 @@
-import collections
-import json
 import os
 import shelve
+import tempfile
+import threading
 import time
 from dataclasses import dataclass
 from enum import Enum
-from typing import Optional, List
+from typing import Optional, List, Iterator, Dict, Set, Tuple
 from uuid import uuid4
 
+from rubberduck_chat.chat_gpt import session_codec
+from rubberduck_chat.chat_gpt.session_layout import get_sharded_session_filepath, iter_session_dir_entries, \
+  has_flat_session_files, move_flat_session_file, migrate_flat_session_files, max_shard_scan_workers
+from rubberduck_chat.chat_gpt.session_namespace import global_namespace
+from rubberduck_chat.chat_gpt.session_records import frame_record, unframe_records, read_records, read_first_record, \
+  read_last_records, repair_records, RecordRepair
+from rubberduck_chat.chat_gpt.session_schema import current_session_version, session_record_type, \
+  system_record_type, turn_record_type, decode_session_records, get_session_version, upgrade_session_records
+from rubberduck_chat.chat_gpt.session_writer import create_session_writer
 from rubberduck_chat.store import rubberduck_dir_name
 from rubberduck_chat.utils import get_datetime
 
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
+
 gpt_dir_name = 'gpt'
 gpt_cache_name = 'gpt-cache'
 gpt_sessions_dir_name = 'sessions'
+gpt_namespaces_dir_name = 'namespaces'
+session_preview_index_filename = 'previews.json'
+preview_turn_record_count = 8
+session_index_entry_length = 5
+current_namespace = global_namespace
+current_version_session_ids: Set[str] = set()
+migrating_session_dir_paths: Set[str] = set()
 
 
 class GptRole(Enum):
@@ -29,22 +50,34 @@ class Session:
 
 
 class GptSessionMetadata:
-  def __init__(self, session_id: str, created_time: int):
+  def __init__(self, session_id: str, created_time: int, parent_session_id: Optional[str] = None,
+               parent_turn_id: Optional[str] = None):
     self.id = session_id
     self.created_time = created_time
+    self.parent_session_id = parent_session_id
+    self.parent_turn_id = parent_turn_id
 
   @classmethod
   def from_line(cls, line: str):
-    message = json.loads(line)
+    message = session_codec.loads(line)
     session_id = message.get('id')
     created_time = message.get('created_time')
-    return cls(session_id, created_time)
+    return cls(session_id, created_time, message.get('parent_session_id'), message.get('parent_turn_id'))
 
   def get_line(self) -> str:
-    return json.dumps({
+    data = {
+      'type': session_record_type,
+      'version': current_session_version,
       'id': self.id,
       'created_time': self.created_time
-    })
+    }
+
+    # A fork starts with the turns of its parent up to the parent turn, they are read from the parent session file.
+    if self.parent_session_id:
+      data['parent_session_id'] = self.parent_session_id
+      data['parent_turn_id'] = self.parent_turn_id
+
+    return session_codec.dumps(data)
 
 
 class GptSystemMessage:
@@ -59,14 +92,15 @@ class GptSystemMessage:
 
   @classmethod
   def from_json_string(cls, line: str):
-    message = json.loads(line)
+    message = session_codec.loads(line)
     system_message_id = message.get('id')
     created_time = int(message.get('created_time'))
     content = message.get('content')
     return cls(system_message_id, created_time, content)
 
   def get_json_string(self) -> str:
-    return json.dumps({
+    return session_codec.dumps({
+      'type': system_record_type,
       'id': self.id,
       'created_time': self.created_time,
       'content': self.content
@@ -80,11 +114,14 @@ class GptSystemMessage:
 
 
 class GptChatTurn:
-  def __init__(self, turn_id: str, created_time: int, user_prompt: str, response: Optional[dict]):
+  def __init__(self, turn_id: str, created_time: int, user_prompt: str, response: Optional[dict],
+               model: Optional[str] = None, is_incomplete: bool = False):
     self.id: str = turn_id
     self.created_time: int = created_time
     self.user_prompt: str = user_prompt
     self.response: Optional[dict] = response
+    self.model: Optional[str] = model
+    self.is_incomplete: bool = is_incomplete
 
   @classmethod
   def from_user_prompt(cls, message: str):
@@ -92,36 +129,46 @@ class GptChatTurn:
 
   @classmethod
   def from_json_string(cls, json_string: str):
-    json_data = json.loads(json_string)
+    json_data = session_codec.loads(json_string)
     turn_id = json_data.get('id')
     created_time = json_data.get('created_time')
     user_prompt = json_data.get('user_prompt')
     response = json_data.get('response', None)
-    return cls(turn_id, created_time, user_prompt, response)
+    model = json_data.get('model', None)
+    is_incomplete = json_data.get('incomplete', False)
+    return cls(turn_id, created_time, user_prompt, response, model, is_incomplete)
+
+  @classmethod
+  def from_json_string_preview(cls, json_string: str):
+    json_data = session_codec.decode_fields(json_string, ['id', 'created_time', 'user_prompt'])
+    return cls(json_data.get('id'), json_data.get('created_time'), json_data.get('user_prompt'), None)
 
   def to_json_string(self) -> str:
     data = {
+      'type': turn_record_type,
       'id': self.id,
       'created_time': self.created_time,
       'user_prompt': self.user_prompt,
     }
 
+    if self.model:
+      data['model'] = self.model
+
     if self.response:
       data['response'] = self.response
 
-    return json.dumps(data)
+    if self.is_incomplete:
+      data['incomplete'] = True
+
+    return session_codec.dumps(data)
 
-  def updated_response(self, response: Optional[dict]):
+  def updated_response(self, response: Optional[dict], model: Optional[str] = None, is_incomplete: bool = False):
     self.response = response
+    self.model = model
+    self.is_incomplete = is_incomplete
 
   def get_assistant_response(self) -> Optional[str]:
-    if not self.response or 'choices' not in self.response:
-      return None
-
-    if len(self.response['choices']) > 0:
-      return self.response['choices'][0]['message']['content']
-    else:
-      return None
+    return get_response_content(self.response)
 
   def get_user_prompt_message(self) -> dict:
     return {
@@ -141,6 +188,16 @@ class GptChatTurn:
     }
 
 
+def get_response_content(response: Optional[dict]) -> Optional[str]:
+  if not response or 'choices' not in response:
+    return None
+
+  if len(response['choices']) > 0:
+    return response['choices'][0]['message']['content']
+  else:
+    return None
+
+
 @dataclass
 class GptSessionPreview:
   session_preview: str
@@ -157,83 +214,221 @@ def get_gpt_dir_filepath(filename: str) -> str:
   return os.path.join(home_dir, rubberduck_dir_name, gpt_dir_name, filename)
 
 
-def get_gpt_session_dir_path() -> str:
-  home_dir = os.path.expanduser('~')
-  return os.path.join(home_dir, rubberduck_dir_name, gpt_dir_name, gpt_sessions_dir_name)
+def set_session_namespace(namespace: str):
+  global current_namespace
+  current_namespace = namespace
 
 
-def get_gpt_session_filepath(filename: str) -> str:
-  home_dir = os.path.expanduser('~')
-  return os.path.join(home_dir, rubberduck_dir_name, gpt_dir_name, gpt_sessions_dir_name, filename)
+def get_session_namespace() -> str:
+  return current_namespace
+
+
+def get_session_namespaces() -> List[str]:
+  try:
+    return [global_namespace, *sorted(os.listdir(os.path.join(get_gpt_dir_path(), gpt_namespaces_dir_name)))]
+  except FileNotFoundError:
+    return [global_namespace]
+
+
+def get_gpt_namespace_dir_path(namespace: Optional[str] = None) -> str:
+  # The global namespace keeps the original layout, so existing sessions stay where they are.
+  namespace = namespace or current_namespace
+
+  if namespace == global_namespace:
+    return get_gpt_dir_path()
+
+  return os.path.join(get_gpt_dir_path(), gpt_namespaces_dir_name, namespace)
+
+
+def get_gpt_namespace_filepath(filename: str) -> str:
+  return os.path.join(get_gpt_namespace_dir_path(), filename)
+
+
+def get_gpt_session_dir_path(namespace: Optional[str] = None) -> str:
+  return os.path.join(get_gpt_namespace_dir_path(namespace), gpt_sessions_dir_name)
+
+
+def get_gpt_session_filepath(session_id: str) -> str:
+  session_dir_path = get_gpt_session_dir_path()
+  filepath = get_sharded_session_filepath(session_dir_path, session_id)
+
+  # Until the flat layout of earlier versions is migrated, a session is moved into its shard as soon as it is used.
+  if session_dir_path in migrating_session_dir_paths and not os.path.exists(filepath):
+    move_flat_session_file(session_dir_path, session_id)
+
+  return filepath
+
+
+def iter_session_entries(namespace: Optional[str] = None, max_workers: int = 1,
+                         prefetch_stat: bool = False) -> Iterator[os.DirEntry]:
+  return iter_session_dir_entries(get_gpt_session_dir_path(namespace), max_workers, prefetch_stat)
+
+
+def migrate_session_files(namespace: Optional[str] = None):
+  # Listings taken after the migration only contain paths in shards, so their files cannot be moved while read.
+  migrate_flat_session_files(get_gpt_session_dir_path(namespace))
+
+
+def start_session_migration():
+  session_dir_path = get_gpt_session_dir_path()
+
+  if session_dir_path in migrating_session_dir_paths or not has_flat_session_files(session_dir_path):
+    return
+
+  def run_migration():
+    migrate_flat_session_files(session_dir_path)
+    migrating_session_dir_paths.discard(session_dir_path)
+
+  # Sessions are moved in the background, so a large flat directory never delays startup.
+  migrating_session_dir_paths.add(session_dir_path)
+  threading.Thread(target=run_migration, daemon=True).start()
+
+
+session_writer = create_session_writer(get_gpt_session_filepath)
 
 
 def create_get_gpt_session_dir():
   os.makedirs(get_gpt_session_dir_path(), exist_ok=True)
 
 
-def remove_old_sessions(max_sessions):
-  session_dir = get_gpt_session_dir_path()
-  session_files = os.listdir(session_dir)
-  session_files_and_timestamps: List[tuple[str, int]] = []
+def remove_session_file(session_id: str):
+  session_writer.close_session(session_id)
+  os.remove(get_gpt_session_filepath(session_id))
 
-  if max_sessions == 0:
-    for session_file in session_files:
-      os.remove(get_gpt_session_filepath(session_file))
-    return
 
-  for session_file in session_files:
-    session_file_path = get_gpt_session_filepath(session_file)
-    with open(session_file_path, 'r') as file_handle:
-      last_line = collections.deque(file_handle, 1)[0]
-      chat_turn = GptChatTurn.from_json_string(last_line)
-      session_files_and_timestamps.append((session_file, chat_turn.created_time))
+def get_session_metadata(session_id: str) -> GptSessionMetadata:
+  return GptSessionMetadata.from_line(read_first_record(get_gpt_session_filepath(session_id)))
 
-  session_files_and_timestamps.sort(key=lambda pair: pair[1])
-  files_to_remove = session_files_and_timestamps[max_sessions:]
-  current_session = get_active_session()
 
-  for session_file_and_timestamp in files_to_remove:
-    session_file = session_file_and_timestamp[0]
+def get_chat_turns(lines: List[str]) -> List[GptChatTurn]:
+  chat_turns: Dict[str, GptChatTurn] = {}
 
-    # Do not remove the current session, even if it is old enough to be removed.
-    # This ensures that the user can continue their session.
-    if current_session and session_file == current_session.session_id:
+  # A turn can be stored more than once, it keeps the position of its first record and the content of its last one.
+  for line in lines:
+    try:
+      turn = GptChatTurn.from_json_string(line)
+    except ValueError:
       continue
 
-    os.remove(get_gpt_session_filepath(session_file))
+    chat_turns[turn.id] = turn
+
+  return list(chat_turns.values())
+
+
+def get_session_chat_turns(session_id: str, until_turn_id: Optional[str] = None) -> List[GptChatTurn]:
+  groups = decode_session_records(fetch_session_data(session_id))
+  metadata = GptSessionMetadata.from_line(groups.metadata)
+  chat_turns = get_parent_chat_turns(metadata) + get_chat_turns(groups.turns)
+
+  if not until_turn_id:
+    return chat_turns
+
+  for index, turn in enumerate(chat_turns):
+    if turn.id == until_turn_id:
+      return chat_turns[:index + 1]
+
+  # A fork never continues from more turns than it was created from.
+  raise ValueError(f'Turn {until_turn_id} not found in session {session_id}')
+
+
+def get_parent_chat_turns(metadata: GptSessionMetadata) -> List[GptChatTurn]:
+  if not metadata.parent_session_id:
+    return []
+
+  try:
+    return get_session_chat_turns(metadata.parent_session_id, metadata.parent_turn_id)
+  except FileNotFoundError:
+    return []
+  except ValueError:
+    pass
+
+  # The turn the fork continues from was lost with a torn parent, the parent turns created before the fork are kept.
+  try:
+    return [turn for turn in get_session_chat_turns(metadata.parent_session_id)
+            if turn.created_time <= metadata.created_time]
+  except (OSError, ValueError):
+    return []
+
+
+def get_session_index() -> Dict[str, list]:
+  preview_index = read_session_preview_index()
+  updated_preview_index: Dict[str, list] = {}
+
+  # Sessions are indexed per namespace by file state, only sessions changed since the last listing are read.
+  # Every entry is [mtime_ns, size, preview created time, preview prompt, parent session id].
+  for entry in iter_session_entries(max_workers=max_shard_scan_workers, prefetch_stat=True):
+    stat = entry.stat()
+    file_state = [stat.st_mtime_ns, stat.st_size]
+    indexed_session = preview_index.get(entry.name)
+
+    if indexed_session and indexed_session[:2] == file_state and len(indexed_session) == session_index_entry_length:
+      updated_preview_index[entry.name] = indexed_session
+      continue
+
+    try:
+      chat_turn = get_most_recent_chat_turn_preview(entry.name)
+    except (OSError, ValueError):
+      chat_turn = None
+
+    try:
+      parent_session_id = get_session_metadata(entry.name).parent_session_id
+    except (OSError, ValueError):
+      parent_session_id = None
+
+    chat_turn_preview = [chat_turn.created_time, chat_turn.user_prompt] if chat_turn else [None, None]
+    updated_preview_index[entry.name] = file_state + chat_turn_preview + [parent_session_id]
+
+  if updated_preview_index != preview_index:
+    write_session_preview_index(updated_preview_index)
+
+  return updated_preview_index
 
 
 def get_all_session_previews() -> List[GptSessionPreview]:
-  filenames = os.listdir(get_gpt_session_dir_path())
   previews: List[GptSessionPreview] = []
   active_session = get_active_session()
 
-  for filename in filenames:
-    if active_session and active_session.session_id == filename:
-      maybe_preview = get_active_session_preview_from_session_file(filename)
+  for session_id, indexed_session in get_session_index().items():
+    created_time, user_prompt = indexed_session[2:4]
+
+    if created_time is None:
+      continue
+
+    if active_session and active_session.session_id == session_id:
+      preview = f'[{get_datetime(created_time)}] [Current Session] {user_prompt}'
     else:
-      maybe_preview = get_preview_for_session(filename)
+      preview = f'[{get_datetime(created_time)}] {user_prompt}'
 
-    if maybe_preview:
-      previews.append(maybe_preview)
+    previews.append(GptSessionPreview(preview, session_id))
 
   previews.sort(key=lambda preview: preview.session_preview, reverse=True)
 
   return previews
 
 
-def get_active_session_preview_from_session_file(session_id) -> Optional[GptSessionPreview]:
-  chat_turn = get_most_recent_chat_turn(session_id)
+def read_session_preview_index() -> Dict[str, list]:
+  try:
+    with open(get_gpt_namespace_filepath(session_preview_index_filename), 'r', encoding='utf-8') as file:
+      return session_codec.loads(file.read())
+  except (FileNotFoundError, ValueError):
+    return {}
 
-  if chat_turn:
-    preview = f'[{get_datetime(chat_turn.created_time)}] [Current Session] {chat_turn.user_prompt}'
-    return GptSessionPreview(preview, session_id)
-  else:
-    return None
+
+def write_session_preview_index(preview_index: Dict[str, list]):
+  filepath = get_gpt_namespace_filepath(session_preview_index_filename)
+
+  try:
+    file_descriptor, temp_filepath = tempfile.mkstemp(dir=os.path.dirname(filepath),
+                                                      prefix=session_preview_index_filename)
+    with os.fdopen(file_descriptor, 'w', encoding='utf-8') as file:
+      file.write(session_codec.dumps(preview_index))
+    os.replace(temp_filepath, filepath)
+  except OSError:
+    pass
 
 
 def get_preview_for_session(session_id: str) -> Optional[GptSessionPreview]:
-  chat_turn = get_most_recent_chat_turn(session_id)
+  chat_turn = get_most_recent_chat_turn_preview(session_id)
 
   if chat_turn:
     return GptSessionPreview(f'[{get_datetime(chat_turn.created_time)}] {chat_turn.user_prompt}', session_id)
@@ -242,43 +437,152 @@ def get_preview_for_session(session_id: str) -> Optional[GptSessionPreview]:
 
 
 def get_most_recent_chat_turn(session_id: str) -> Optional[GptChatTurn]:
-  with open(get_gpt_session_filepath(session_id), 'r') as file:
-    last_line = collections.deque(file, 1)
+  last_line = read_last_records(get_gpt_session_filepath(session_id), 1)
 
-    if last_line:
-      return GptChatTurn.from_json_string(last_line[0])
-    else:
-      return None
+  if last_line:
+    return GptChatTurn.from_json_string(last_line[0])
+  else:
+    return None
+
+
+def get_most_recent_chat_turn_preview(session_id: str) -> Optional[GptChatTurn]:
+  last_lines = read_last_records(get_gpt_session_filepath(session_id), preview_turn_record_count + 2)
+
+  # A turn sent again from the outbox or continued is appended after newer turns, the newest turn is the latest one.
+  if len(last_lines) >= 3:
+    turns = [GptChatTurn.from_json_string_preview(line) for line in reversed(last_lines[2:])]
+    return max(turns, key=lambda turn: turn.created_time)
+
+  # A fork without turns of its own is previewed with the turn it was forked from.
+  if last_lines:
+    metadata = GptSessionMetadata.from_line(last_lines[0])
+    if metadata.parent_session_id:
+      return get_chat_turn_preview(metadata.parent_session_id, metadata.parent_turn_id)
+
+  return None
+
+
+def get_chat_turn_preview(session_id: str, turn_id: str) -> Optional[GptChatTurn]:
+  try:
+    with open(get_gpt_session_filepath(session_id), 'r', encoding='utf-8', errors='replace') as file:
+      records = unframe_records(file)
+      metadata = GptSessionMetadata.from_line(next(records, ''))
+      next(records, None)
+      matching_turn = None
+
+      for record in records:
+        turn = GptChatTurn.from_json_string_preview(record)
+        if turn.id == turn_id:
+          matching_turn = turn
+  except FileNotFoundError:
+    return None
+
+  if matching_turn or not metadata.parent_session_id:
+    return matching_turn
+
+  return get_chat_turn_preview(metadata.parent_session_id, turn_id)
 
 
 def fetch_session_data(session_id: str) -> List[str]:
-  with open(get_gpt_session_filepath(session_id), 'r') as file:
-    return file.readlines()
+  # Records are returned without their checksum, torn or corrupt records left by a crash are skipped.
+  return read_records(get_gpt_session_filepath(session_id))
+
+
+def repair_session_files() -> List[Tuple[str, RecordRepair]]:
+  repairs: List[Tuple[str, RecordRepair]] = []
+
+  # Only the tail of each file is read, up to its last valid record.
+  for namespace in get_session_namespaces():
+    migrate_session_files(namespace)
+
+    for entry in list(iter_session_entries(namespace)):
+      session_writer.close_session(entry.name)
+
+      try:
+        repairs.append((entry.path, repair_records(entry.path)))
+      except FileNotFoundError:
+        continue
+
+  return repairs
 
 
 def store_metadata_to_file(session_id: str, message: GptSessionMetadata):
-  with open(get_gpt_session_filepath(session_id), 'a') as file:
-    file.write(f'{message.get_line()}\n')
+  session_writer.write(session_id, [message.get_line()])
 
 
 def store_system_message_to_file(session_id: str, message: GptSystemMessage):
-  with open(get_gpt_session_filepath(session_id), 'a') as file:
-    file.write(f'{message.get_json_string()}\n')
+  session_writer.write(session_id, [message.get_json_string()])
 
 
 def store_chat_turn_to_file(session_id: str, message: GptChatTurn):
-  with open(get_gpt_session_filepath(session_id), 'a') as file:
-    file.write(f'{message.to_json_string()}\n')
+  upgrade_session_file(session_id)
+  session_writer.write(session_id, [message.to_json_string()])
+
+
+def upgrade_session_file(session_id: str):
+  # Older sessions are read as they are and only rewritten in the current version when they are appended to.
+  if session_id in current_version_session_ids:
+    return
+
+  filepath = get_gpt_session_filepath(session_id)
+
+  try:
+    with open(filepath, 'r+b') as lock_file:
+      if fcntl:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+
+      if get_session_version(read_first_record(filepath)) < current_session_version:
+        records = read_records(filepath)
+        session_writer.close_session(session_id)
+        stat = os.stat(filepath)
+        file_descriptor, temp_filepath = tempfile.mkstemp(dir=os.path.dirname(filepath), prefix=f'.{session_id}')
+
+        with os.fdopen(file_descriptor, 'w', encoding='utf-8') as file:
+          file.write(''.join(f'{frame_record(record)}\n' for record in upgrade_session_records(records)))
+
+        os.utime(temp_filepath, (stat.st_atime, stat.st_mtime))
+        os.replace(temp_filepath, filepath)
+  except (FileNotFoundError, ValueError):
+    return
+
+  current_version_session_ids.add(session_id)
+
+
+def store_forked_session_to_file(session_id: str, metadata: GptSessionMetadata, system_message: GptSystemMessage):
+  session_writer.write(session_id, [metadata.get_line(), system_message.get_json_string()])
+
+
+def store_new_session_to_file(session_id: str, metadata: GptSessionMetadata, system_message: GptSystemMessage,
+                              turn: GptChatTurn):
+  session_writer.write(session_id, [metadata.get_line(), system_message.get_json_string(), turn.to_json_string()])
+
+
+def store_records_to_new_session_file(session_id: str, records: List[str],
+                                      last_active_time: Optional[int] = None) -> bool:
+  filepath = get_gpt_session_filepath(session_id)
+  os.makedirs(os.path.dirname(filepath), exist_ok=True)
+
+  try:
+    with open(filepath, 'x', encoding='utf-8') as file:
+      file.write(''.join(f'{frame_record(record)}\n' for record in records))
+  except FileExistsError:
+    return False
+
+  # Retention uses the file modification time as the last active time of a session.
+  if last_active_time:
+    os.utime(filepath, (last_active_time, last_active_time))
+
+  return True
 
 
 def set_active_session_id(active_session_id: str):
-  with shelve.open(get_gpt_dir_filepath(gpt_cache_name)) as shelf:
+  with shelve.open(get_gpt_namespace_filepath(gpt_cache_name)) as shelf:
     shelf['active_session_id'] = active_session_id
     shelf['active_session_last_active_time'] = int(time.time())
 
 
 def get_active_session() -> Optional[Session]:
-  with shelve.open(get_gpt_dir_filepath(gpt_cache_name)) as shelf:
+  with shelve.open(get_gpt_namespace_filepath(gpt_cache_name)) as shelf:
     if 'active_session_id' not in shelf or 'active_session_last_active_time' not in shelf:
       return None
 
@@ -289,3 +593,18 @@ def get_active_session() -> Optional[Session]:
       return Session(active_session_id, active_session_time)
     else:
       return None
+
+
+def get_pinned_session_ids() -> List[str]:
+  with shelve.open(get_gpt_namespace_filepath(gpt_cache_name)) as shelf:
+    return list(shelf.get('pinned_session_ids', []))
+
+
+def set_session_pinned(session_id: str, is_pinned: bool):
+  with shelve.open(get_gpt_namespace_filepath(gpt_cache_name)) as shelf:
+    pinned_session_ids = [pinned_id for pinned_id in shelf.get('pinned_session_ids', []) if pinned_id != session_id]
+
+    if is_pinned:
+      pinned_session_ids.append(session_id)
+
+    shelf['pinned_session_ids'] = pinned_session_ids
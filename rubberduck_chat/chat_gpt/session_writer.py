@@ -0,0 +1,174 @@
+import atexit
+import collections
+import os
+import threading
+import time
+from enum import Enum
+from typing import List, Callable
+
+from rubberduck_chat.chat_gpt.session_records import frame_record
+
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
+
+
+class SessionDurability(Enum):
+  NONE = 'none'
+  TURN = 'turn'
+  INTERVAL = 'interval'
+
+
+def is_valid_durability(value: str) -> bool:
+  return value in [durability.value for durability in SessionDurability]
+
+
+class SessionWriter:
+
+  def __init__(self, get_session_filepath: Callable[[str], str], max_open_files: int = 16):
+    self.get_session_filepath = get_session_filepath
+    self.max_open_files = max_open_files
+    self.durability = SessionDurability.NONE
+    self.fsync_interval_in_seconds = 1.0
+    self.file_descriptors: collections.OrderedDict[str, int] = collections.OrderedDict()
+    self.pending_records: dict[str, List[str]] = {}
+    self.unsynced_session_ids: set[str] = set()
+    self.lock = threading.RLock()
+    self.fsync_thread = None
+
+  def configure(self, durability: SessionDurability, fsync_interval_in_seconds: float):
+    with self.lock:
+      self.durability = durability
+      self.fsync_interval_in_seconds = max(fsync_interval_in_seconds, 0.01)
+
+      if durability == SessionDurability.INTERVAL and not self.fsync_thread:
+        self.fsync_thread = threading.Thread(target=self.run_interval_fsync, daemon=True)
+        self.fsync_thread.start()
+
+  def append(self, session_id: str, records: List[str]):
+    with self.lock:
+      self.pending_records.setdefault(session_id, []).extend(records)
+
+  def commit(self, session_id: str):
+    with self.lock:
+      records = self.pending_records.pop(session_id, None)
+
+      if not records:
+        return
+
+      file_descriptor = self.get_file_descriptor(session_id)
+      data = ''.join(f'{frame_record(record)}\n' for record in records).encode('utf-8')
+
+      # A single write to an O_APPEND descriptor keeps the group of records contiguous, the advisory lock
+      # additionally protects against interleaving with other rda processes appending to the same session.
+      if fcntl:
+        fcntl.flock(file_descriptor, fcntl.LOCK_EX)
+
+        # The file may have been replaced by a rewrite while waiting for the lock, the new file is appended to instead.
+        while os.fstat(file_descriptor).st_nlink == 0:
+          fcntl.flock(file_descriptor, fcntl.LOCK_UN)
+          file_descriptor = self.get_file_descriptor(session_id)
+          fcntl.flock(file_descriptor, fcntl.LOCK_EX)
+      try:
+        while data:
+          written = os.write(file_descriptor, data)
+          data = data[written:]
+      finally:
+        if fcntl:
+          fcntl.flock(file_descriptor, fcntl.LOCK_UN)
+
+      if self.durability == SessionDurability.TURN:
+        os.fsync(file_descriptor)
+      elif self.durability == SessionDurability.INTERVAL:
+        self.unsynced_session_ids.add(session_id)
+
+  def write(self, session_id: str, records: List[str]):
+    # Records are committed before returning, readers of the session file always see them. A commit groups the records
+    # of this call and of any other thread appending to the same session meanwhile, the syncs are what the interval
+    # durability groups across turns.
+    self.append(session_id, records)
+    self.commit(session_id)
+
+  def get_file_descriptor(self, session_id: str) -> int:
+    file_descriptor = self.file_descriptors.get(session_id)
+
+    # Another process may have removed the session file, in that case the file is recreated.
+    if file_descriptor is not None and os.fstat(file_descriptor).st_nlink == 0:
+      self.close_session(session_id)
+      file_descriptor = None
+
+    if file_descriptor is None:
+      filepath = self.get_session_filepath(session_id)
+      flags = os.O_RDWR | os.O_APPEND | os.O_CREAT | getattr(os, 'O_BINARY', 0)
+
+      # The directory of a new session is only created by its first write.
+      try:
+        file_descriptor = os.open(filepath, flags, 0o600)
+      except FileNotFoundError:
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        file_descriptor = os.open(filepath, flags, 0o600)
+
+      self.file_descriptors[session_id] = file_descriptor
+      self.terminate_last_record(file_descriptor)
+
+      while len(self.file_descriptors) > self.max_open_files:
+        self.close_session(next(iter(self.file_descriptors)))
+    else:
+      self.file_descriptors.move_to_end(session_id)
+
+    return file_descriptor
+
+  def terminate_last_record(self, file_descriptor: int):
+    # A record cut short by a crash is ended first, otherwise the next record would be appended to its line.
+    if fcntl:
+      fcntl.flock(file_descriptor, fcntl.LOCK_EX)
+    try:
+      if os.lseek(file_descriptor, 0, os.SEEK_END) > 0:
+        os.lseek(file_descriptor, -1, os.SEEK_END)
+        if os.read(file_descriptor, 1) != b'\n':
+          os.write(file_descriptor, b'\n')
+    finally:
+      if fcntl:
+        fcntl.flock(file_descriptor, fcntl.LOCK_UN)
+
+  def sync_pending(self):
+    with self.lock:
+      for session_id in self.unsynced_session_ids:
+        file_descriptor = self.file_descriptors.get(session_id)
+        if file_descriptor is not None:
+          os.fsync(file_descriptor)
+      self.unsynced_session_ids.clear()
+
+  def run_interval_fsync(self):
+    while True:
+      time.sleep(self.fsync_interval_in_seconds)
+      self.sync_pending()
+
+  def close_session(self, session_id: str):
+    with self.lock:
+      self.commit(session_id)
+      file_descriptor = self.file_descriptors.pop(session_id, None)
+
+      if file_descriptor is None:
+        return
+
+      if session_id in self.unsynced_session_ids:
+        os.fsync(file_descriptor)
+        self.unsynced_session_ids.discard(session_id)
+
+      os.close(file_descriptor)
+
+  def close(self):
+    with self.lock:
+      for session_id in list(self.pending_records.keys()):
+        self.commit(session_id)
+
+      for session_id in list(self.file_descriptors.keys()):
+        self.close_session(session_id)
+
+
+def create_session_writer(get_session_filepath: Callable[[str], str]) -> SessionWriter:
+  writer = SessionWriter(get_session_filepath)
+  atexit.register(writer.close)
+  return writer
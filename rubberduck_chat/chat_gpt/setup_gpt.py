@@ -1,24 +1,23 @@
 import os
 import time
-from typing import Optional
+from typing import Optional, List
 
 from rubberduck_chat.chat_gpt.chat import GptChat, GptChatSession, GptChatSessionConfigs
 from rubberduck_chat.chat_gpt.credentials import setup_gpt_credentials
+from rubberduck_chat.chat_gpt.rate_limiter import setup_rate_limiter
+from rubberduck_chat.chat_gpt.relevance_index import ContextSelectionMode
+from rubberduck_chat.chat_gpt.retention import RetentionPolicy, apply_retention, seconds_per_day
+from rubberduck_chat.chat_gpt.session_namespace import NamespaceMode, resolve_namespace, is_valid_namespace
 from rubberduck_chat.chat_gpt.session_store import get_gpt_dir_path, get_gpt_session_dir_path, \
-  create_get_gpt_session_dir, remove_old_sessions, get_active_session, get_preview_for_session, set_active_session_id
-from rubberduck_chat.configs import config_collection
+  create_get_gpt_session_dir, get_active_session, get_preview_for_session, set_active_session_id, session_writer, \
+  set_session_namespace, get_session_namespace, start_session_migration
+from rubberduck_chat.chat_gpt.session_writer import SessionDurability
+from rubberduck_chat.configs import config_collection, ConfigEntry, config_array_delimiter
 
 
 def setup_gpt(openai_api_key: Optional[str]) -> GptChat:
-  max_saved_session_count = config_collection.max_saved_session_count.get_int_value()
-
-  os.makedirs(get_gpt_dir_path(), exist_ok=True)
-  os.makedirs(get_gpt_session_dir_path(), exist_ok=True)
-
-  setup_gpt_credentials(openai_api_key)
+  setup_gpt_store(openai_api_key)
   chat_session_configs = get_gpt_chat_configs()
-  create_get_gpt_session_dir()
-  remove_old_sessions(max_saved_session_count)
   previous_session = restore_previous_session(chat_session_configs)
 
   if previous_session:
@@ -27,29 +26,98 @@ def setup_gpt(openai_api_key: Optional[str]) -> GptChat:
     return GptChat(get_new_session(chat_session_configs), chat_session_configs)
 
 
+def setup_gpt_store(openai_api_key: Optional[str]):
+  setup_gpt_session_store()
+  setup_gpt_credentials(openai_api_key)
+  setup_rate_limiter()
+  apply_retention(get_retention_policy())
+
+
+def get_retention_policy() -> RetentionPolicy:
+  namespace = get_session_namespace()
+
+  return RetentionPolicy(
+    max_session_count=config_collection.max_saved_session_count.get_namespace_int_value(namespace),
+    max_session_age_in_seconds=config_collection.max_session_age_in_days.get_namespace_int_value(
+      namespace) * seconds_per_day,
+    max_total_bytes=config_collection.max_total_session_bytes.get_namespace_int_value(namespace),
+    max_session_bytes=config_collection.max_session_bytes.get_namespace_int_value(namespace)
+  )
+
+
+def setup_session_namespace(explicit_namespace: Optional[str] = None, cwd: Optional[str] = None) -> str:
+  namespace = resolve_namespace(NamespaceMode(config_collection.session_namespace_mode.get_value()),
+                                explicit_namespace or config_collection.session_namespace.get_value(),
+                                cwd or os.getcwd())
+
+  # Namespaces are directory names, one passed by a subcommand or a daemon client must not point outside of them.
+  if not isinstance(namespace, str) or not is_valid_namespace(namespace):
+    raise ValueError('Namespace may only contain letters, digits, ".", "_" and "-"')
+
+  set_session_namespace(namespace)
+  os.makedirs(get_gpt_session_dir_path(), exist_ok=True)
+  start_session_migration()
+  return namespace
+
+
+def setup_gpt_session_store():
+  os.makedirs(get_gpt_dir_path(), exist_ok=True)
+  os.makedirs(get_gpt_session_dir_path(), exist_ok=True)
+
+  create_get_gpt_session_dir()
+  session_writer.configure(SessionDurability(config_collection.session_write_durability.get_value()),
+                           config_collection.session_fsync_interval_in_seconds.get_int_value())
+
+
 def get_gpt_chat_configs() -> GptChatSessionConfigs:
-  return GptChatSessionConfigs(config_collection.chat_gpt_model.get_value(),
-                               config_collection.max_messages_per_request.get_int_value(),
-                               config_collection.snippet_header_background_color.get_value(),
-                               config_collection.snippet_theme.get_value())
+  return GptChatSessionConfigs(
+    chat_gpt_model=config_collection.chat_gpt_model.get_value(),
+    fallback_models=get_config_list(config_collection.chat_gpt_fallback_models),
+    light_model=config_collection.chat_gpt_light_model.get_value().strip(),
+    light_model_max_prompt_tokens=config_collection.light_model_max_prompt_tokens.get_int_value(),
+    request_timeout_in_seconds=config_collection.chat_gpt_request_timeout_in_seconds.get_int_value(),
+    requests_per_minute=config_collection.rate_limit_requests_per_minute.get_int_value(),
+    tokens_per_minute=config_collection.rate_limit_tokens_per_minute.get_int_value(),
+    max_messages_per_request=config_collection.max_messages_per_request.get_int_value(),
+    min_messages_per_request=config_collection.min_messages_per_request.get_int_value(),
+    target_p50_latency_in_ms=config_collection.target_p50_latency_in_ms.get_int_value(),
+    target_p95_latency_in_ms=config_collection.target_p95_latency_in_ms.get_int_value(),
+    context_selection_mode=ContextSelectionMode(config_collection.context_selection_mode.get_value()),
+    relevant_turns_per_request=config_collection.relevant_turns_per_request.get_int_value(),
+    relevant_context_max_characters=config_collection.relevant_context_max_characters.get_int_value(),
+    map_reduce_chunk_tokens=max(config_collection.map_reduce_chunk_tokens.get_int_value(), 1),
+    map_reduce_max_workers=max(config_collection.map_reduce_max_workers.get_int_value(), 1),
+    outbox_max_workers=max(config_collection.outbox_max_workers.get_int_value(), 1),
+    snippet_header_background_color=config_collection.snippet_header_background_color.get_value(),
+    snippet_theme=config_collection.snippet_theme.get_value()
+  )
+
+
+def get_config_list(entry: ConfigEntry) -> List[str]:
+  values = [value.strip() for value in entry.get_value().split(config_array_delimiter)]
+  return [value for value in values if value]
 
 
 def restore_previous_session(configs: GptChatSessionConfigs) -> Optional[GptChatSession]:
   always_continue_last_session = config_collection.always_continue_last_session.get_bool_value()
   active_session = get_active_session()
 
-  if always_continue_last_session and active_session:
-    return GptChatSession.from_session_id(active_session.session_id, configs)
+  if not active_session:
+    return None
 
-  if active_session:
+  if not always_continue_last_session:
     old_session_cutoff_time_in_seconds = config_collection.inactive_session_cutoff_time_in_seconds.get_int_value()
     is_active_session_expired = int(
       time.time()) - old_session_cutoff_time_in_seconds > active_session.last_active_time
 
-    if not is_active_session_expired:
-      return GptChatSession.from_session_id(active_session.session_id, configs)
+    if is_active_session_expired:
+      return None
 
-  return None
+  # A session file left empty or torn by a crash is skipped, a new session is started instead.
+  try:
+    return GptChatSession.from_session_id(active_session.session_id, configs)
+  except (ValueError, OSError):
+    return None
 
 
 def get_new_session(session_configs: GptChatSessionConfigs) -> Optional[GptChatSession]:
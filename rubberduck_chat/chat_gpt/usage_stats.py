@@ -0,0 +1,230 @@
+import datetime
+import json
+import os
+import tempfile
+import threading
+import time
+from typing import Optional, List, Callable, Iterable, Tuple
+
+from rubberduck_chat.chat_gpt.model_router import characters_per_token
+from rubberduck_chat.chat_gpt.session_layout import max_shard_scan_workers
+from rubberduck_chat.chat_gpt.session_records import read_records
+from rubberduck_chat.chat_gpt.session_schema import decode_session_records
+from rubberduck_chat.chat_gpt.session_store import GptChatTurn, get_gpt_dir_filepath, iter_session_entries, \
+  get_chat_turns, get_session_namespaces, migrate_session_files
+
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
+
+usage_stats_filename = 'usage.json'
+usage_stats_lock_filename = 'usage.lock'
+default_report_days = 7
+
+# Dollars per 1000 prompt and completion tokens, matched by the longest model name prefix.
+model_prices = {
+  'gpt-3.5-turbo': (0.0015, 0.002),
+  'gpt-3.5-turbo-16k': (0.003, 0.004),
+  'gpt-4': (0.03, 0.06),
+  'gpt-4-32k': (0.06, 0.12),
+}
+
+usage_stats_lock = threading.Lock()
+
+
+def get_usage_stats_filepath() -> str:
+  return get_gpt_dir_filepath(usage_stats_filename)
+
+
+def get_model_price(model: str) -> Tuple[float, float]:
+  matching_models = [name for name in model_prices if model.startswith(name)]
+  return model_prices[max(matching_models, key=len)] if matching_models else (0.0, 0.0)
+
+
+def get_turn_usage(turn: GptChatTurn) -> Optional[Tuple[str, str, dict]]:
+  if not turn.response:
+    return None
+
+  model = turn.model or turn.response.get('model') or 'unknown'
+  usage = turn.response.get('usage')
+
+  # Streamed responses carry no usage, the completion tokens are estimated from the content.
+  if usage:
+    prompt_tokens = usage.get('prompt_tokens', 0)
+    completion_tokens = usage.get('completion_tokens', 0)
+  else:
+    prompt_tokens = 0
+    completion_tokens = len(turn.get_assistant_response() or '') // characters_per_token
+
+  prompt_price, completion_price = get_model_price(model)
+  created_time = turn.response.get('created') or turn.created_time
+  day = datetime.date.fromtimestamp(created_time).isoformat()
+
+  return day, model, {
+    'requests': 1,
+    'prompt_tokens': prompt_tokens,
+    'completion_tokens': completion_tokens,
+    'cost': (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1000,
+  }
+
+
+def add_usage(totals: dict, usage: dict):
+  for key, value in usage.items():
+    totals[key] = totals.get(key, 0) + value
+
+
+def merge_usage_stats(totals: dict, stats: dict):
+  for key, value in stats.items():
+    if isinstance(value, dict):
+      merge_usage_stats(totals.setdefault(key, {}), value)
+    else:
+      totals[key] = totals.get(key, 0) + value
+
+
+def add_turn_usage(stats: dict, session_id: str, turn: GptChatTurn, latency_ms: Optional[int] = None):
+  turn_usage = get_turn_usage(turn)
+
+  if not turn_usage:
+    return
+
+  day, model, usage = turn_usage
+
+  if latency_ms is not None:
+    usage = {**usage, 'latency_ms': latency_ms, 'timed_requests': 1}
+
+  add_usage(stats.setdefault('days', {}).setdefault(day, {}).setdefault(model, {}), usage)
+  add_usage(stats.setdefault('sessions', {}).setdefault(session_id, {}), usage)
+
+
+def update_usage_stats(update: Callable[[dict], None]):
+  filepath = get_usage_stats_filepath()
+
+  # Every rda process adds to the same file. It is replaced atomically, so a separate lock file is locked and a crash
+  # never leaves a partially written file behind.
+  with usage_stats_lock, open(get_gpt_dir_filepath(usage_stats_lock_filename), 'a') as lock_file:
+    if fcntl:
+      fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+
+    try:
+      with open(filepath, 'r', encoding='utf-8') as file:
+        stats = json.load(file)
+    except (FileNotFoundError, ValueError):
+      stats = {}
+
+    update(stats)
+    file_descriptor, temp_filepath = tempfile.mkstemp(dir=os.path.dirname(filepath), prefix=usage_stats_filename)
+
+    with os.fdopen(file_descriptor, 'w', encoding='utf-8') as file:
+      file.write(json.dumps(stats, separators=(',', ':')))
+
+    os.replace(temp_filepath, filepath)
+
+
+def record_turn_usage(session_id: str, turn: GptChatTurn, latency_ms: Optional[int] = None):
+  try:
+    update_usage_stats(lambda stats: add_turn_usage(stats, session_id, turn, latency_ms))
+  except OSError:
+    pass
+
+
+def record_session_usage(session_id: str, turns: Iterable[GptChatTurn]):
+  def add_session_usage(stats: dict):
+    for turn in turns:
+      add_turn_usage(stats, session_id, turn)
+
+  try:
+    update_usage_stats(add_session_usage)
+  except OSError:
+    pass
+
+
+def record_usage_stats(usage_stats: dict):
+  if not usage_stats:
+    return
+
+  try:
+    update_usage_stats(lambda stats: merge_usage_stats(stats, usage_stats))
+  except OSError:
+    pass
+
+
+def remove_session_usage(session_ids: List[str]):
+  def remove_sessions(stats: dict):
+    for session_id in session_ids:
+      stats.get('sessions', {}).pop(session_id, None)
+
+  try:
+    update_usage_stats(remove_sessions)
+  except OSError:
+    pass
+
+
+def rebuild_usage_stats() -> int:
+  rebuilt_stats: dict = {}
+  session_count = 0
+
+  # Usage is shared by every namespace. Only the turns stored in each file are counted, forks do not count the turns
+  # they share with their parent.
+  for namespace in get_session_namespaces():
+    migrate_session_files(namespace)
+
+    for entry in iter_session_entries(namespace, max_workers=max_shard_scan_workers):
+      try:
+        groups = decode_session_records(read_records(entry.path))
+      except (OSError, ValueError):
+        continue
+
+      for turn in get_chat_turns(groups.turns):
+        add_turn_usage(rebuilt_stats, entry.name, turn)
+
+      session_count += 1
+
+  def replace_stats(stats: dict):
+    stats.clear()
+    stats.update(rebuilt_stats)
+
+  update_usage_stats(replace_stats)
+  return session_count
+
+
+def get_usage_stats() -> dict:
+  try:
+    with open(get_usage_stats_filepath(), 'r', encoding='utf-8') as file:
+      return json.load(file)
+  except (FileNotFoundError, ValueError):
+    return {}
+
+
+def format_usage(usage: dict) -> str:
+  tokens = usage.get('prompt_tokens', 0) + usage.get('completion_tokens', 0)
+  text = f'{usage.get("requests", 0)} requests, {tokens} tokens, ${usage.get("cost", 0):.4f}'
+
+  if usage.get('timed_requests'):
+    text += f', {usage["latency_ms"] // usage["timed_requests"]} ms average'
+
+  return text
+
+
+def print_usage_report(session_id: Optional[str] = None, days: int = default_report_days):
+  stats = get_usage_stats()
+  first_day = (datetime.date.fromtimestamp(time.time()) - datetime.timedelta(days=days - 1)).isoformat()
+  period_usage: dict = {}
+  model_usages: dict[str, dict] = {}
+
+  for day, models in sorted(stats.get('days', {}).items()):
+    if day < first_day:
+      continue
+
+    for model, usage in sorted(models.items()):
+      print(f'{day} {model}: {format_usage(usage)}')
+      add_usage(period_usage, usage)
+      add_usage(model_usages.setdefault(model, {}), usage)
+
+  for model, usage in sorted(model_usages.items()):
+    print(f'Last {days} days {model}: {format_usage(usage)}')
+
+  print(f'Last {days} days: {format_usage(period_usage)}')
+
+  if session_id:
+    print(f'Current session: {format_usage(stats.get("sessions", {}).get(session_id, {}))}')
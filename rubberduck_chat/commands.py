@@ -0,0 +1,129 @@
+import importlib
+import threading
+from typing import Callable, List, Optional, Union
+
+command_plugin_entry_point_group = 'rubberduck_chat.commands'
+trie_terminal_key = ''
+
+CommandAction = Callable[[object, str], None]
+
+
+class LazyCommandAction:
+
+  def __init__(self, reference: str):
+    self.reference = reference
+    self.action: Optional[CommandAction] = None
+
+  def load(self) -> CommandAction:
+    if not self.action:
+      module_name, attribute_name = self.reference.split(':')
+      self.action = getattr(importlib.import_module(module_name), attribute_name)
+    return self.action
+
+  def __call__(self, gpt_chat, user_input: str):
+    self.load()(gpt_chat, user_input)
+
+
+class Command:
+  def __init__(self, trigger: str, action: Union[CommandAction, str], description: str):
+    self.trigger = trigger
+    self.action = LazyCommandAction(action) if isinstance(action, str) else action
+    self.description = description
+
+
+class CommandRegistry:
+
+  def __init__(self):
+    self.commands: dict[str, Command] = {}
+    self.trie: dict = {}
+    self.has_multi_word_triggers = False
+    self.plugin_discovery: Optional[threading.Thread] = None
+    self.plugin_entry_points: list = []
+    self.plugins: Optional[CommandRegistry] = None
+
+  def clear(self):
+    # Plugin commands are kept in their own registry, they are registered once and survive config reloads.
+    self.commands.clear()
+    self.trie.clear()
+    self.has_multi_word_triggers = False
+
+  def register(self, command: Command):
+    # The first registration of a trigger wins.
+    if command.trigger in self.commands:
+      return
+
+    self.commands[command.trigger] = command
+    self.has_multi_word_triggers = self.has_multi_word_triggers or ' ' in command.trigger
+    node = self.trie
+
+    for character in command.trigger:
+      node = node.setdefault(character, {})
+
+    node[trie_terminal_key] = command
+
+  def find(self, user_input: str) -> Optional[Command]:
+    command = self.find_registered(user_input)
+
+    if command:
+      return command
+
+    plugins = self.get_plugins(wait=False)
+    return plugins.find_registered(user_input) if plugins else None
+
+  def find_registered(self, user_input: str) -> Optional[Command]:
+    if not self.has_multi_word_triggers:
+      return self.commands.get(user_input.split(' ', 1)[0])
+
+    # Multi-word triggers are matched by walking the trie, the longest trigger ending on a word boundary wins.
+    node = self.trie
+    match = None
+
+    for index, character in enumerate(user_input):
+      node = node.get(character)
+      if node is None:
+        break
+      is_boundary = index + 1 == len(user_input) or user_input[index + 1] == ' '
+      if trie_terminal_key in node and is_boundary:
+        match = node[trie_terminal_key]
+
+    return match
+
+  def get_commands(self) -> List[Command]:
+    plugin_commands = self.get_plugins(wait=True).commands.values()
+
+    # Built-in triggers win over plugin triggers.
+    return list(self.commands.values()) + \
+      [command for command in plugin_commands if command.trigger not in self.commands]
+
+  def start_plugin_discovery(self):
+    if not self.plugin_discovery:
+      self.plugin_discovery = threading.Thread(target=self.discover_plugins, daemon=True)
+      self.plugin_discovery.start()
+
+  def discover_plugins(self):
+    from importlib.metadata import entry_points
+
+    try:
+      self.plugin_entry_points = list(entry_points(group=command_plugin_entry_point_group))
+    except TypeError:
+      self.plugin_entry_points = list(entry_points().get(command_plugin_entry_point_group, []))
+
+  def get_plugins(self, wait: bool) -> Optional['CommandRegistry']:
+    if self.plugins:
+      return self.plugins
+
+    # Plugin metadata is scanned on a background thread, and plugin modules are only imported on first use.
+    # Prompts are not held back while the scan is still running, it is done long before a command can be typed.
+    self.start_plugin_discovery()
+
+    if wait:
+      self.plugin_discovery.join()
+    elif self.plugin_discovery.is_alive():
+      return None
+
+    self.plugins = CommandRegistry()
+
+    for entry_point in self.plugin_entry_points:
+      self.plugins.register(Command(entry_point.name, entry_point.value, f'Plugin command from {entry_point.value}'))
+
+    return self.plugins
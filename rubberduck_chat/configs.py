@@ -2,18 +2,22 @@ import configparser
 import os
 import platform
 import re
+import tempfile
+import time
 from dataclasses import dataclass
-from typing import Optional, List
-
-import inquirer
+from types import MappingProxyType
+from typing import Optional, List, Mapping
 
+from rubberduck_chat.chat_gpt.relevance_index import ContextSelectionMode, is_valid_context_selection_mode
+from rubberduck_chat.chat_gpt.session_namespace import NamespaceMode, is_valid_namespace_mode, is_valid_namespace
+from rubberduck_chat.chat_gpt.session_writer import SessionDurability, is_valid_durability
 from rubberduck_chat.store import rubberduck_dir_name
 
 configs_filename = 'configs.ini'
 default_config_section_name = 'default'
+namespace_config_section_prefix = 'namespace:'
 config_array_delimiter = ','
-
-configs = configparser.ConfigParser()
+config_reload_check_interval_in_seconds = 1.0
 
 
 def is_valid_int(value: str) -> bool:
@@ -40,25 +44,89 @@ class ConfigEntry:
   value_varifier: Optional[callable]
 
   def get_value(self) -> str:
-    return configs[default_config_section_name][self.name]
+    return get_config_snapshot().get_value(self)
 
   def set_value(self, value):
+    if value == self.get_value():
+      return
+
+    configs = read_configs()
     configs[default_config_section_name][self.name] = value
-    with open(get_configs_path(), 'w') as configfile:
-      configs.write(configfile)
+    write_configs(configs)
 
   def get_int_value(self) -> int:
-    try:
-      value = int(self.get_value())
-      if value >= 0:
-        return value
-      else:
-        return int(self.default_value)
-    except ValueError:
-      return int(self.default_value)
+    return get_config_snapshot().get_int_value(self)
 
   def get_bool_value(self) -> bool:
-    return self.get_value().lower() == 'true'
+    return get_config_snapshot().get_bool_value(self)
+
+  def get_namespace_int_value(self, namespace: str) -> int:
+    return get_config_snapshot().get_namespace_int_value(self, namespace)
+
+
+def parse_int_value(value: str, default_value: str) -> int:
+  try:
+    value = int(value)
+    if value >= 0:
+      return value
+    else:
+      return int(default_value)
+  except ValueError:
+    return int(default_value)
+
+
+@dataclass(frozen=True)
+class ConfigSnapshot:
+  mtime_ns: Optional[int]
+  values: Mapping[str, str]
+  int_values: Mapping[str, int]
+  bool_values: Mapping[str, bool]
+  namespace_values: Mapping[str, Mapping[str, str]]
+
+  @classmethod
+  def from_configs(cls, configs: configparser.ConfigParser, mtime_ns: Optional[int]):
+    section = configs[default_config_section_name] if default_config_section_name in configs else {}
+    values: dict[str, str] = {}
+    int_values: dict[str, int] = {}
+    bool_values: dict[str, bool] = {}
+
+    for config in config_collection_list:
+      value = section.get(config.name, config.default_value)
+      # A value the config editor would reject falls back to the default, a typo in the file must not break a reload.
+      if config.value_varifier and not config.value_varifier(value):
+        value = config.default_value
+      values[config.name] = value
+      bool_values[config.name] = value.lower() == 'true'
+      if config.default_value.isdigit():
+        int_values[config.name] = parse_int_value(value, config.default_value)
+
+    # Sections named after a session namespace override the default values for that namespace only.
+    namespace_values = {
+      section_name[len(namespace_config_section_prefix):]: MappingProxyType(dict(configs[section_name]))
+      for section_name in configs.sections() if section_name.startswith(namespace_config_section_prefix)
+    }
+
+    return cls(mtime_ns, MappingProxyType(values), MappingProxyType(int_values), MappingProxyType(bool_values),
+               MappingProxyType(namespace_values))
+
+  def get_value(self, config: 'ConfigEntry') -> str:
+    return self.values.get(config.name, config.default_value)
+
+  def get_int_value(self, config: 'ConfigEntry') -> int:
+    if config.name in self.int_values:
+      return self.int_values[config.name]
+    return parse_int_value(self.get_value(config), config.default_value)
+
+  def get_bool_value(self, config: 'ConfigEntry') -> bool:
+    if config.name in self.bool_values:
+      return self.bool_values[config.name]
+    return self.get_value(config).lower() == 'true'
+
+  def get_namespace_int_value(self, config: 'ConfigEntry', namespace: str) -> int:
+    namespace_values = self.namespace_values.get(namespace, {})
+    if config.name in namespace_values:
+      return parse_int_value(namespace_values[config.name], self.get_value(config))
+    return self.get_int_value(config)
 
 
 @dataclass
@@ -69,6 +137,36 @@ class ConfigSet:
     'Maximum number of sessions saved locally',
     is_valid_int
   )
+  max_session_age_in_days = ConfigEntry(
+    'max_session_age_in_days',
+    str(0),
+    'Remove sessions inactive for more than this many days, 0 for no limit',
+    is_valid_int
+  )
+  max_total_session_bytes = ConfigEntry(
+    'max_total_session_bytes',
+    str(0),
+    'Maximum total bytes of sessions saved locally, 0 for no limit',
+    is_valid_int
+  )
+  max_session_bytes = ConfigEntry(
+    'max_session_bytes',
+    str(0),
+    'Remove sessions larger than this many bytes, 0 for no limit',
+    is_valid_int
+  )
+  session_namespace_mode = ConfigEntry(
+    'session_namespace_mode',
+    NamespaceMode.GLOBAL.value,
+    'Session namespace; [global/cwd/git], cwd keeps sessions per working directory and git per repository root',
+    is_valid_namespace_mode
+  )
+  session_namespace = ConfigEntry(
+    'session_namespace',
+    '',
+    'Namespace used for sessions instead of the namespace mode, leave empty to use the namespace mode',
+    is_valid_namespace
+  )
   always_continue_last_session = ConfigEntry(
     'always_continue_last_session',
     'false',
@@ -87,12 +185,114 @@ class ConfigSet:
     'ChatGPT model; [gpt-3.5-turbo/gpt-4]',
     None
   )
+  chat_gpt_fallback_models = ConfigEntry(
+    'chat_gpt_fallback_models',
+    '',
+    'Models tried when the ChatGPT model is rate limited or times out, separated by commas',
+    None
+  )
+  chat_gpt_light_model = ConfigEntry(
+    'chat_gpt_light_model',
+    '',
+    'Faster model used for short prompts, leave empty to always use the ChatGPT model',
+    None
+  )
+  light_model_max_prompt_tokens = ConfigEntry(
+    'light_model_max_prompt_tokens',
+    str(200),
+    'Maximum estimated prompt tokens routed to the light model',
+    is_valid_int
+  )
+  chat_gpt_request_timeout_in_seconds = ConfigEntry(
+    'chat_gpt_request_timeout_in_seconds',
+    str(120),
+    'Seconds before a ChatGPT request times out and falls back to the next model',
+    is_valid_int
+  )
+  rate_limit_requests_per_minute = ConfigEntry(
+    'rate_limit_requests_per_minute',
+    str(0),
+    'Requests per minute per model shared by all rda processes, 0 to use the limits reported by the API',
+    is_valid_int
+  )
+  rate_limit_tokens_per_minute = ConfigEntry(
+    'rate_limit_tokens_per_minute',
+    str(0),
+    'Tokens per minute per model shared by all rda processes, 0 to use the limits reported by the API',
+    is_valid_int
+  )
   max_messages_per_request = ConfigEntry(
     'max_messages_per_request',
     str(10),
     'Maximum number of previous chat user prompts used to generating new responses',
     is_valid_int
   )
+  min_messages_per_request = ConfigEntry(
+    'min_messages_per_request',
+    str(2),
+    'Fewest previous chat user prompts kept when the context is reduced to meet the latency targets',
+    is_valid_int
+  )
+  target_p50_latency_in_ms = ConfigEntry(
+    'target_p50_latency_in_ms',
+    str(0),
+    'Median response latency to keep by adjusting the previous prompts sent per request, 0 to disable',
+    is_valid_int
+  )
+  target_p95_latency_in_ms = ConfigEntry(
+    'target_p95_latency_in_ms',
+    str(0),
+    '95th percentile response latency to keep by adjusting the previous prompts sent per request, 0 to disable',
+    is_valid_int
+  )
+  context_selection_mode = ConfigEntry(
+    'context_selection_mode',
+    ContextSelectionMode.RECENT.value,
+    'Previous messages sent with a prompt; [recent/relevant], relevant also adds older turns matching the prompt',
+    is_valid_context_selection_mode
+  )
+  relevant_turns_per_request = ConfigEntry(
+    'relevant_turns_per_request',
+    str(3),
+    'Maximum number of older relevant turns added to a request when context selection mode is relevant',
+    is_valid_int
+  )
+  relevant_context_max_characters = ConfigEntry(
+    'relevant_context_max_characters',
+    str(4000),
+    'Maximum characters of older relevant turns added to a request',
+    is_valid_int
+  )
+  map_reduce_chunk_tokens = ConfigEntry(
+    'map_reduce_chunk_tokens',
+    str(2000),
+    'Estimated tokens per part when a prompt is too large for the model and is processed in parts',
+    is_valid_int
+  )
+  map_reduce_max_workers = ConfigEntry(
+    'map_reduce_max_workers',
+    str(4),
+    'Maximum number of parts of a large prompt requested at once',
+    is_valid_int
+  )
+  outbox_max_workers = ConfigEntry(
+    'outbox_max_workers',
+    str(2),
+    'Maximum number of saved prompts sent at once when the outbox is drained',
+    is_valid_int
+  )
+  session_write_durability = ConfigEntry(
+    'session_write_durability',
+    SessionDurability.INTERVAL.value,
+    'Session write durability; [none/turn/interval]',
+    is_valid_durability
+  )
+  session_fsync_interval_in_seconds = ConfigEntry(
+    'session_fsync_interval_in_seconds',
+    str(1),
+    'Seconds between session file syncs when durability is interval',
+    is_valid_int
+  )
   snippet_header_background_color = ConfigEntry(
     'snippet_header_background_color',
     '#707070',
@@ -135,6 +335,48 @@ class ConfigSet:
     'Commands to start new session',
     None
   )
+  compare_command_trigger = ConfigEntry(
+    'compare_command_trigger',
+    config_array_delimiter.join(['.compare']),
+    'Commands to send a prompt to several models at once',
+    None
+  )
+  compare_models = ConfigEntry(
+    'compare_models',
+    config_array_delimiter.join(['gpt-3.5-turbo', 'gpt-4']),
+    'Models used by the compare command, separated by commas',
+    None
+  )
+  pin_session_command_trigger = ConfigEntry(
+    'pin_session_command_trigger',
+    config_array_delimiter.join(['.pin']),
+    'Commands to pin or unpin current session so it is never removed',
+    None
+  )
+  usage_command_trigger = ConfigEntry(
+    'usage_command_trigger',
+    config_array_delimiter.join(['.usage']),
+    'Commands to print token usage and estimated cost',
+    None
+  )
+  fork_session_command_trigger = ConfigEntry(
+    'fork_session_command_trigger',
+    config_array_delimiter.join(['.fork']),
+    'Commands to continue a copy of current session from a turn',
+    None
+  )
+  outbox_command_trigger = ConfigEntry(
+    'outbox_command_trigger',
+    config_array_delimiter.join(['.outbox']),
+    'Commands to show and send prompts saved while the API was unavailable',
+    None
+  )
+  continue_command_trigger = ConfigEntry(
+    'continue_command_trigger',
+    config_array_delimiter.join(['.continue']),
+    'Commands to continue the last response after it was cancelled',
+    None
+  )
   update_key_command_trigger = ConfigEntry(
     'update_key_command_trigger',
     config_array_delimiter.join(['.key', '.k']),
@@ -158,10 +400,32 @@ class ConfigSet:
 config_collection = ConfigSet()
 config_collection_list: List[ConfigEntry] = [
   config_collection.max_saved_session_count,
+  config_collection.max_session_age_in_days,
+  config_collection.max_total_session_bytes,
+  config_collection.max_session_bytes,
+  config_collection.session_namespace_mode,
+  config_collection.session_namespace,
   config_collection.always_continue_last_session,
   config_collection.inactive_session_cutoff_time_in_seconds,
   config_collection.chat_gpt_model,
+  config_collection.chat_gpt_fallback_models,
+  config_collection.chat_gpt_light_model,
+  config_collection.light_model_max_prompt_tokens,
+  config_collection.chat_gpt_request_timeout_in_seconds,
+  config_collection.rate_limit_requests_per_minute,
+  config_collection.rate_limit_tokens_per_minute,
   config_collection.max_messages_per_request,
+  config_collection.min_messages_per_request,
+  config_collection.target_p50_latency_in_ms,
+  config_collection.target_p95_latency_in_ms,
+  config_collection.context_selection_mode,
+  config_collection.relevant_turns_per_request,
+  config_collection.relevant_context_max_characters,
+  config_collection.map_reduce_chunk_tokens,
+  config_collection.map_reduce_max_workers,
+  config_collection.outbox_max_workers,
+  config_collection.session_write_durability,
+  config_collection.session_fsync_interval_in_seconds,
   config_collection.snippet_header_background_color,
   config_collection.snippet_theme,
   config_collection.exit_command_trigger,
@@ -169,6 +433,13 @@ config_collection_list: List[ConfigEntry] = [
   config_collection.change_session_command_trigger,
   config_collection.print_session_command_trigger,
   config_collection.new_session_command_trigger,
+  config_collection.compare_command_trigger,
+  config_collection.compare_models,
+  config_collection.pin_session_command_trigger,
+  config_collection.usage_command_trigger,
+  config_collection.fork_session_command_trigger,
+  config_collection.outbox_command_trigger,
+  config_collection.continue_command_trigger,
   config_collection.update_key_command_trigger,
   config_collection.update_config_command_trigger,
   config_collection.supported_command_cli,
@@ -179,22 +450,83 @@ def get_configs_path() -> str:
   return os.path.join(os.path.expanduser('~'), rubberduck_dir_name, configs_filename)
 
 
-def setup_default_config(override_existing_configs: bool = False):
-  config_filepath = get_configs_path()
+def get_configs_mtime_ns() -> Optional[int]:
+  try:
+    return os.stat(get_configs_path()).st_mtime_ns
+  except FileNotFoundError:
+    return None
+
+
+current_config_snapshot: Optional[ConfigSnapshot] = None
+last_config_reload_check_time = 0.0
+
+
+def get_config_snapshot() -> ConfigSnapshot:
+  global current_config_snapshot, last_config_reload_check_time
+
+  # The configs file is checked at most once per interval, and only parsed again when its mtime changed.
+  now = time.monotonic()
+  if current_config_snapshot and now - last_config_reload_check_time < config_reload_check_interval_in_seconds:
+    return current_config_snapshot
+
+  last_config_reload_check_time = now
+  mtime_ns = get_configs_mtime_ns()
+
+  if not current_config_snapshot or current_config_snapshot.mtime_ns != mtime_ns:
+    current_config_snapshot = ConfigSnapshot.from_configs(read_configs(), mtime_ns)
+
+  return current_config_snapshot
+
+
+def reload_config_snapshot() -> ConfigSnapshot:
+  global current_config_snapshot
+
+  current_config_snapshot = ConfigSnapshot.from_configs(read_configs(), get_configs_mtime_ns())
+  return current_config_snapshot
+
+
+def read_configs() -> configparser.ConfigParser:
+  configs = configparser.ConfigParser()
   configs.read(get_configs_path())
 
   if default_config_section_name not in configs:
     configs.add_section(default_config_section_name)
 
+  return configs
+
+
+def write_configs(configs: configparser.ConfigParser):
+  config_filepath = get_configs_path()
+  file_descriptor, temp_filepath = tempfile.mkstemp(dir=os.path.dirname(config_filepath), prefix=configs_filename)
+
+  try:
+    with os.fdopen(file_descriptor, 'w') as configfile:
+      configs.write(configfile)
+    os.replace(temp_filepath, config_filepath)
+  except BaseException:
+    os.remove(temp_filepath)
+    raise
+
+  reload_config_snapshot()
+
+
+def setup_default_config(override_existing_configs: bool = False):
+  configs = read_configs()
+  is_changed = not os.path.exists(get_configs_path())
+
   for config in config_collection_list:
-    if override_existing_configs or config.name not in configs[default_config_section_name]:
-      configs[default_config_section_name][config.name] = config.default_value
+    section = configs[default_config_section_name]
+    if override_existing_configs or config.name not in section:
+      is_changed = is_changed or section.get(config.name) != config.default_value
+      section[config.name] = config.default_value
 
-  with open(config_filepath, 'w') as configfile:
-    configs.write(configfile)
+  if is_changed:
+    write_configs(configs)
 
 
 def update_config():
+  import inquirer
+
   options: List[tuple[str, ConfigEntry]] = [
     ('Reset all configs', ConfigEntry('reset_all', '', '', None))
   ]
@@ -0,0 +1,234 @@
+import json
+import os
+import shutil
+import socket
+import sys
+from contextlib import redirect_stdout
+from typing import Optional, Tuple
+
+from rubberduck_chat.store import rubberduck_dir_name
+
+daemon_socket_filename = 'rda.sock'
+daemon_connect_timeout_in_seconds = 0.05
+daemon_buffer_size = 65536
+daemon_stop_command = 'stop'
+daemon_prompt_command = 'prompt'
+
+
+def get_daemon_socket_path() -> str:
+  return os.path.join(os.path.expanduser('~'), rubberduck_dir_name, daemon_socket_filename)
+
+
+def is_daemon_supported() -> bool:
+  return hasattr(socket, 'AF_UNIX')
+
+
+def connect_to_daemon() -> Optional[socket.socket]:
+  if not is_daemon_supported() or not os.path.exists(get_daemon_socket_path()):
+    return None
+
+  client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  client.settimeout(daemon_connect_timeout_in_seconds)
+
+  try:
+    client.connect(get_daemon_socket_path())
+  except OSError:
+    client.close()
+    return None
+
+  client.settimeout(None)
+  return client
+
+
+def send_daemon_request(client: socket.socket, request: dict):
+  client.sendall(json.dumps(request).encode('utf-8') + b'\n')
+  client.shutdown(socket.SHUT_WR)
+
+
+def forward_prompt_to_daemon(prompt: str, openai_api_key: Optional[str], namespace: Optional[str] = None) -> bool:
+  client = connect_to_daemon()
+
+  if not client:
+    return False
+
+  with client:
+    send_daemon_request(client, {
+      'command': daemon_prompt_command,
+      'prompt': prompt,
+      'openai_api_key': openai_api_key,
+      'namespace': namespace,
+      'cwd': os.getcwd(),
+      'is_terminal': sys.stdout.isatty(),
+      'terminal_width': shutil.get_terminal_size().columns,
+    })
+
+    output = sys.stdout.buffer
+
+    # Ctrl+C closes the connection, the daemon drops the answer and keeps serving other clients.
+    try:
+      while True:
+        data = client.recv(daemon_buffer_size)
+        if not data:
+          break
+        output.write(data)
+        output.flush()
+    except KeyboardInterrupt:
+      print()
+
+  return True
+
+
+def stop_daemon() -> bool:
+  client = connect_to_daemon()
+
+  if not client:
+    return False
+
+  with client:
+    send_daemon_request(client, {'command': daemon_stop_command})
+    client.recv(daemon_buffer_size)
+
+  return True
+
+
+class RubberduckDaemon:
+
+  def __init__(self, openai_api_key: Optional[str]):
+    from rubberduck_chat.chat_gpt.session_store import get_session_namespace
+    from rubberduck_chat.chat_gpt.setup_gpt import setup_gpt
+
+    self.gpt_chat = setup_gpt(openai_api_key)
+    self.namespace = get_session_namespace()
+    self.session_file_state = self.get_session_file_state()
+    self.config_snapshot = None
+    self.is_running = False
+
+  def serve_forever(self):
+    socket_path = get_daemon_socket_path()
+
+    if connect_to_daemon():
+      print(f'Daemon is already running on {socket_path}')
+      return
+
+    if os.path.exists(socket_path):
+      os.remove(socket_path)
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_path)
+    os.chmod(socket_path, 0o600)
+    server.listen()
+    self.is_running = True
+    print(f'Daemon listening on {socket_path}')
+
+    # Connections are served one at a time, the chat session and stdout redirection are shared state.
+    try:
+      while self.is_running:
+        connection, _ = server.accept()
+        with connection:
+          # A client that disconnects mid-answer only drops its own connection.
+          try:
+            self.handle_connection(connection)
+          except OSError:
+            pass
+    except KeyboardInterrupt:
+      pass
+    finally:
+      server.close()
+      if os.path.exists(socket_path):
+        os.remove(socket_path)
+
+  def handle_connection(self, connection: socket.socket):
+    with connection.makefile('rb') as reader:
+      line = reader.readline()
+
+    try:
+      request = json.loads(line)
+    except ValueError:
+      return
+
+    if request.get('command') == daemon_stop_command:
+      self.is_running = False
+      connection.sendall(b'Daemon stopped\n')
+    elif request.get('command') == daemon_prompt_command:
+      with connection.makefile('w', encoding='utf-8') as writer, redirect_stdout(writer):
+        try:
+          self.process_prompt(request)
+        except Exception as error:
+          print(str(error))
+        writer.flush()
+
+  def process_prompt(self, request: dict):
+    import openai
+    from rich.console import Console
+
+    # A key passed by a client is used for its prompt only, later clients fall back to the daemon's own key.
+    daemon_api_key = openai.api_key
+
+    if request.get('openai_api_key'):
+      openai.api_key = request['openai_api_key']
+
+    try:
+      self.refresh_configs()
+      self.refresh_namespace(request)
+      self.refresh_session()
+      self.gpt_chat.session.console = Console(force_terminal=request.get('is_terminal', False),
+                                              width=request.get('terminal_width'))
+      self.gpt_chat.process_prompt(request['prompt'])
+      self.session_file_state = self.get_session_file_state()
+    finally:
+      openai.api_key = daemon_api_key
+
+  def refresh_configs(self):
+    from rubberduck_chat.chat_gpt.setup_gpt import get_gpt_chat_configs
+    from rubberduck_chat.configs import get_config_snapshot
+
+    if get_config_snapshot() is not self.config_snapshot:
+      self.config_snapshot = get_config_snapshot()
+      self.gpt_chat.update_configs(get_gpt_chat_configs())
+
+  def refresh_namespace(self, request: dict):
+    from rubberduck_chat.chat_gpt.setup_gpt import setup_session_namespace, restore_previous_session, get_new_session
+
+    # The namespace is resolved from the directory rda was run in, not the one the daemon was started from.
+    namespace = setup_session_namespace(request.get('namespace'), request.get('cwd'))
+
+    if namespace != self.namespace:
+      self.namespace = namespace
+      configs = self.gpt_chat.configs
+      self.gpt_chat.session = restore_previous_session(configs) or get_new_session(configs)
+      self.session_file_state = self.get_session_file_state()
+
+  def refresh_session(self):
+    from rubberduck_chat.chat_gpt.session_store import get_active_session
+    from rubberduck_chat.chat_gpt.setup_gpt import restore_previous_session, get_new_session
+
+    # The session is reloaded only if another process switched sessions or appended to the session file.
+    active_session = get_active_session()
+
+    if not active_session and not self.gpt_chat.session.turns:
+      return
+
+    is_same_session = active_session and active_session.session_id == self.gpt_chat.session.session_id
+
+    if is_same_session and self.session_file_state == self.get_session_file_state():
+      return
+
+    configs = self.gpt_chat.configs
+    self.gpt_chat.session = restore_previous_session(configs) or get_new_session(configs)
+
+  def get_session_file_state(self) -> Optional[Tuple[int, int]]:
+    from rubberduck_chat.chat_gpt.session_store import get_gpt_session_filepath
+
+    try:
+      stat = os.stat(get_gpt_session_filepath(self.gpt_chat.session.session_id))
+      return stat.st_mtime_ns, stat.st_size
+    except FileNotFoundError:
+      return None
+
+
+def start_daemon(openai_api_key: Optional[str]):
+  if not is_daemon_supported():
+    print('Daemon mode requires Unix domain socket support')
+    return
+
+  RubberduckDaemon(openai_api_key).serve_forever()
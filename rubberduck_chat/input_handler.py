@@ -1,9 +1,9 @@
-from typing import Callable, List
+from typing import List, Union
 
 from rubberduck_chat import __version__
 from rubberduck_chat.chat_gpt.chat import GptChat
-from rubberduck_chat.chat_gpt.credentials import ask_for_key_input
-from rubberduck_chat.chat_gpt.setup_gpt import get_gpt_chat_configs
+from rubberduck_chat.chat_gpt.setup_gpt import get_gpt_chat_configs, get_config_list
+from rubberduck_chat.commands import Command, CommandRegistry, CommandAction
 from rubberduck_chat.configs import *
 
 if platform.system() == 'Windows':
@@ -16,40 +16,43 @@ else:
   readline = readline_input
 
 
-class Command:
-  def __init__(self, trigger: str, action: Callable[[str], None], description: str):
-    self.trigger = trigger
-    self.trigger_with_space = f'{trigger} '
-    self.action = action
-    self.description = description
-
-
-commands: List[Command] = []
+command_registry = CommandRegistry()
 
 
 def start_evaluation_loop(gpt_chat: GptChat):
   setup_command_triggers(gpt_chat)
+  config_snapshot = get_config_snapshot()
+  gpt_chat.drain_outbox_in_background()
 
   while True:
     try:
       user_input = input('>>>')
-      is_command = False
+    except (KeyboardInterrupt, EOFError):
+      exit()
+
+    # Ctrl+C while a command or prompt is running cancels only that, the session stays open.
+    try:
+      gpt_chat.apply_sent_turns()
+
+      # Pick up config edits made from another terminal while waiting for input.
+      if get_config_snapshot() is not config_snapshot:
+        config_snapshot = get_config_snapshot()
+        setup_command_triggers(gpt_chat)
+        gpt_chat.update_configs(get_gpt_chat_configs())
 
       if user_input.isnumeric() and gpt_chat.has_snippet(int(user_input)) and int(user_input) > 0:
         gpt_chat.copy_snippet(int(user_input))
         continue
 
-      for command in commands:
-        if user_input == command.trigger or user_input.startswith(command.trigger_with_space):
-          command.action(user_input)
-          is_command = True
-          continue
+      command = command_registry.find(user_input)
 
-      if not is_command:
+      if command:
+        command.action(gpt_chat, user_input)
+      else:
         gpt_chat.process_prompt(user_input)
-
+        gpt_chat.drain_outbox_in_background()
     except KeyboardInterrupt:
-      exit()
+      print('Cancelled')
 
 
 def print_hello_message():
@@ -66,7 +69,7 @@ def print_get_help_message():
 def process_help_command():
   description_to_command_map: dict[str, List[str]] = {}
 
-  for command in commands:
+  for command in command_registry.get_commands():
     if command.description in description_to_command_map:
       description_to_command_map[command.description].append(command.trigger)
     else:
@@ -97,37 +100,80 @@ def process_help_command():
       print(f'{triggers}\t\t\t\t{description}')
 
 
+def process_compare_command(gpt_chat: GptChat, user_input: str):
+  prompt = get_command_argument(user_input)
+
+  if not prompt:
+    print('Usage: .compare <PROMPT>')
+    return
+
+  gpt_chat.compare_prompt(prompt, get_config_list(config_collection.compare_models))
+
+
+def process_fork_command(gpt_chat: GptChat, user_input: str):
+  turn = get_command_argument(user_input)
+
+  if turn and not turn.isdigit():
+    print('Usage: .fork [TURN]')
+    return
+
+  gpt_chat.fork_session(int(turn) if turn else None)
+
+
+def get_command_argument(user_input: str) -> str:
+  parts = user_input.split(' ', 1)
+  return parts[1].strip() if len(parts) > 1 else ''
+
+
 def process_exit_command():
   exit()
 
 
 def setup_command_triggers(gpt_chat: GptChat):
-  commands.clear()
-  commands.extend(get_command(config_collection.supported_command_cli,
-                              lambda user_input: os.system(user_input),
-                              'Input is executed on the command line'))
-  commands.extend(get_command(config_collection.exit_command_trigger,
-                              lambda user_input: process_exit_command(),
-                              'Exit application'))
-  commands.extend(get_command(config_collection.help_command_trigger,
-                              lambda user_input: process_help_command(),
-                              'Print this help message'))
-  commands.extend(get_command(config_collection.change_session_command_trigger,
-                              lambda user_input: gpt_chat.change_session(),
-                              'Change chat session'))
-  commands.extend(get_command(config_collection.print_session_command_trigger,
-                              lambda user_input: gpt_chat.print_current_session(),
-                              'Print current session'))
-  commands.extend(get_command(config_collection.new_session_command_trigger,
-                              lambda user_input: gpt_chat.create_new_session(),
-                              'Create new session'))
-  commands.extend(get_command(config_collection.update_key_command_trigger,
-                              lambda user_input: ask_for_key_input(),
-                              'Update OpenAi credential key'))
-  commands.extend(get_command(config_collection.update_config_command_trigger,
-                              lambda user_input: update_config_value(gpt_chat),
-                              'Update config'))
-  commands.sort(key=lambda command: len(command.trigger), reverse=True)
+  command_registry.clear()
+  register_commands(config_collection.supported_command_cli,
+                    lambda chat, user_input: os.system(user_input),
+                    'Input is executed on the command line')
+  register_commands(config_collection.exit_command_trigger,
+                    lambda chat, user_input: process_exit_command(),
+                    'Exit application')
+  register_commands(config_collection.help_command_trigger,
+                    lambda chat, user_input: process_help_command(),
+                    'Print this help message')
+  register_commands(config_collection.change_session_command_trigger,
+                    lambda chat, user_input: chat.change_session(),
+                    'Change chat session')
+  register_commands(config_collection.print_session_command_trigger,
+                    lambda chat, user_input: chat.print_current_session(),
+                    'Print current session')
+  register_commands(config_collection.new_session_command_trigger,
+                    lambda chat, user_input: chat.create_new_session(),
+                    'Create new session')
+  register_commands(config_collection.compare_command_trigger,
+                    lambda chat, user_input: process_compare_command(chat, user_input),
+                    'Compare answers from several models')
+  register_commands(config_collection.pin_session_command_trigger,
+                    lambda chat, user_input: chat.toggle_pin_session(),
+                    'Pin or unpin current session')
+  register_commands(config_collection.usage_command_trigger,
+                    lambda chat, user_input: chat.print_usage(),
+                    'Print token usage and estimated cost')
+  register_commands(config_collection.fork_session_command_trigger,
+                    lambda chat, user_input: process_fork_command(chat, user_input),
+                    'Fork current session at a turn, the last turn by default')
+  register_commands(config_collection.outbox_command_trigger,
+                    lambda chat, user_input: chat.drain_outbox(),
+                    'Show and send prompts saved while the API was unavailable')
+  register_commands(config_collection.continue_command_trigger,
+                    lambda chat, user_input: chat.continue_response(),
+                    'Continue the last response after it was cancelled with Ctrl+C')
+  register_commands(config_collection.update_key_command_trigger,
+                    'rubberduck_chat.chat_gpt.credentials:process_key_command',
+                    'Update OpenAi credential key')
+  register_commands(config_collection.update_config_command_trigger,
+                    lambda chat, user_input: update_config_value(chat),
+                    'Update config')
+  command_registry.start_plugin_discovery()
 
 
 def update_config_value(gpt_chat: GptChat):
@@ -136,13 +182,18 @@ def update_config_value(gpt_chat: GptChat):
   gpt_chat.update_configs(get_gpt_chat_configs())
 
 
-def get_command(entry: ConfigEntry, create_command_trigger: Callable, description: str) -> List[Command]:
+def register_commands(entry: ConfigEntry, action: Union[CommandAction, str], description: str):
+  for command in get_command(entry, action, description):
+    command_registry.register(command)
+
+
+def get_command(entry: ConfigEntry, action: Union[CommandAction, str], description: str) -> List[Command]:
   new_commands: List[Command] = []
   command_triggers = entry.get_value().split(config_array_delimiter)
 
   for trigger in command_triggers:
     stripped_trigger = trigger.strip()
     if len(stripped_trigger) > 0:
-      new_commands.append(Command(stripped_trigger, create_command_trigger, description))
+      new_commands.append(Command(stripped_trigger, action, description))
 
   return new_commands
@@ -0,0 +1,145 @@
+import json
+import os
+import select
+import stat
+import sys
+from enum import Enum
+from typing import Optional, List, TextIO, Tuple
+
+exit_code_success = 0
+exit_code_error = 1
+exit_code_usage_error = 2
+exit_code_retryable_error = 3
+exit_code_broken_pipe = 141
+exit_code_interrupted = 130
+stdin_wait_in_seconds = 1.0
+
+
+class PipeOutputFormat(Enum):
+  RAW = 'raw'
+  JSONL = 'jsonl'
+
+
+def has_stdin_input(wait_in_seconds: Optional[float]) -> bool:
+  if sys.stdin is None or sys.stdin.isatty():
+    return False
+
+  try:
+    stdin_mode = os.fstat(sys.stdin.fileno()).st_mode
+  except (OSError, ValueError):
+    return False
+
+  if stat.S_ISREG(stdin_mode):
+    return os.fstat(sys.stdin.fileno()).st_size > 0
+
+  if not stat.S_ISFIFO(stdin_mode) and not stat.S_ISSOCK(stdin_mode):
+    return False
+
+  # A pipe inherited from a parent that never writes to it must not block, the writer gets a moment to start writing
+  # or to close it.
+  try:
+    readable, _, _ = select.select([sys.stdin], [], [], wait_in_seconds)
+    return bool(readable)
+  except (OSError, ValueError):
+    return True
+
+
+def is_pipe_mode(force_pipe_mode: bool, prompt: Optional[str]) -> bool:
+  return force_pipe_mode or has_stdin_input(stdin_wait_in_seconds) or (bool(prompt) and not sys.stdout.isatty())
+
+
+def read_pipe_input(prompt: Optional[str], context_filepaths: List[str],
+                    force_pipe_mode: bool) -> Tuple[str, str]:
+  parts: List[str] = []
+
+  # With --pipe, stdin is waited for as long as it takes to be written.
+  if has_stdin_input(None if force_pipe_mode else stdin_wait_in_seconds):
+    stdin_text = sys.stdin.read()
+    if stdin_text:
+      parts.append(stdin_text)
+
+  for context_filepath in context_filepaths:
+    with open(context_filepath, 'r', encoding='utf-8', errors='replace') as file:
+      parts.append(f'{os.path.basename(context_filepath)}:\n{file.read()}')
+
+  # The prompt argument is the instruction, stdin and the context files are the input it applies to.
+  return prompt or '', '\n\n'.join(parts)
+
+
+class PipeWriter:
+
+  def __init__(self, output: TextIO, output_format: PipeOutputFormat):
+    self.output = output
+    self.output_format = output_format
+
+  def write_content(self, content: str):
+    if self.output_format == PipeOutputFormat.JSONL:
+      self.write_line({'type': 'delta', 'content': content})
+    else:
+      self.output.write(content)
+      self.output.flush()
+
+  def write_done(self, turn_id: str, model: Optional[str], finish_reason: Optional[str]):
+    if self.output_format == PipeOutputFormat.JSONL:
+      self.write_line({'type': 'done', 'turn_id': turn_id, 'model': model, 'finish_reason': finish_reason})
+    else:
+      self.output.write('\n')
+      self.output.flush()
+
+  def write_error(self, message: str):
+    if self.output_format == PipeOutputFormat.JSONL:
+      self.write_line({'type': 'error', 'message': message})
+    print(message, file=sys.stderr)
+
+  def write_line(self, data: dict):
+    self.output.write(json.dumps(data) + '\n')
+    self.output.flush()
+
+
+def run_pipe_mode(prompt: Optional[str], context_filepaths: List[str], output_format: PipeOutputFormat,
+                  openai_api_key: Optional[str], force_pipe_mode: bool = False) -> int:
+  import openai
+
+  from rubberduck_chat.chat_gpt.map_reduce import needs_map_reduce, split_prompt
+  from rubberduck_chat.chat_gpt.model_router import fallback_errors
+  from rubberduck_chat.chat_gpt.setup_gpt import setup_gpt
+
+  writer = PipeWriter(sys.stdout, output_format)
+
+  try:
+    instruction, content = read_pipe_input(prompt, context_filepaths, force_pipe_mode)
+  except OSError as error:
+    writer.write_error(str(error))
+    return exit_code_usage_error
+
+  prompt = '\n\n'.join(part for part in [instruction, content] if part)
+
+  if not prompt.strip():
+    writer.write_error('No prompt given, pass one as an argument or through stdin')
+    return exit_code_usage_error
+
+  gpt_chat = setup_gpt(openai_api_key)
+
+  try:
+    if needs_map_reduce(prompt, gpt_chat.configs):
+      if not instruction:
+        instruction, content = split_prompt(content)
+      turn = gpt_chat.map_reduce_prompt(instruction, content)
+      writer.write_content(turn.get_assistant_response() or '')
+    else:
+      turn = gpt_chat.stream_prompt(prompt, writer.write_content)
+  except fallback_errors as error:
+    writer.write_error(f'{error}, the prompt is saved to the outbox and can be sent with `rda --drain-outbox`')
+    return exit_code_retryable_error
+  except openai.error.OpenAIError as error:
+    writer.write_error(str(error))
+    return exit_code_error
+  except KeyboardInterrupt:
+    return exit_code_interrupted
+  except BrokenPipeError:
+    # The reader went away, for example `rda ... | head`. Further writes to stdout are discarded.
+    os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+    return exit_code_broken_pipe
+
+  writer.write_done(turn.id, turn.model, turn.response['choices'][0].get('finish_reason'))
+  return exit_code_success
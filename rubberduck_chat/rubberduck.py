@@ -1,32 +1,221 @@
 import argparse
+import sys
+from typing import List
 
-from rubberduck_chat.chat_gpt.setup_gpt import setup_gpt, print_session_preview_message
-from rubberduck_chat.configs import setup_default_config
-from rubberduck_chat.input_handler import start_evaluation_loop, print_get_help_message, print_hello_message
-from rubberduck_chat.store import setup_rubberduck_dir
+from rubberduck_chat.daemon import forward_prompt_to_daemon, start_daemon, stop_daemon
+from rubberduck_chat.chat_gpt.session_namespace import is_valid_namespace
+from rubberduck_chat.pipe_mode import PipeOutputFormat, is_pipe_mode, run_pipe_mode
 
 parser = argparse.ArgumentParser(description='Rubberduck AI')
-parser.add_argument('single_prompt', nargs='?', default=None, help='Single prompt for the chat session.')
+parser.add_argument('single_prompt', nargs='?', default=None,
+                    help='Single prompt for the chat session, use `rda -- serve` for a prompt named like a subcommand.')
 parser.add_argument('-k', '--openai-api-key', default=None, required=False, help='OpenAI API key.')
 parser.add_argument('-p', '--print-session', action='store_true', required=False, help='Print current session.')
 parser.add_argument('-v', '--version', action='store_true', required=False, help='Print version.')
-args = parser.parse_args()
+parser.add_argument('-m', '--models', default=None, required=False,
+                    help='Comma separated models to send the single prompt to concurrently.')
+parser.add_argument('--retention-report', action='store_true', required=False,
+                    help='Print the sessions the retention policy would remove, without removing them.')
+parser.add_argument('--usage', action='store_true', required=False,
+                    help='Print token usage and estimated cost of the last days.')
+parser.add_argument('--rebuild-usage', action='store_true', required=False,
+                    help='Recompute token usage from all stored sessions.')
+parser.add_argument('--drain-outbox', action='store_true', required=False,
+                    help='Send the prompts saved while the API was unavailable.')
+parser.add_argument('--repair-sessions', action='store_true', required=False,
+                    help='Truncate records left incomplete by a crash at the end of session files.')
+parser.add_argument('-n', '--namespace', default=None, required=False,
+                    help='Session namespace, overrides session_namespace_mode. Use global for the shared sessions.')
+parser.add_argument('--daemon', action='store_true', required=False,
+                    help='Run a resident daemon that serves single prompts.')
+parser.add_argument('--stop-daemon', action='store_true', required=False, help='Stop the running daemon.')
+parser.add_argument('--no-daemon', action='store_true', required=False,
+                    help='Process the single prompt in process even if a daemon is running.')
+parser.add_argument('--pipe', action='store_true', required=False,
+                    help='Stream the response as plain output, used by default when stdin or stdout is not a terminal.')
+parser.add_argument('--format', default=PipeOutputFormat.RAW.value,
+                    choices=[output_format.value for output_format in PipeOutputFormat],
+                    help='Output format in pipe mode.')
+parser.add_argument('--context-file', action='append', default=[], required=False,
+                    help='File appended to the prompt in pipe mode, can be repeated.')
+
+serve_parser = argparse.ArgumentParser(prog='rda serve', description='Rubberduck AI local HTTP gateway')
+serve_parser.add_argument('--host', default='127.0.0.1', help='Host to bind.')
+serve_parser.add_argument('--port', type=int, default=8008, help='Port to bind.')
+serve_parser.add_argument('-k', '--openai-api-key', default=None, required=False, help='OpenAI API key.')
+
+
+def serve(argv: List[str]):
+  from rubberduck_chat.server import start_server
+
+  serve_args = serve_parser.parse_args(argv)
+  start_server(serve_args.openai_api_key, serve_args.host, serve_args.port)
+
+
+export_parser = argparse.ArgumentParser(prog='rda export', description='Export all sessions into a single archive')
+export_parser.add_argument('output', nargs='?', default='-',
+                           help='Archive path, compressed when it ends with .gz. Defaults to stdout.')
+export_parser.add_argument('-n', '--namespace', default=None, help='Session namespace to export.')
+
+import_parser = argparse.ArgumentParser(prog='rda import', description='Import sessions from an archive')
+import_parser.add_argument('input', help='rda archive (.jsonl/.gz) or ChatGPT data export (conversations.json/.zip).')
+import_parser.add_argument('-n', '--namespace', default=None, help='Session namespace to import into.')
+
+
+def export(argv: List[str]):
+  from rubberduck_chat.chat_gpt.session_archive import export_sessions
+  from rubberduck_chat.chat_gpt.setup_gpt import setup_gpt_session_store, setup_session_namespace
+
+  export_args = export_parser.parse_args(argv)
+
+  try:
+    setup_session_namespace(export_args.namespace)
+  except ValueError as error:
+    export_parser.error(str(error))
+
+  setup_gpt_session_store()
+  session_count = export_sessions(export_args.output)
+  print(f'Exported {session_count} sessions', file=sys.stderr)
+
+
+def import_archive(argv: List[str]):
+  from rubberduck_chat.chat_gpt.session_archive import import_sessions
+  from rubberduck_chat.chat_gpt.setup_gpt import setup_gpt_session_store, setup_session_namespace, \
+    get_retention_policy
+
+  import_args = import_parser.parse_args(argv)
+
+  try:
+    setup_session_namespace(import_args.namespace)
+  except ValueError as error:
+    import_parser.error(str(error))
+
+  setup_gpt_session_store()
+  imported_count, skipped_count = import_sessions(import_args.input)
+  print(f'Imported {imported_count} sessions, skipped {skipped_count} existing sessions')
+
+  max_saved_session_count = get_retention_policy().max_session_count
+  if imported_count > max_saved_session_count:
+    print(f'Only the {max_saved_session_count} most recent sessions are kept, '
+          f'raise max_saved_session_count to keep all imported sessions')
+
+
+subcommands = {
+  'serve': serve,
+  'export': export,
+  'import': import_archive,
+}
 
 
 def main():
+  if len(sys.argv) > 1 and sys.argv[1] in subcommands:
+    from rubberduck_chat.configs import setup_default_config
+    from rubberduck_chat.store import setup_rubberduck_dir
+
+    from rubberduck_chat.chat_gpt.setup_gpt import setup_session_namespace
+
+    setup_rubberduck_dir()
+    setup_default_config()
+    setup_session_namespace()
+    subcommands[sys.argv[1]](sys.argv[2:])
+    return
+
+  args = parser.parse_args()
 
   if args.version:
     from rubberduck_chat import __version__
     print(f'v{__version__}')
     return
 
+  if args.namespace and not is_valid_namespace(args.namespace):
+    parser.error('namespace may only contain letters, digits, ".", "_" and "-"')
+
+  if args.stop_daemon:
+    if not stop_daemon():
+      print('No daemon running')
+    return
+
+  is_pipe_prompt = not args.models and not args.print_session and not args.daemon and not args.retention_report and \
+    not args.drain_outbox and not args.usage and not args.rebuild_usage and not args.repair_sessions and \
+    is_pipe_mode(args.pipe, args.single_prompt)
+
+  # Single prompts are forwarded to the daemon before any of the heavy modules are imported.
+  if args.single_prompt and not args.models and not args.print_session and not args.daemon and not args.no_daemon \
+      and not is_pipe_prompt:
+    if forward_prompt_to_daemon(args.single_prompt, args.openai_api_key, args.namespace):
+      return
+
+  from rubberduck_chat.chat_gpt.setup_gpt import setup_gpt, print_session_preview_message, setup_session_namespace
+  from rubberduck_chat.configs import setup_default_config
+  from rubberduck_chat.input_handler import start_evaluation_loop, print_get_help_message, print_hello_message
+  from rubberduck_chat.store import setup_rubberduck_dir
+
   setup_rubberduck_dir()
   setup_default_config()
+  setup_session_namespace(args.namespace)
+
+  if args.daemon:
+    start_daemon(args.openai_api_key)
+    return
+
+  if args.retention_report:
+    from rubberduck_chat.chat_gpt.retention import get_retention_plan, print_retention_report
+    from rubberduck_chat.chat_gpt.setup_gpt import setup_gpt_session_store, get_retention_policy
+
+    setup_gpt_session_store()
+    print_retention_report(get_retention_plan(get_retention_policy()))
+    return
+
+  if args.repair_sessions:
+    from rubberduck_chat.chat_gpt.session_store import repair_session_files
+    from rubberduck_chat.chat_gpt.setup_gpt import setup_gpt_session_store
+
+    setup_gpt_session_store()
+    repairs = repair_session_files()
+
+    for filepath, repair in repairs:
+      if not repair.is_recoverable:
+        print(f'{filepath}: no valid records, left unchanged')
+      elif repair.truncated_bytes:
+        print(f'{filepath}: truncated {repair.truncated_bytes} bytes')
+
+    repaired_count = sum(1 for _, repair in repairs if repair.truncated_bytes)
+    print(f'Checked {len(repairs)} sessions, repaired {repaired_count}')
+    return
+
+  if args.usage or args.rebuild_usage:
+    from rubberduck_chat.chat_gpt.setup_gpt import setup_gpt_session_store
+    from rubberduck_chat.chat_gpt.usage_stats import rebuild_usage_stats, print_usage_report
+
+    setup_gpt_session_store()
+
+    if args.rebuild_usage:
+      print(f'Rebuilt usage from {rebuild_usage_stats()} sessions')
+
+    print_usage_report()
+    return
+
+  if args.drain_outbox:
+    from rubberduck_chat.chat_gpt.outbox import drain_outbox, get_outbox_entries, print_outbox_status, \
+      print_drain_result
+    from rubberduck_chat.chat_gpt.setup_gpt import setup_gpt_store, get_gpt_chat_configs
+
+    setup_gpt_store(args.openai_api_key)
+    configs = get_gpt_chat_configs()
+    print_outbox_status(get_outbox_entries())
+    print_drain_result(drain_outbox(configs, configs.outbox_max_workers, due_only=False))
+    return
+
+  if is_pipe_prompt:
+    sys.exit(run_pipe_mode(args.single_prompt, args.context_file, PipeOutputFormat(args.format), args.openai_api_key,
+                           args.pipe))
 
   gpt_chat = setup_gpt(args.openai_api_key)
 
   if args.print_session:
     gpt_chat.print_current_session()
+  elif args.single_prompt and args.models:
+    gpt_chat.compare_prompt(args.single_prompt, [model.strip() for model in args.models.split(',') if model.strip()])
   elif args.single_prompt:
     gpt_chat.process_prompt(args.single_prompt)
   else:
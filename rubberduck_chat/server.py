@@ -0,0 +1,301 @@
+import asyncio
+import hmac
+import os
+import secrets
+from dataclasses import dataclass, field
+from typing import Optional, List, Tuple
+from urllib.parse import urlsplit
+
+import aiohttp
+import openai
+from aiohttp import web
+
+from rubberduck_chat.chat_gpt.chat import GptChatSession, GptChatSessionConfigs
+from rubberduck_chat.chat_gpt.model_router import aroute_chat_completion, parse_model_prefix, RoutedResponse
+from rubberduck_chat.chat_gpt.rate_limiter import create_trace_config
+from rubberduck_chat.chat_gpt.session_layout import is_valid_session_id
+from rubberduck_chat.chat_gpt.session_store import GptChatTurn, get_all_session_previews, get_gpt_session_filepath
+from rubberduck_chat.chat_gpt.setup_gpt import setup_gpt_store, get_gpt_chat_configs
+from rubberduck_chat.configs import get_config_snapshot
+from rubberduck_chat.store import rubberduck_dir_name
+
+default_server_host = '127.0.0.1'
+default_server_port = 8008
+max_pooled_connections = 100
+gateway_token_filename = 'gateway-token'
+local_hostnames = {'localhost', '127.0.0.1', '::1'}
+completion_parameters = {'messages', 'model', 'stream', 'temperature', 'top_p', 'n', 'stop', 'max_tokens',
+                         'presence_penalty', 'frequency_penalty', 'logit_bias', 'user', 'functions', 'function_call'}
+
+
+def get_gateway_token_filepath() -> str:
+  return os.path.join(os.path.expanduser('~'), rubberduck_dir_name, gateway_token_filename)
+
+
+def get_gateway_token() -> str:
+  filepath = get_gateway_token_filepath()
+
+  try:
+    with open(filepath, 'r', encoding='utf-8') as file:
+      token = file.read().strip()
+      if token:
+        return token
+  except FileNotFoundError:
+    pass
+
+  # The token is only readable by the user, every request must send it as a bearer token.
+  token = secrets.token_urlsafe(32)
+  file_descriptor = os.open(filepath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+
+  with os.fdopen(file_descriptor, 'w', encoding='utf-8') as file:
+    file.write(token)
+
+  return token
+
+
+def get_hostname(value: Optional[str]) -> Optional[str]:
+  try:
+    return urlsplit(f'//{value}').hostname if value else None
+  except ValueError:
+    return None
+
+
+@dataclass
+class GatewaySession:
+  session: GptChatSession
+  file_state: Optional[Tuple[int, int]]
+  lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+
+
+def get_session_file_state(session_id: str) -> Optional[Tuple[int, int]]:
+  try:
+    stat = os.stat(get_gpt_session_filepath(session_id))
+    return stat.st_mtime_ns, stat.st_size
+  except FileNotFoundError:
+    return None
+
+
+def get_turn_json(turn: GptChatTurn) -> dict:
+  return {
+    'id': turn.id,
+    'created_time': turn.created_time,
+    'user_prompt': turn.user_prompt,
+    'model': turn.model,
+    'response': turn.get_assistant_response(),
+  }
+
+
+class ChatGateway:
+
+  def __init__(self, configs: GptChatSessionConfigs, token: str, host: str):
+    self.configs = configs
+    self.token = token
+    self.allowed_hostnames = local_hostnames | {host}
+    self.config_snapshot = get_config_snapshot()
+    self.sessions: dict[str, GatewaySession] = {}
+    self.client_session: Optional[aiohttp.ClientSession] = None
+
+  def create_app(self) -> web.Application:
+    app = web.Application(middlewares=[self.check_request])
+    app.on_startup.append(self.on_startup)
+    app.on_cleanup.append(self.on_cleanup)
+    app.add_routes([
+      web.get('/sessions', self.list_sessions),
+      web.post('/sessions', self.create_session),
+      web.get('/sessions/{session_id}', self.load_session),
+      web.post('/sessions/{session_id}/prompt', self.prompt_session),
+      web.post('/v1/chat/completions', self.chat_completions),
+    ])
+    return app
+
+  @web.middleware
+  async def check_request(self, request: web.Request, handler):
+    # The gateway spends the API key, web pages open in a browser must not be able to reach it.
+    if get_hostname(request.host) not in self.allowed_hostnames:
+      raise web.HTTPForbidden(text='Host not allowed')
+
+    origin = request.headers.get('Origin')
+    if origin and urlsplit(origin).hostname not in local_hostnames:
+      raise web.HTTPForbidden(text='Origin not allowed')
+
+    authorization = request.headers.get('Authorization', '')
+    if not hmac.compare_digest(authorization.encode('utf-8'), f'Bearer {self.token}'.encode('utf-8')):
+      raise web.HTTPUnauthorized(text=f'Missing or invalid bearer token, see {get_gateway_token_filepath()}')
+
+    return await handler(request)
+
+  async def on_startup(self, app: web.Application):
+    connector = aiohttp.TCPConnector(limit=max_pooled_connections)
+    self.client_session = aiohttp.ClientSession(connector=connector, trace_configs=[create_trace_config()])
+
+  async def on_cleanup(self, app: web.Application):
+    await self.client_session.close()
+
+  def refresh_configs(self):
+    if get_config_snapshot() is self.config_snapshot:
+      return
+
+    self.config_snapshot = get_config_snapshot()
+    self.configs = get_gpt_chat_configs()
+
+    for gateway_session in self.sessions.values():
+      gateway_session.session.configs = self.configs
+
+  async def create_chat_completion(self, messages: List[dict], pinned_model: Optional[str],
+                                   **kwargs) -> RoutedResponse:
+    # The context variable is set per request task so every completion shares one connection pool.
+    openai.aiosession.set(self.client_session)
+    return await aroute_chat_completion(messages, self.configs, pinned_model, **kwargs)
+
+  async def get_gateway_session(self, session_id: str) -> Optional[GatewaySession]:
+    gateway_session = self.sessions.get(session_id)
+
+    if gateway_session:
+      return gateway_session
+
+    # Ids come from the request path, anything that is not a plain id never reaches the file system.
+    if not is_valid_session_id(session_id):
+      return None
+
+    loop = asyncio.get_running_loop()
+    file_state = await loop.run_in_executor(None, get_session_file_state, session_id)
+
+    if file_state is None:
+      return None
+
+    session = await loop.run_in_executor(None, GptChatSession.from_session_id, session_id, self.configs)
+    return self.sessions.setdefault(session_id, GatewaySession(session, file_state))
+
+  async def refresh_gateway_session(self, gateway_session: GatewaySession):
+    # Reload sessions that were appended to by other processes since they were cached.
+    loop = asyncio.get_running_loop()
+    session_id = gateway_session.session.session_id
+    file_state = await loop.run_in_executor(None, get_session_file_state, session_id)
+
+    if file_state is None or file_state == gateway_session.file_state:
+      return
+
+    gateway_session.session = await loop.run_in_executor(None, GptChatSession.from_session_id, session_id,
+                                                         self.configs)
+    gateway_session.file_state = file_state
+
+  async def list_sessions(self, request: web.Request) -> web.Response:
+    loop = asyncio.get_running_loop()
+    previews = await loop.run_in_executor(None, get_all_session_previews)
+    return web.json_response([
+      {'session_id': preview.session_id, 'preview': preview.session_preview} for preview in previews
+    ])
+
+  async def create_session(self, request: web.Request) -> web.Response:
+    session = GptChatSession.create_new(self.configs)
+    self.sessions[session.session_id] = GatewaySession(session, None)
+    return web.json_response({'session_id': session.session_id}, status=201)
+
+  async def load_session(self, request: web.Request) -> web.Response:
+    gateway_session = await self.get_gateway_session(request.match_info['session_id'])
+
+    if not gateway_session:
+      raise web.HTTPNotFound(text='Session not found')
+
+    async with gateway_session.lock:
+      await self.refresh_gateway_session(gateway_session)
+
+    session = gateway_session.session
+    return web.json_response({
+      'session_id': session.session_id,
+      'created_time': session.session_metadata.created_time,
+      'system_message': session.system_message.content,
+      'turns': [get_turn_json(turn) for turn in session.turns],
+    })
+
+  async def prompt_session(self, request: web.Request) -> web.Response:
+    body = await read_json_body(request)
+    prompt = body.get('prompt')
+
+    if not prompt:
+      raise web.HTTPBadRequest(text='Missing prompt')
+
+    self.refresh_configs()
+    gateway_session = await self.get_gateway_session(request.match_info['session_id'])
+
+    if not gateway_session:
+      raise web.HTTPNotFound(text='Session not found')
+
+    # Writes are serialized per session, requests on other sessions are not blocked.
+    async with gateway_session.lock:
+      await self.refresh_gateway_session(gateway_session)
+      turn = await self.process_prompt(gateway_session, prompt, body.get('model'))
+
+    return web.json_response(get_turn_json(turn))
+
+  async def process_prompt(self, gateway_session: GatewaySession, prompt: str,
+                           pinned_model: Optional[str]) -> GptChatTurn:
+    loop = asyncio.get_running_loop()
+    session = gateway_session.session
+
+    if not pinned_model:
+      pinned_model, prompt = parse_model_prefix(prompt, self.configs)
+
+    turn = await loop.run_in_executor(None, session.add_user_prompt, prompt)
+
+    messages = session.get_request_messages(pinned_model)
+
+    try:
+      routed_response = await self.create_chat_completion(messages, pinned_model)
+    except openai.error.OpenAIError as error:
+      raise web.HTTPBadGateway(text=str(error))
+
+    await loop.run_in_executor(None, session.store_response, turn, routed_response.response, routed_response.model,
+                               routed_response.latency_ms)
+    await loop.run_in_executor(None, session.record_request_latency, messages, pinned_model,
+                               routed_response.latency_ms)
+    gateway_session.file_state = await loop.run_in_executor(None, get_session_file_state, session.session_id)
+    return turn
+
+  async def chat_completions(self, request: web.Request) -> web.Response:
+    body = await read_json_body(request)
+    messages = body.get('messages')
+
+    if not messages:
+      raise web.HTTPBadRequest(text='Missing messages')
+
+    if body.get('stream'):
+      raise web.HTTPBadRequest(text='Streaming is not supported')
+
+    # Parameters are passed on to the API, unknown ones are rejected instead of silently dropped.
+    unsupported_parameters = sorted(set(body) - completion_parameters)
+    if unsupported_parameters:
+      raise web.HTTPBadRequest(text=f'Unsupported parameters: {", ".join(unsupported_parameters)}')
+
+    parameters = {key: value for key, value in body.items() if key not in ['messages', 'model', 'stream']}
+
+    self.refresh_configs()
+    try:
+      routed_response = await self.create_chat_completion(messages, body.get('model'), **parameters)
+    except openai.error.OpenAIError as error:
+      return web.json_response({'error': {'message': str(error), 'type': type(error).__name__}},
+                               status=error.http_status or 502)
+
+    return web.json_response(routed_response.response)
+
+
+async def read_json_body(request: web.Request) -> dict:
+  if request.content_type != 'application/json':
+    raise web.HTTPUnsupportedMediaType(text='Content-Type must be application/json')
+
+  try:
+    body = await request.json()
+  except ValueError:
+    raise web.HTTPBadRequest(text='Invalid JSON')
+
+  if not isinstance(body, dict):
+    raise web.HTTPBadRequest(text='Body must be a JSON object')
+
+  return body
+
+
+def start_server(openai_api_key: Optional[str], host: str, port: int):
+  setup_gpt_store(openai_api_key)
+  gateway = ChatGateway(get_gpt_chat_configs(), get_gateway_token(), host)
+  print(f'Send the token in {get_gateway_token_filepath()} as `Authorization: Bearer <TOKEN>`')
+  web.run_app(gateway.create_app(), host=host, port=port)
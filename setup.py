@@ -29,7 +29,7 @@ setup(
   packages=find_packages(),
   include_package_data=True,
 
-  python_requires='>=3.5',
+  python_requires='>=3.8',
   install_requires=requirements,
   entry_points={
     'console_scripts': [